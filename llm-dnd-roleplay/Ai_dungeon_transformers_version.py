@@ -1,118 +1,187 @@
+import time
+
+# Startup timings are measured from here, so they include the imports below
+PROCESS_START = time.perf_counter()
+
 import tkinter as tk
-from tkinter import scrolledtext, messagebox
+from tkinter import scrolledtext, messagebox, ttk
+import argparse
 import random
 import json
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from pydantic import RootModel, ValidationError
-from typing import Dict
-
-# Set up the Hugging Face model and tokenizer
-class QwenModel:
-    def __init__(self):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Using device: {self.device}")
-        self.model_name = "Qwen/Qwen3-1.7B"
-        
-        # Load tokenizer and model
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_name, 
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32
-        ).to(self.device)
-        
-    def generate_response(self, messages, temperature=0.8, max_new_tokens=1024):
-        """Generate a response using the Qwen model based on a list of messages."""
-        # Format messages as a conversation
-        prompt = ""
-        for msg in messages:
-            role = msg["role"]
-            content = msg["content"]
-            if role == "system":
-                prompt += f"<|im_start|>system\n{content}<|im_end|>\n"
-            elif role == "user":
-                prompt += f"<|im_start|>user\n{content}<|im_end|>\n"
-            elif role == "assistant":
-                prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-        
-        prompt += "<|im_start|>assistant\n"
-        
-        # Tokenize input
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        
-        # Generate response
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                do_sample=True,
-                temperature=temperature,
-                max_new_tokens=max_new_tokens,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
-        
-        # Decode the generated output
-        full_output = self.tokenizer.decode(outputs[0], skip_special_tokens=False)
-        
-        # Extract the assistant's response (everything after the last assistant tag)
-        response_start = full_output.rfind("<|im_start|>assistant\n") + len("<|im_start|>assistant\n")
-        response_end = full_output.rfind("<|im_end|>")
-        
-        if response_end > response_start:
-            return full_output[response_start:response_end].strip()
-        else:
-            return full_output[response_start:].strip()
-
-# Define the Pydantic model for validation
-class DnDResponseSchema(RootModel[Dict[str, str]]):
-    def validate_keys(self):
-        expected_keys = {str(i) for i in range(1, 7)}
-        actual_keys = set(self.root.keys())
-        if expected_keys != actual_keys:
-            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
+from pydantic import ValidationError
+# torch and transformers are only imported by qwen_backend, which loads on the worker thread
+from dungeon_common import (
+    DEFAULT_RESPONSE_CACHE, OUTCOME_SYSTEM_PROMPT, SUGGESTION_SYSTEM_PROMPT, CampaignLog, DnDResponseSchema, GenerationCancelled, HistoryStore,
+    InferenceWorker, KV_CACHE_MODES, LOAD_MODES, ResponseCache, SuggestionsSchema, TRACER
+)
 
-class SuggestionsSchema(RootModel[Dict[str, str]]):
-    def validate_keys(self):
-        expected_keys = {"1", "2", "3"}
-        actual_keys = set(self.root.keys())
-        if expected_keys != actual_keys:
-            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
+# Model loading stages, in order, with the text shown next to the progress bar
+LOAD_STAGES = [
+    ("import", "Importing torch and transformers..."),
+    ("tokenizer", "Loading tokenizer..."),
+    ("weights", "Loading Qwen/Qwen3-1.7B weights..."),
+    ("warmup", "Warming up the model..."),
+]
 
 class DnDGameInterface:
-    def __init__(self, root):
+    def __init__(self, root, max_rendered_entries=500, history_page_size=100, parallel_outcomes=False, lazy_outcomes=False, context_tokens=1024, retrieval_k=4, load_mode="fp32", kv_cache="dynamic", kv_max_bytes=None,
+                 startup_probe=None, response_cache=None, prefetch=True, campaign=None, save_kv=False, history_ring=512):
         self.root = root
         self.root.title("D&D Game Interface")
         self.root.geometry("800x700")
         
-        # Initialize the model (display a loading message)
-        self.loading_label = tk.Label(self.root, text="Loading Qwen/Qwen3-1.7B model...\nThis may take a few minutes.", font=("Arial", 14))
-        self.loading_label.pack(expand=True)
-        self.root.update()
-        
-        try:
-            self.model = QwenModel()
-            self.loading_label.destroy()
-        except Exception as e:
-            messagebox.showerror("Model Loading Error", f"Failed to load model: {str(e)}")
-            self.root.quit()
-            return
+        # Set once the worker has loaded the model; an action sent before then waits for it
+        self.model = None
+        self.context = None
+        self.session = None
+        self.queued_action = None
+        self.startup_times = {}
+        # Action played automatically at startup, after which the timings are printed and the app exits
+        self.startup_probe = startup_probe
         
-        self.game_history = []
+        # Only the newest history_ring entries are held in memory; older ones are read back from disk
+        self.game_history = HistoryStore(ring_size=history_ring)
         self.current_outcomes = {}
         self.current_roll = None
         self.last_action = ""
+        # Decode the six outcome tiers as parallel rows instead of one JSON object
+        self.parallel_outcomes = parallel_outcomes
+        # Generate the rolled tier first and fill in the others in the background
+        self.lazy_outcomes = lazy_outcomes
+        self.outcomes_pending = False
+        self.pending_roll = None
+        # Replies memoized by action and scene; whether to reuse them is read from the checkbox each turn
+        self.response_cache = response_cache
+        self.reuse_cached = False
+        self.turn_started = None
+        # Outcome tables generated for the suggested actions while the player decides, by reply key
+        self.prefetch = prefetch
+        self.prefetched = {}
+        self.prefetch_started = False
+        self.prefetch_turns = 0
+        self.prefetch_hits = 0
+        # Replies with missing or empty keys get a follow-up for just those keys
+        self.repair_stats = {"repairs": 0, "keys": 0, "tokens": 0, "tokens_saved": 0}
+        # Save file the history and current turn are appended to, and whether the session's KV cache is snapshotted with it
+        self.campaign = campaign
+        self.save_kv = save_kv
+        # Summary of a resumed campaign, put back into the context window once the model has loaded
+        self.resumed_summary = ("", 0)
+        
+        # Only a bounded window of the history lives in the text widget
+        self.max_rendered_entries = max_rendered_entries
+        self.history_page_size = history_page_size
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.worker = InferenceWorker(self.root)
         
         # Create frames
         self.create_widgets()
         self.layout_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        # A saved campaign is shown straight away; its summary and KV snapshot go back once the model loads
+        if self.campaign is not None:
+            self.restore_campaign(*self.campaign.load())
+        
+        # The window is usable straight away; the model loads in the background
+        self.root.after(0, self.record_startup, "window")
+        self.worker.submit(
+            self.load_model_job,
+            {"load_mode": load_mode, "kv_cache": kv_cache, "kv_max_bytes": kv_max_bytes},
+            context_tokens,
+            retrieval_k,
+            self.resumed_summary,
+            self.kv_snapshot_path(),
+            on_done=self.on_model_ready,
+            on_error=self.on_model_error
+        )
+        if self.startup_probe:
+            self.user_input.insert(tk.END, self.startup_probe)
+            self.root.after(0, self.on_send_clicked)
+    
+    def load_model_job(self, cancel_event, model_options, context_tokens, retrieval_k, resumed_summary=("", 0), kv_snapshot=None):
+        """Import torch and transformers, load the model and warm it up, reporting each stage.
+        
+        For a resumed campaign the running summary is restored and, if a KV snapshot is given,
+        the session cache is loaded from it instead of being prefilled on the first turn.
+        """
+        stage = lambda name: self.worker.post(self.show_load_stage, name)
+        stage("import")
+        import qwen_backend
+        model = qwen_backend.QwenModel(on_stage=stage, **model_options)
+        # Prompts see a summary of older turns plus the newest entries that fit the token budget
+        context = model.new_context_window(max_tokens=context_tokens, retrieval_k=retrieval_k)
+        session = model.new_session(max_tokens=context.max_tokens + 512)
+        # The summary is part of the session header, so it has to match the snapshot's
+        summary, summarized = resumed_summary
+        if summarized:
+            context.apply_summary(summary, summarized)
+        restored = model.load_session(session, kv_snapshot) if kv_snapshot else 0
+        
+        # Kernel setup, system prompt prefills and grammars are paid for here rather than on the first turn
+        stage("warmup")
+        model.warm_up(
+            [OUTCOME_SYSTEM_PROMPT.strip(), SUGGESTION_SYSTEM_PROMPT.strip()],
+            [DnDResponseSchema.keys, SuggestionsSchema.keys]
+        )
+        return model, context, session, restored
+    
+    def show_load_stage(self, name):
+        names = [stage for stage, _ in LOAD_STAGES]
+        self.loading_label.config(text=dict(LOAD_STAGES)[name])
+        self.loading_progress.config(value=names.index(name))
+    
+    def on_model_ready(self, result):
+        self.model, self.context, self.session, restored = result
+        self.loading_frame.pack_forget()
+        self.record_startup("ready")
+        text = f"Model ready ({self.model.load_stats['load_time']:.1f}s to load)"
+        if restored:
+            text += f" | {restored} tokens restored from the KV snapshot"
+        self.stats_label.config(text=text)
+        if self.queued_action is not None:
+            user_action = self.queued_action
+            self.queued_action = None
+            self.start_turn(user_action)
+        elif self.pending_roll is not None:
+            # A reroll made before the model loaded, or saved before its tier arrived
+            self.request_missing_tiers()
+    
+    def on_model_error(self, error):
+        self.loading_label.config(text="Failed to load the model")
+        messagebox.showerror("Model Loading Error", f"Failed to load model: {str(error)}")
+        self.root.quit()
+    
+    def record_startup(self, name):
+        """Record time since process start for a startup milestone (window, ready, first_turn)."""
+        if name in self.startup_times:
+            return
+        self.startup_times[name] = time.perf_counter() - PROCESS_START
+        print(f"Startup: {name} after {self.startup_times[name]:.2f}s")
+        if name == "first_turn" and self.startup_probe:
+            print(json.dumps(self.startup_times))
+            self.root.quit()
     
     def create_widgets(self):
+        # Progress through the model loading stages, hidden once it's ready
+        self.loading_frame = tk.Frame(self.root)
+        self.loading_label = tk.Label(self.loading_frame, text="Starting...", fg="gray")
+        self.loading_progress = ttk.Progressbar(self.loading_frame, mode="determinate", maximum=len(LOAD_STAGES))
+        
         # Create main frames
         self.history_frame = tk.Frame(self.root)
         self.input_frame = tk.Frame(self.root)
         self.suggestions_frame = tk.Frame(self.root)
         
         # Game history text area
-        self.context_label = tk.Label(self.history_frame, text="Game History:")
+        self.history_header = tk.Frame(self.history_frame)
+        self.context_label = tk.Label(self.history_header, text="Game History:")
+        self.show_earlier_button = tk.Button(
+            self.history_header,
+            text="Show earlier entries",
+            command=self.on_show_earlier_clicked,
+            state=tk.DISABLED
+        )
         self.context_box = scrolledtext.ScrolledText(
             self.history_frame,
             wrap=tk.WORD,
@@ -148,6 +217,34 @@ class DnDGameInterface:
             fg="white",
             width=10
         )
+        self.stream_var = tk.BooleanVar(value=True)
+        self.stream_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Stream tokens",
+            variable=self.stream_var
+        )
+        # Off by default: overlapped suggestions can't see the roll and bypass the session KV cache
+        self.pipeline_var = tk.BooleanVar(value=False)
+        self.pipeline_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Overlap suggestions",
+            variable=self.pipeline_var
+        )
+        self.cache_var = tk.BooleanVar(value=self.response_cache is not None)
+        self.cache_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Reuse cached replies",
+            variable=self.cache_var,
+            state=tk.NORMAL if self.response_cache is not None else tk.DISABLED
+        )
+        self.trace_var = tk.BooleanVar(value=TRACER.enabled)
+        self.trace_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Trace turns",
+            variable=self.trace_var,
+            command=self.on_trace_toggled
+        )
+        self.stats_label = tk.Label(self.button_frame, text="", fg="gray")
         
         # Suggestions
         self.suggestions_label = tk.Label(self.suggestions_frame, text="Suggested Actions:")
@@ -163,9 +260,16 @@ class DnDGameInterface:
             self.suggestion_buttons.append(button)
     
     def layout_widgets(self):
+        # Layout loading progress
+        self.loading_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.loading_label.pack(side=tk.LEFT)
+        self.loading_progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        
         # Layout history frame
         self.history_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        self.context_label.pack(anchor="w")
+        self.history_header.pack(fill=tk.X)
+        self.context_label.pack(side=tk.LEFT)
+        self.show_earlier_button.pack(side=tk.RIGHT)
         self.context_box.pack(fill=tk.BOTH, expand=True)
         
         # Layout input frame
@@ -177,6 +281,11 @@ class DnDGameInterface:
         self.button_frame.pack(fill=tk.X, pady=5)
         self.send_button.pack(side=tk.LEFT, padx=5)
         self.reroll_button.pack(side=tk.LEFT, padx=5)
+        self.stream_checkbox.pack(side=tk.LEFT, padx=5)
+        self.pipeline_checkbox.pack(side=tk.LEFT, padx=5)
+        self.cache_checkbox.pack(side=tk.LEFT, padx=5)
+        self.trace_checkbox.pack(side=tk.LEFT, padx=5)
+        self.stats_label.pack(side=tk.RIGHT, padx=5)
         
         # Layout suggestions
         self.suggestions_frame.pack(fill=tk.BOTH, padx=10, pady=10)
@@ -184,18 +293,120 @@ class DnDGameInterface:
         for button in self.suggestion_buttons:
             button.pack(fill=tk.X, pady=2)
     
+    @TRACER.traced("update_context")
     def update_context(self, content, replace_last=False):
         if replace_last and self.game_history:
-            self.game_history.pop()
-        self.game_history.append(content)
-        
-        # Update the text widget
+            # The rerolled entry is no longer valid in the conversation cache
+            if self.session is not None:
+                self.session.truncate(len(self.game_history) - 1)
+            self.game_history.replace_last(content)
+            self.replace_last_rendered(content)
+        else:
+            self.game_history.append(content)
+            self.render_entry(content)
+    
+    def render_entry(self, content):
+        """Append one entry to the text widget, trimming the oldest past the scrollback limit."""
+        index = len(self.game_history) - 1
         self.context_box.config(state=tk.NORMAL)
-        self.context_box.delete(1.0, tk.END)
-        self.context_box.insert(tk.END, "\n\n".join(self.game_history))
+        if self.rendered_end > self.rendered_start:
+            self.context_box.insert(tk.END, "\n\n")
+        self.context_box.insert(tk.END, content, f"entry{index}")
+        self.rendered_end = index + 1
+        while self.rendered_end - self.rendered_start > self.max_rendered_entries:
+            self.drop_first_rendered()
         self.context_box.config(state=tk.DISABLED)
         self.context_box.see(tk.END)  # Scroll to the end
-        
+        self.update_show_earlier()
+    
+    def replace_last_rendered(self, content):
+        tag = f"entry{len(self.game_history) - 1}"
+        self.context_box.config(state=tk.NORMAL)
+        ranges = self.context_box.tag_ranges(tag)
+        if ranges:
+            start = ranges[0]
+            self.context_box.delete(ranges[0], ranges[-1])
+        else:
+            start = self.context_box.index("end-1c")
+        self.context_box.insert(start, content, tag)
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)  # Scroll to the end
+    
+    def drop_first_rendered(self):
+        next_ranges = self.context_box.tag_ranges(f"entry{self.rendered_start + 1}")
+        self.context_box.delete("1.0", next_ranges[0] if next_ranges else "end-1c")
+        self.context_box.tag_delete(f"entry{self.rendered_start}")
+        self.rendered_start += 1
+    
+    def on_show_earlier_clicked(self):
+        """Page older entries back into the text widget from the stored history."""
+        start = max(0, self.rendered_start - self.history_page_size)
+        self.context_box.config(state=tk.NORMAL)
+        for index in range(self.rendered_start - 1, start - 1, -1):
+            self.context_box.insert("1.0", "\n\n")
+            self.context_box.insert("1.0", self.game_history[index], f"entry{index}")
+        self.context_box.config(state=tk.DISABLED)
+        self.rendered_start = start
+        self.context_box.see("1.0")
+        self.update_show_earlier()
+    
+    def update_show_earlier(self):
+        self.show_earlier_button.config(state=tk.NORMAL if self.rendered_start > 0 else tk.DISABLED)
+    
+    def begin_stream(self):
+        """Open a provisional region at the end of the history that streamed tokens are written into."""
+        self.context_box.config(state=tk.NORMAL)
+        self.context_box.insert(tk.END, "\n\nDM is writing... ", "stream")
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)
+    
+    def append_stream(self, text):
+        self.context_box.config(state=tk.NORMAL)
+        self.context_box.insert(tk.END, text, "stream")
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)
+    
+    def end_stream(self):
+        ranges = self.context_box.tag_ranges("stream")
+        if ranges:
+            self.context_box.config(state=tk.NORMAL)
+            self.context_box.delete(ranges[0], ranges[-1])
+            self.context_box.config(state=tk.DISABLED)
+    
+    def on_trace_toggled(self):
+        TRACER.enabled = self.trace_var.get()
+        if not TRACER.enabled:
+            TRACER.flush()
+    
+    def end_turn_trace(self):
+        # The turn span runs from the action being sent to the suggestions (or an error) arriving
+        if self.turn_started is not None and TRACER.enabled:
+            TRACER.record("turn", self.turn_started, time.perf_counter())
+            TRACER.flush()
+        self.turn_started = None
+    
+    def show_error(self, title, message):
+        # Dialogs must be opened from the Tk thread
+        self.worker.post(messagebox.showerror, title, message)
+    
+    def show_stats(self, stats):
+        if not stats:
+            return
+        if stats.get("cached"):
+            text = "Cached reply"
+        elif stats.get("prefetched"):
+            text = "Prefetched reply"
+        else:
+            text = f"TTFT {stats['ttft']:.2f}s | {stats['tokens_per_sec']:.1f} tok/s | {stats['new_tokens']} tokens"
+        if self.response_cache is not None:
+            cache = self.response_cache.stats()
+            text += f" | cache {cache['hit_rate']:.0%} hits, {cache['saved_seconds']:.1f}s saved"
+        if self.repair_stats["repairs"]:
+            text += f" | {self.repair_stats['repairs']} repairs, {self.repair_stats['tokens_saved']} tokens saved"
+        if self.prefetch_turns:
+            text += f" | prefetch {self.prefetch_hits}/{self.prefetch_turns} hits"
+        self.stats_label.config(text=text)
+    
     def update_suggestions(self, suggestions):
         for i, button in enumerate(self.suggestion_buttons):
             button.config(text=suggestions[str(i+1)])
@@ -203,178 +414,576 @@ class DnDGameInterface:
     def roll_die(self):
         return random.randint(1, 6)
     
-    def get_model_response(self, user_action):
-        system_prompt = """
-        You are a fantasy roleplaying assistant. Your task is to return 6 different interpretations or outcomes of a user's in-game action.
-        The replies will be from failure to success with the lowest being failure, and the highest success.
-        
-        Respond ONLY in JSON format, using the following schema:
-        {
-          "1": "An epic and funny failure.",
-          "2": "The request fails perhaps the opposite effect the user wanted.",
-          "3": "The action was not successful but the outcome is neutral",
-          "4": "A fair success",
-          "5": "An elegant success",
-          "6": "an amazing success"
-        }
-        
-        Here's an example for the action "I try to climb the tower":
-        {
-          "1": "You slip on the first foothold and fall flat on your back, knocking the wind out of yourself as nearby creatures snicker at your clumsiness.",
-          "2": "Your aggressive climbing causes several loose stones to break free. They crash down around you, alerting the tower guards to your presence.",
-          "3": "After several attempts, you realize the tower's surface is too smooth to climb without proper equipment. You're back where you started.",
-          "4": "With careful movements, you manage to scale about halfway up the tower, finding a small window ledge where you can rest and observe.",
-          "5": "Your nimble fingers find perfect handholds in the weathered stone, allowing you to scale the tower with remarkable speed and silence.",
-          "6": "Not only do you scale the tower effortlessly, but you discover a hidden entrance near the top that appears to have been unused for centuries."
-        }
+    def outcome_messages(self, user_action, context=""):
+        story = f"Story context: {context}\n\n" if context else ""
+        return [
+            {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"{story}My action: {user_action}"}
+        ]
+    
+    def outcome_context(self, user_action, history):
+        # Outcomes get half the budget: earlier events relevant to the action plus the latest turns
+        return self.context.build(history, query=user_action, max_tokens=self.context.max_tokens // 2)
+    
+    def reply_key(self, kind, history, **params):
+        # Replies are matched on the latest player action and the latest DM entry
+        action = next((entry[len("Player: "):] for entry in reversed(history) if entry.startswith("Player: ")), "")
+        scene = next((entry for entry in reversed(history) if entry.startswith("DM ")), "")
+        return ResponseCache.make_key(kind, action, scene, model=self.model.model_name, **params)
+    
+    def cached_reply(self, key):
+        """Return the stored reply text for key, or None if there is none or reuse is off."""
+        if self.response_cache is None or key is None or not self.reuse_cached:
+            return None
+        start = time.perf_counter()
+        text = self.response_cache.get(key)
+        if text is not None:
+            self.model.last_stats = {"ttft": time.perf_counter() - start, "tokens_per_sec": 0.0, "new_tokens": 0, "cached": True}
+        return text
+    
+    def store_reply(self, key, text, cost):
+        """Remember a reply that took cost seconds to generate."""
+        if self.response_cache is not None and key is not None:
+            self.response_cache.put(key, text, cost)
+    
+    @TRACER.traced("parse_json")
+    def parse_reply(self, response_text):
+        """Pull the JSON object out of a reply; anything unparseable comes back empty for repair_table to fill."""
+        # Try to find JSON in the response (look for content between { and })
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx == -1 or end_idx <= start_idx:
+            return {}
+        try:
+            table = json.loads(response_text[start_idx:end_idx])
+        except json.JSONDecodeError:
+            return {}
+        return table if isinstance(table, dict) else {}
+    
+    def repair_table(self, table, schema, follow_up, temperature, cancel_event=None):
+        """Validate a parsed reply against schema and regenerate only the keys that are missing or empty.
         
-        Each response should be a short narrative or description (1–3 sentences), styled as if spoken by a dungeon master. Keep it creative and immersive.
+        follow_up() builds the prompt, and is only called once a key is missing. The follow-up decodes
+        just those values as parallel rows of it, whose system block is already cached. Returns the
+        table and the keys that still failed.
         """
+        table = {key: value.strip() for key, value in table.items() if key in schema.keys and isinstance(value, str) and value.strip()}
+        try:
+            schema(table).validate_keys()
+            return table, []
+        except ValueError:
+            missing = [key for key in schema.keys if key not in table]
         
+        stats = self.model.last_stats
+        values = self.model.generate_parallel_values(follow_up(), missing, temperature=temperature, cancel_event=cancel_event)
+        table.update({key: value for key, value in values.items() if value})
+        # Rows decode in lockstep, so each costs as many steps as the longest; a full retry would cost the whole reply again
+        used = self.model.last_stats["new_tokens"] * len(missing)
+        self.repair_stats["repairs"] += 1
+        self.repair_stats["keys"] += len(missing)
+        self.repair_stats["tokens"] += used
+        # A short, truncated reply can cost less than its repair; that saved nothing rather than a negative amount
+        self.repair_stats["tokens_saved"] += max(0, stats.get("new_tokens", 0) - used)
+        # The stats line keeps describing the reply itself
+        self.model.last_stats = stats
+        return table, [key for key in schema.keys if key not in table]
+    
+    def fill_missing(self, table, missing, placeholder):
+        # Placeholders keep the turn playable when even the targeted retry came back incomplete
+        if missing:
+            self.show_error("JSON Error", f"The model left out {', '.join(missing)} even after a retry for just those keys")
+        return {**table, **{key: placeholder(key) for key in missing}}
+    
+    @TRACER.traced("get_model_response")
+    def get_model_response(self, user_action, on_token=None, cancel_event=None, context="", cache_key=None):
         try:
-            messages = [
-                {"role": "system", "content": system_prompt.strip()},
-                {"role": "user", "content": f"My action: {user_action}"}
-            ]
-            
-            response_text = self.model.generate_response(messages, temperature=0.8)
+            response_text = self.cached_reply(cache_key)
+            if response_text is not None:
+                if on_token is not None:
+                    on_token(response_text)
+                return self.parse_reply(response_text)
             
-            # Check if the response is a valid JSON
-            try:
-                # Try to find JSON in the response (look for content between { and })
-                start_idx = response_text.find('{')
-                end_idx = response_text.rfind('}') + 1
-                
-                if start_idx != -1 and end_idx > start_idx:
-                    json_str = response_text[start_idx:end_idx]
-                    return json.loads(json_str)
-                else:
-                    # If no JSON found, try to format a response based on text
-                    fallback = {}
-                    lines = response_text.strip().split('\n')
-                    for i in range(1, 7):
-                        fallback[str(i)] = f"Outcome {i}: " + (lines[i-1] if i <= len(lines) else "Generated outcome")
-                    return fallback
-            except json.JSONDecodeError as e:
-                messagebox.showerror("JSON Error", f"Failed to parse model response: {str(e)}\n\nRaw response: {response_text}")
-                # Return a fallback dictionary
-                return {str(i): f"Error parsing outcome {i}" for i in range(1, 7)}
+            start = time.perf_counter()
+            messages = self.outcome_messages(user_action, context)
+            if self.parallel_outcomes:
+                outcomes = self.model.generate_parallel_values(messages, DnDResponseSchema.keys, temperature=0.8, cancel_event=cancel_event)
+            else:
+                outcomes = self.parse_reply(self.model.generate_response(
+                    messages,
+                    temperature=0.8,
+                    on_token=on_token,
+                    cancel_event=cancel_event,
+                    json_keys=DnDResponseSchema.keys
+                ))
+            outcomes, missing = self.repair_table(outcomes, DnDResponseSchema, lambda: messages, 0.8, cancel_event)
+            if not missing:
+                self.store_reply(cache_key, json.dumps(outcomes), time.perf_counter() - start)
+            return self.fill_missing(outcomes, missing, lambda key: f"Error parsing outcome {key}")
+        except GenerationCancelled:
+            raise
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to get model response: {str(e)}")
+            self.show_error("Error", f"Failed to get model response: {str(e)}")
             return {str(i): f"Error getting outcome {i}" for i in range(1, 7)}
     
-    def get_suggestions(self, context):
-        system_prompt = """
-        You are a fantasy roleplaying assistant. You are now an expert Dungeon Master for a fantasy role-playing adventure. Your task is to suggest 3 different possible actions the player might want to take next based on the context.
-        
-        Respond ONLY in JSON format, using the following schema:
-        {
-          "1": "A possible action described in 5-10 words",
-          "2": "A possible action described in 5-10 words",
-          "3": "A possible action described in 5-10 words"
-        }
-        
-        Here's an example for a context where the player just entered a tavern:
-        {
-          "1": "Order a drink from the bartender",
-          "2": "Ask locals about recent rumors",
-          "3": "Look for suspicious characters"
-        }
-        
-        Make the suggestions creative, varied, and appropriate to the current situation.
-        """
-        
+    @TRACER.traced("get_outcome_tiers")
+    def get_outcome_tiers(self, user_action, keys, on_token=None, cancel_event=None, context=""):
+        """Generate only the given outcome tiers for an action, as parallel rows."""
+        try:
+            return self.model.generate_parallel_values(
+                self.outcome_messages(user_action, context),
+                keys,
+                temperature=0.8,
+                on_token=on_token,
+                cancel_event=cancel_event
+            )
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            self.show_error("Error", f"Failed to get model response: {str(e)}")
+            return {key: f"Error getting outcome {key}" for key in keys}
+    
+    def suggestion_messages(self, history):
+        context = self.context.build(history, query="\n".join(history[-2:]))
+        return [
+            {"role": "system", "content": SUGGESTION_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"Game context: {context}\n\nSuggest three possible actions for the player:"}
+        ]
+    
+    def speculative_suggestion_messages(self, history):
+        # The outcome isn't known yet, so the model suggests follow-ups from the action alone
+        context = self.context.build(history, query=history[-1] if history else None)
+        return [
+            {"role": "system", "content": SUGGESTION_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"Game context: {context}\n\nThe outcome of the player's last action is still being decided. Suggest three possible actions for the player:"}
+        ]
+    
+    @TRACER.traced("get_turn_responses")
+    def get_turn_responses(self, user_action, history, on_token=None, cancel_event=None):
+        """Generate outcomes and speculative suggestions for a turn in a single batched pass."""
         try:
-            # Limit context to prevent token overflow
-            if len(context) > 2000:
-                context = context[-2000:]
-                
-            messages = [
-                {"role": "system", "content": system_prompt.strip()},
-                {"role": "user", "content": f"Game context: {context}\n\nSuggest three possible actions for the player:"}
-            ]
+            # Outcomes and speculative suggestions are stored together, as they were generated
+            cache_key = self.reply_key("turn", history, temperatures=[0.8, 0.9])
+            cached = self.cached_reply(cache_key)
+            if cached is not None:
+                outcome_text, suggestion_text = json.loads(cached)
+                if on_token is not None:
+                    on_token(outcome_text)
+                return self.parse_reply(outcome_text), self.parse_reply(suggestion_text)
             
-            response_text = self.model.generate_response(messages, temperature=0.9)
+            start = time.perf_counter()
+            outcome_messages = self.outcome_messages(user_action, self.outcome_context(user_action, history))
+            suggestion_messages = self.speculative_suggestion_messages(history)
+            outcome_text, suggestion_text = self.model.generate_batch(
+                [outcome_messages, suggestion_messages],
+                temperatures=[0.8, 0.9],
+                on_token=on_token,
+                cancel_event=cancel_event,
+                json_keys=[DnDResponseSchema.keys, SuggestionsSchema.keys]
+            )
+            outcomes, missing_outcomes = self.repair_table(self.parse_reply(outcome_text), DnDResponseSchema, lambda: outcome_messages, 0.8, cancel_event)
+            suggestions, missing_suggestions = self.repair_table(self.parse_reply(suggestion_text), SuggestionsSchema, lambda: suggestion_messages, 0.9, cancel_event)
+            if not missing_outcomes and not missing_suggestions:
+                self.store_reply(cache_key, json.dumps([json.dumps(outcomes), json.dumps(suggestions)]), time.perf_counter() - start)
+            return (
+                self.fill_missing(outcomes, missing_outcomes, lambda key: f"Error parsing outcome {key}"),
+                self.fill_missing(suggestions, missing_suggestions, lambda key: f"Suggested action {key}")
+            )
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            self.show_error("Error", f"Failed to get model response: {str(e)}")
+            return (
+                {str(i): f"Error getting outcome {i}" for i in range(1, 7)},
+                {str(i): f"Suggested action {i}" for i in range(1, 4)}
+            )
+    
+    @TRACER.traced("get_suggestions")
+    def get_suggestions(self, history, cancel_event=None):
+        try:
+            cache_key = self.reply_key("suggestions", history, temperature=0.9)
+            cached = self.cached_reply(cache_key)
+            if cached is not None:
+                return self.parse_reply(cached)
             
-            # Check if the response is a valid JSON
-            try:
-                # Try to find JSON in the response (look for content between { and })
-                start_idx = response_text.find('{')
-                end_idx = response_text.rfind('}') + 1
-                
-                if start_idx != -1 and end_idx > start_idx:
-                    json_str = response_text[start_idx:end_idx]
-                    return json.loads(json_str)
-                else:
-                    # If no JSON found, create fallback suggestions
-                    return {
-                        "1": "Explore the area around you",
-                        "2": "Talk to the nearest character",
-                        "3": "Look for items or clues"
-                    }
-            except json.JSONDecodeError as e:
-                messagebox.showerror("JSON Error", f"Failed to parse model response: {str(e)}\n\nRaw response: {response_text}")
-                # Return fallback suggestions
-                return {
-                    "1": "Explore the area around you",
-                    "2": "Talk to the nearest character",
-                    "3": "Look for items or clues"
-                }
+            start = time.perf_counter()
+            # The session cache already holds earlier turns, so only new entries are prefilled;
+            # it is reseeded whenever the summary of older turns changes
+            summary, entries = self.context.window(history)
+            # Folded entries relevant to the latest turn go after the cached part of the prompt
+            recalled = self.context.recall(history, "\n".join(history[-2:]), self.context.summarized, self.context.max_tokens // 4)
+            instruction = "Suggest three possible actions for the player:"
+            if recalled:
+                instruction = "Relevant earlier events:\n" + "\n".join(recalled) + "\n\n" + instruction
+            response_text = self.model.generate_session_response(
+                self.session,
+                SUGGESTION_SYSTEM_PROMPT.strip(),
+                f"Game context: Story so far: {summary}\n\n" if summary else "Game context: ",
+                entries,
+                instruction,
+                temperature=0.9,
+                cancel_event=cancel_event,
+                json_keys=SuggestionsSchema.keys
+            )
+            suggestions, missing = self.repair_table(
+                self.parse_reply(response_text), SuggestionsSchema, lambda: self.suggestion_messages(history), 0.9, cancel_event
+            )
+            if not missing:
+                self.store_reply(cache_key, json.dumps(suggestions), time.perf_counter() - start)
+            return self.fill_missing(suggestions, missing, lambda key: f"Suggested action {key}")
+        except GenerationCancelled:
+            raise
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to get suggestions: {str(e)}")
+            self.show_error("Error", f"Failed to get suggestions: {str(e)}")
             return {str(i): f"Suggested action {i}" for i in range(1, 4)}
     
     def on_send_clicked(self):
         user_action = self.user_input.get("1.0", tk.END).strip()
         if not user_action:
             return
-            
-        self.last_action = user_action
+        
+        # Clear user input
+        self.user_input.delete("1.0", tk.END)
+        
+        if self.model is None:
+            # Hold the action until the model has loaded; sending another replaces it
+            self.update_context(f"Player: {user_action}", replace_last=self.queued_action is not None)
+            self.queued_action = user_action
+            self.root.config(cursor="watch")
+            return
         self.update_context(f"Player: {user_action}")
+        self.start_turn(user_action)
+    
+    def start_turn(self, user_action):
+        """Generate the outcome and suggestions for an action already added to the history."""
+        # A new action supersedes whatever the model is still working on
+        self.worker.cancel_all()
+        self.end_stream()
         
-        try:
-            # Show loading indicator in the UI
+        self.last_action = user_action
+        TRACER.next_turn()
+        self.turn_started = time.perf_counter()
+        self.reuse_cached = self.cache_var.get()
+        self.current_outcomes = {}
+        self.outcomes_pending = False
+        self.pending_roll = None
+        prefetched = self.take_prefetched(self.game_history)
+        if prefetched is not None:
+            # The outcome table was generated while the player was choosing
+            outcomes, stats = prefetched
             self.root.config(cursor="watch")
-            self.root.update()
-            
-            # Get 6 possible outcomes from model
-            self.current_outcomes = self.get_model_response(user_action)
+            self.on_outcomes_ready((outcomes, dict(stats, prefetched=True)))
+            return
+        
+        # Show loading indicator in the UI while the worker runs
+        self.root.config(cursor="watch")
+        on_token = None
+        if self.stream_var.get():
+            self.begin_stream()
+            on_token = lambda text: self.worker.post(self.append_stream, text)
+        
+        if self.lazy_outcomes:
+            self.outcomes_pending = True
+            self.worker.submit(
+                self.lazy_turn_job,
+                user_action,
+                self.game_history.snapshot(),
+                on_token,
+                on_error=self.on_turn_error
+            )
+            return
+        
+        if self.pipeline_var.get() and not self.parallel_outcomes:
+            # Outcomes and suggestions decode side by side in one batch
+            self.worker.submit(
+                self.pipeline_job,
+                user_action,
+                self.game_history.snapshot(),
+                on_token,
+                on_error=self.on_turn_error
+            )
+            return
+        
+        # Get 6 possible outcomes from model in the background
+        self.worker.submit(
+            self.outcomes_job,
+            user_action,
+            self.game_history.snapshot(),
+            on_token,
+            on_done=self.on_outcomes_ready,
+            on_error=self.on_turn_error
+        )
+    
+    def outcomes_job(self, cancel_event, user_action, history, on_token):
+        context = self.outcome_context(user_action, history)
+        cache_key = self.reply_key("outcomes", history, temperature=0.8)
+        outcomes = self.get_model_response(user_action, on_token=on_token, cancel_event=cancel_event, context=context, cache_key=cache_key)
+        return outcomes, dict(self.model.last_stats)
+    
+    def pipeline_job(self, cancel_event, user_action, history, on_token):
+        outcomes, suggestions = self.get_turn_responses(user_action, history, on_token=on_token, cancel_event=cancel_event)
+        self.worker.post(self.on_pipeline_ready, (outcomes, suggestions, dict(self.model.last_stats)))
+        self.update_summary(history, cancel_event)
+    
+    def suggestions_job(self, cancel_event, history):
+        self.worker.post(self.on_suggestions_ready, self.get_suggestions(history, cancel_event=cancel_event))
+        self.update_summary(history, cancel_event)
+    
+    @TRACER.traced("update_summary")
+    def update_summary(self, history, cancel_event):
+        """Fold older entries into the running summary once they outgrow the context budget.
+        
+        Runs at the end of a turn's job, after its results are posted, so it never delays a turn;
+        if the next action cancels it the same entries are folded after that turn instead.
+        """
+        pending = self.context.pending_summary(history)
+        if pending is None:
+            return
+        previous, entries, end = pending
+        try:
+            summary = self.model.generate_response(
+                self.context.summary_messages(previous, entries),
+                temperature=0.3,
+                max_new_tokens=self.context.summary_tokens,
+                cancel_event=cancel_event
+            )
+        except GenerationCancelled:
+            self.context.cancel_summary()
+            return
+        except Exception as e:
+            self.context.cancel_summary()
+            self.show_error("Error", f"Failed to summarize the story so far: {str(e)}")
+            return
+        self.context.apply_summary(summary, end)
+    
+    def on_pipeline_ready(self, result):
+        outcomes, suggestions, stats = result
+        if self.show_outcome(outcomes, stats):
+            self.on_suggestions_ready(suggestions)
+    
+    def lazy_turn_job(self, cancel_event, user_action, history, on_token):
+        """Roll first, generate and show only the rolled tier, then fill in the others for rerolls."""
+        roll = self.roll_die()
+        context = self.outcome_context(user_action, history)
+        # A full table stored by any earlier turn already has every tier
+        cache_key = self.reply_key("outcomes", history, temperature=0.8)
+        cached = self.cached_reply(cache_key)
+        start = time.perf_counter()
+        if cached is not None:
+            if on_token is not None:
+                on_token(cached)
+            rolled = self.parse_reply(cached)
+        else:
+            rolled = self.get_outcome_tiers(user_action, [str(roll)], on_token=on_token, cancel_event=cancel_event, context=context)
+        rolled_cost = time.perf_counter() - start
+        self.worker.post(self.show_outcome, rolled, dict(self.model.last_stats), roll)
+        
+        history = history + [f"DM [Rolled {roll}]: {rolled[str(roll)]}"]
+        self.worker.post(self.on_suggestions_ready, self.get_suggestions(history, cancel_event=cancel_event))
+        
+        if cached is None:
+            # The remaining tiers are only needed for rerolls; they decode together as one batch
+            remaining = [key for key in DnDResponseSchema.keys if key != str(roll)]
+            start = time.perf_counter()
+            filled = self.get_outcome_tiers(user_action, remaining, cancel_event=cancel_event, context=context)
+            table = {**rolled, **filled}
+            if all(value != f"Error getting outcome {key}" for key, value in table.items()):
+                self.store_reply(cache_key, json.dumps(table), rolled_cost + time.perf_counter() - start)
+        else:
+            filled = rolled
+        self.worker.post(self.merge_outcomes, filled)
+        self.update_summary(history, cancel_event)
+    
+    def on_outcomes_ready(self, result):
+        outcomes, stats = result
+        if not self.show_outcome(outcomes, stats):
+            return
+        
+        # Get suggestions for next actions
+        self.worker.submit(self.suggestions_job, self.game_history.snapshot(), on_error=self.on_turn_error)
+    
+    def show_outcome(self, outcomes, stats, roll=None):
+        """Roll for the finished outcome table (unless already rolled) and add the result to the history."""
+        self.end_stream()
+        self.show_stats(stats)
+        try:
+            self.current_outcomes = outcomes
             
             # Roll die and get outcome
-            self.current_roll = self.roll_die()
+            self.current_roll = roll if roll is not None else self.roll_die()
             outcome = self.current_outcomes[str(self.current_roll)]
             
             # Update game context
             self.update_context(f"DM [Rolled {self.current_roll}]: {outcome}")
-            
-            # Clear user input
-            self.user_input.delete("1.0", tk.END)
-            
-            # Get suggestions for next actions
-            full_context = "\n\n".join(self.game_history)
-            suggestions = self.get_suggestions(full_context)
+        except Exception as e:
+            self.on_turn_error(e)
+            return False
+        self.record_startup("first_turn")
+        return True
+    
+    def merge_outcomes(self, outcomes):
+        """Add background-filled tiers to the table and resolve a reroll that was waiting on them."""
+        self.current_outcomes.update(outcomes)
+        self.outcomes_pending = False
+        if self.pending_roll is not None:
+            outcome = self.current_outcomes.get(str(self.pending_roll), f"Error getting outcome {self.pending_roll}")
+            self.update_context(f"DM [Rolled {self.pending_roll}]: {outcome}", replace_last=True)
+            self.pending_roll = None
+        self.save_campaign()
+    
+    def on_suggestions_ready(self, suggestions):
+        try:
             self.update_suggestions(suggestions)
-            
         except Exception as e:
-            self.update_context(f"Error: {str(e)}")
-        finally:
-            # Reset cursor
-            self.root.config(cursor="")
+            self.on_turn_error(e)
+            return
+        if self.prefetch:
+            # Runs once the model is otherwise idle; the next action cancels it
+            self.prefetch_started = True
+            self.worker.submit_idle(self.prefetch_job, self.game_history.snapshot(), [suggestions[str(i)] for i in range(1, 4)])
+        # Reset cursor
+        self.root.config(cursor="")
+        self.end_turn_trace()
+        self.save_campaign()
+    
+    def prefetch_job(self, cancel_event, history, actions):
+        """Generate outcome tables for the suggested actions, one at a time, for a click to use instantly."""
+        for action in actions:
+            turn_history = history + [f"Player: {action}"]
+            messages = self.outcome_messages(action, self.outcome_context(action, turn_history))
+            try:
+                response_text = self.model.generate_response(messages, temperature=0.8, cancel_event=cancel_event, json_keys=DnDResponseSchema.keys)
+                outcomes, missing = self.repair_table(self.parse_reply(response_text), DnDResponseSchema, lambda: messages, 0.8, cancel_event)
+            except GenerationCancelled:
+                raise
+            except Exception:
+                missing = True
+            if missing:
+                # Speculative work: a table that failed is just not offered
+                continue
+            self.worker.post(self.store_prefetched, self.reply_key("outcomes", turn_history, temperature=0.8), outcomes, dict(self.model.last_stats))
+    
+    def store_prefetched(self, key, outcomes, stats):
+        self.prefetched[key] = (outcomes, stats)
+    
+    def take_prefetched(self, history):
+        """Return the prefetched (outcomes, stats) for the action just added to history, dropping the others."""
+        prefetched = self.prefetched.get(self.reply_key("outcomes", history, temperature=0.8))
+        if self.prefetch_started:
+            self.prefetch_turns += 1
+            self.prefetch_hits += prefetched is not None
+        self.prefetched = {}
+        self.prefetch_started = False
+        return prefetched
+    
+    def on_turn_error(self, error):
+        self.end_stream()
+        self.update_context(f"Error: {str(error)}")
+        # Reset cursor
+        self.root.config(cursor="")
+        self.end_turn_trace()
+        self.save_campaign()
     
     def on_reroll_clicked(self):
         if not self.current_outcomes:
             return
             
-        # Roll again
+        # Roll again; a tier the table lacks is generated, so every other number can come up
         old_roll = self.current_roll
         self.current_roll = self.roll_die()
-        while self.current_roll == old_roll and len(self.current_outcomes) > 1:
+        while self.current_roll == old_roll:
             self.current_roll = self.roll_die()
+        
+        if str(self.current_roll) not in self.current_outcomes:
+            # Show it as soon as it lands: the background fill is already generating it, or (for a
+            # table saved before that fill finished) the missing tiers are generated now
+            self.pending_roll = self.current_roll
+            self.update_context(f"DM [Rolled {self.current_roll}]: ...", replace_last=True)
+            if not self.outcomes_pending:
+                self.request_missing_tiers()
+            self.save_campaign()
+            return
+        self.pending_roll = None
             
         outcome = self.current_outcomes[str(self.current_roll)]
         
         # Update game context (replace last entry)
         self.update_context(f"DM [Rolled {self.current_roll}]: {outcome}", replace_last=True)
+        self.save_campaign()
+    
+    def request_missing_tiers(self):
+        """Generate the outcome tiers missing from the current table and merge them in when they land."""
+        if self.model is None:
+            # on_model_ready asks again once the model has loaded
+            return
+        missing = [key for key in DnDResponseSchema.keys if key not in self.current_outcomes]
+        self.outcomes_pending = True
+        self.worker.submit(
+            self.tiers_job,
+            self.last_action,
+            # The history up to the player's action, without the DM entry rerolls replace
+            self.game_history.snapshot(len(self.game_history) - 1),
+            missing,
+            on_done=self.merge_outcomes,
+            on_error=self.on_turn_error
+        )
+    
+    def tiers_job(self, cancel_event, user_action, history, keys):
+        return self.get_outcome_tiers(user_action, keys, cancel_event=cancel_event, context=self.outcome_context(user_action, history))
+    
+    def campaign_meta(self):
+        summary, summarized = self.resumed_summary if self.context is None else (self.context.summary, self.context.summarized)
+        return {
+            "outcomes": self.current_outcomes,
+            "roll": self.current_roll,
+            # A reroll still waiting on its tier; the table may lack tiers the background fill hadn't added yet
+            "pending_roll": self.pending_roll,
+            "action": self.last_action,
+            "suggestions": [button["text"] for button in self.suggestion_buttons],
+            "summary": summary,
+            "summarized": summarized,
+        }
+    
+    def restore_campaign(self, history, meta):
+        """Show a saved campaign's history and put its last turn back, so play continues where it stopped."""
+        # Only the newest entries are rendered, as if they had been played in this window
+        start = max(0, len(history) - self.max_rendered_entries)
+        self.game_history.extend(history[:start])
+        self.rendered_start = self.rendered_end = start
+        for entry in history[start:]:
+            self.game_history.append(entry)
+            self.render_entry(entry)
+        self.update_show_earlier()
+        self.current_outcomes = meta.get("outcomes") or {}
+        self.current_roll = meta.get("roll")
+        self.pending_roll = meta.get("pending_roll")
+        self.last_action = meta.get("action", "")
+        for button, text in zip(self.suggestion_buttons, meta.get("suggestions", [])):
+            button.config(text=text)
+        self.resumed_summary = (meta.get("summary", ""), meta.get("summarized", 0))
+    
+    def kv_snapshot_path(self):
+        return self.campaign.path + ".kv" if self.campaign is not None and self.save_kv else None
+    
+    def save_campaign(self):
+        if self.campaign is None:
+            return
+        try:
+            self.campaign.save(self.game_history, self.campaign_meta())
+        except OSError as e:
+            self.show_error("Save Error", f"Failed to save the campaign: {str(e)}")
+    
+    def on_close(self):
+        # Stop the model first so the session cache is free to snapshot
+        self.worker.cancel_all()
+        self.save_campaign()
+        TRACER.close()
+        snapshot = self.kv_snapshot_path()
+        if snapshot is not None and self.session is not None:
+            try:
+                self.model.save_session(self.session, snapshot)
+            except Exception as e:
+                print(f"Failed to save the KV snapshot: {e}")
+        self.root.destroy()
     
     def on_suggestion_clicked(self, suggestion_number):
         suggestion = self.suggestion_buttons[suggestion_number-1]["text"]
@@ -385,8 +994,46 @@ class DnDGameInterface:
         self.user_input.see(tk.END)
 
 def main():
+    parser = argparse.ArgumentParser(description="AI dungeon with a local Qwen model")
+    parser.add_argument("--parallel-outcomes", action="store_true", help="decode the six outcomes as parallel rows")
+    parser.add_argument("--lazy-outcomes", action="store_true", help="show the rolled outcome first and fill in the rest in the background")
+    parser.add_argument("--context-tokens", type=int, default=1024, help="token budget for the game context in prompts")
+    parser.add_argument("--retrieval-k", type=int, default=4, help="earlier entries recalled by relevance per prompt (0 to disable)")
+    parser.add_argument("--load-mode", choices=LOAD_MODES, default="fp32", help="weight precision: fp32, bf16, or int8 linear layers (CPU)")
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="dynamic", help="KV cache for single replies: dynamic, int8/int4 quantized, or offloaded to CPU (CUDA)")
+    parser.add_argument("--kv-max-mb", type=float, default=None, help="ceiling on a reply's KV cache; older prompt tokens slide out to fit")
+    parser.add_argument("--response-cache", metavar="PATH", default=DEFAULT_RESPONSE_CACHE, help="SQLite file for memoized replies")
+    parser.add_argument("--no-response-cache", action="store_true", help="never store or reuse replies")
+    parser.add_argument("--no-prefetch", action="store_true", help="don't generate outcomes for the suggested actions while idle")
+    parser.add_argument("--trace", action="store_true", help="record timing spans for each turn from the start (also a checkbox)")
+    parser.add_argument("--trace-file", default="dungeon_trace.jsonl", help="JSONL file the spans are appended to")
+    parser.add_argument("--metrics-file", default="dungeon_metrics.prom", help="Prometheus textfile with per-stage totals")
+    parser.add_argument("--campaign", metavar="PATH", help="save file to resume the campaign from and autosave it to")
+    parser.add_argument("--history-ring", type=int, default=512, help="newest history entries kept in memory; older ones are memory-mapped from disk")
+    parser.add_argument("--save-kv", action="store_true", help="also snapshot the session KV cache next to the campaign on exit")
+    parser.add_argument("--startup-probe", metavar="ACTION", help="play ACTION as soon as the window opens, print startup timings and exit")
+    args = parser.parse_args()
+    TRACER.trace_path = args.trace_file
+    TRACER.metrics_path = args.metrics_file
+    TRACER.enabled = args.trace
+    
     root = tk.Tk()
-    app = DnDGameInterface(root)
+    app = DnDGameInterface(
+        root,
+        parallel_outcomes=args.parallel_outcomes,
+        lazy_outcomes=args.lazy_outcomes,
+        context_tokens=args.context_tokens,
+        retrieval_k=args.retrieval_k,
+        load_mode=args.load_mode,
+        kv_cache=args.kv_cache,
+        kv_max_bytes=int(args.kv_max_mb * 2**20) if args.kv_max_mb else None,
+        startup_probe=args.startup_probe,
+        response_cache=None if args.no_response_cache else ResponseCache(args.response_cache),
+        prefetch=not args.no_prefetch,
+        campaign=CampaignLog(args.campaign) if args.campaign else None,
+        history_ring=args.history_ring,
+        save_kv=args.save_kv
+    )
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,277 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Make the dungeon scripts importable when run from another directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dungeon_common
+from dungeon_common import LOAD_MODES
+
+def read_actions(path):
+    """Yield (index, id, action, context) for each line of a JSONL file of scripted actions.
+
+    A line is {"action": "..."} with an optional unique "id" (default: its line number) and "context" (the
+    story so far, sent the way the game sends its context window). Blank lines are skipped.
+    """
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            yield number, str(item.get("id", number)), item["action"], item.get("context", "")
+
+def completed_ids(path):
+    """Ids already written to an output file; failed actions don't count, so a rerun retries them."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash is generated again
+                continue
+            if "error" not in result:
+                done.add(result["id"])
+    return done
+
+def parse_table(response_text, keys):
+    """Pull the JSON object out of a reply; returns the non-empty string values and the keys without one."""
+    start_idx = response_text.find('{')
+    end_idx = response_text.rfind('}') + 1
+    table = {}
+    if start_idx != -1 and end_idx > start_idx:
+        try:
+            table = json.loads(response_text[start_idx:end_idx])
+        except json.JSONDecodeError:
+            pass
+    if not isinstance(table, dict):
+        table = {}
+    values = {key: table[key].strip() for key in keys if isinstance(table.get(key), str) and table[key].strip()}
+    return values, [key for key in keys if key not in values]
+
+def outcome_messages(prompts, action, context):
+    story = f"Story context: {context}\n\n" if context else ""
+    return [
+        {"role": "system", "content": prompts.OUTCOME_SYSTEM_PROMPT.strip()},
+        {"role": "user", "content": f"{story}My action: {action}"}
+    ]
+
+def suggestion_messages(prompts, action, context):
+    # Suggestions follow on from the action whichever tier is rolled
+    story = f"{context}\n" if context else ""
+    return [
+        {"role": "system", "content": prompts.SUGGESTION_SYSTEM_PROMPT.strip()},
+        {"role": "user", "content": f"Game context: {story}Player: {action}\n\nSuggest three possible actions for the player:"}
+    ]
+
+def make_backend(args):
+    """Return the module whose prompts are used and submit(messages, temperature, json_keys) -> Future of (text, stats)."""
+    if args.backend == "lm-studio":
+        # The client and the prompts worded for LM Studio's models, without the Tk game around them
+        import lmstudio_client
+
+        # The client's semaphore bounds the requests in flight; the pool only needs to keep it full
+        client = lmstudio_client.AsyncLMStudioClient(base_url=args.base_url, max_concurrency=args.concurrency)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency * 2)
+        return lmstudio_client, lambda messages, temperature, json_keys: pool.submit(
+            client.complete, messages, temperature, max_tokens=args.max_new_tokens
+        )
+
+    if args.backend == "transformers":
+        import torch
+        from qwen_backend import QwenModel, ContinuousBatcher
+
+        # Shards split the cores between them instead of all contending for every one
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+        model = QwenModel(load_mode=args.load_mode)
+        model.warm_up(
+            [dungeon_common.OUTCOME_SYSTEM_PROMPT.strip(), dungeon_common.SUGGESTION_SYSTEM_PROMPT.strip()],
+            [dungeon_common.DnDResponseSchema.keys, dungeon_common.SuggestionsSchema.keys]
+        )
+        # Each action decodes an outcome row and a suggestion row
+        batcher = ContinuousBatcher(model, max_batch=args.batch_size * 2)
+        return dungeon_common, lambda messages, temperature, json_keys: batcher.submit(
+            messages, temperature=temperature, max_new_tokens=args.max_new_tokens, json_keys=json_keys
+        )
+
+    from dungeon_benchmarks import FakeModel
+
+    def fake_complete(messages, temperature, json_keys):
+        model = FakeModel(token_delay=args.token_delay)
+        text = model.generate_response(messages, temperature=temperature, max_new_tokens=args.max_new_tokens, json_keys=json_keys)
+        return text, model.last_stats
+
+    pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    return dungeon_common, lambda messages, temperature, json_keys: pool.submit(fake_complete, messages, temperature, json_keys)
+
+def run_shard(shard, args, done, results):
+    """Generate every action whose index falls in this shard, putting one result dict per action on results.
+
+    Actions are read ahead batch_size at a time and submitted longest prompt first, so rows the
+    batcher admits together have similar lengths and little left padding; the system prompts are
+    shared, so the story context and action decide the length. A semaphore bounds the actions in
+    flight, and each one frees its slot as soon as its tables are back, so the batcher is refilled
+    row by row instead of waiting for the slowest action of a window.
+    """
+    try:
+        prompts, submit = make_backend(args)
+        actions = (
+            item for item in read_actions(args.input)
+            if item[0] % args.workers == shard and item[1] not in done
+        )
+        tables = 1 if args.no_suggestions else 2
+        in_flight = args.max_in_flight or args.batch_size * 2
+        slots = threading.BoundedSemaphore(in_flight)
+        lock = threading.Lock()
+        pending = {}
+
+        def on_done(future, action_id, kind, keys):
+            # Runs on the backend's thread; writes the action once all of its tables are back
+            with lock:
+                result = pending[action_id]
+                try:
+                    text, stats = future.result()
+                except Exception as e:
+                    result["error"] = f"{kind}: {e}"
+                else:
+                    result[kind], missing = parse_table(text, keys)
+                    if missing:
+                        result.setdefault("missing", {})[kind] = missing
+                    result["new_tokens"] += stats.get("new_tokens", 0)
+                result["tables"] += 1
+                if result["tables"] < tables:
+                    return
+                del pending[action_id]
+            del result["tables"]
+            result["seconds"] = time.perf_counter() - result.pop("started")
+            results.put(result)
+            slots.release()
+
+        def start(action_id, kind, messages, temperature, keys):
+            submit(messages, temperature, keys).add_done_callback(lambda future: on_done(future, action_id, kind, keys))
+
+        while True:
+            window = [item for _, item in zip(range(args.batch_size), actions)]
+            if not window:
+                break
+            window.sort(key=lambda item: len(item[2]) + len(item[3]), reverse=True)
+            for _, action_id, action, context in window:
+                slots.acquire()
+                with lock:
+                    pending[action_id] = {"id": action_id, "action": action, "new_tokens": 0, "tables": 0, "started": time.perf_counter()}
+                start(action_id, "outcomes", outcome_messages(prompts, action, context), 0.8, dungeon_common.DnDResponseSchema.keys)
+                if not args.no_suggestions:
+                    start(action_id, "suggestions", suggestion_messages(prompts, action, context), 0.9, dungeon_common.SuggestionsSchema.keys)
+
+        # Every slot is back once the last action has been written
+        for _ in range(in_flight):
+            slots.acquire()
+    except Exception as e:
+        results.put({"shard_error": f"shard {shard}: {e}"})
+    finally:
+        results.put({"shard_done": shard})
+
+def write_progress(path, progress):
+    # Written whole and swapped in, so a crash never leaves half a file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate outcome tables and suggestions for a JSONL file of scripted actions")
+    parser.add_argument("input", help='JSONL file with one {"id": ..., "action": ..., "context": ...} per line')
+    parser.add_argument("--output", default=None, help="JSONL results, appended to as actions finish (default <input>.tables.jsonl)")
+    parser.add_argument("--backend", choices=("transformers", "lm-studio", "fake"), default="transformers")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes; actions are sharded between them by line")
+    parser.add_argument("--batch-size", type=int, default=8, help="actions read ahead and length-sorted together per worker")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="actions submitted but not yet finished per worker (default twice --batch-size)")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight per worker (lm-studio and fake backends)")
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--load-mode", choices=LOAD_MODES, default="fp32", help="weight precision for the transformers backend")
+    parser.add_argument("--base-url", default="http://localhost:1234/v1", help="OpenAI-compatible endpoint for the lm-studio backend")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds per token for the fake backend")
+    parser.add_argument("--no-suggestions", action="store_true", help="only generate outcome tables")
+    parser.add_argument("--checkpoint-every", type=int, default=50, help="results between progress checkpoints")
+    parser.add_argument("--restart", action="store_true", help="discard earlier output instead of resuming from it")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + ".tables.jsonl"
+    progress_path = output + ".progress.json"
+    if args.restart:
+        for path in (output, progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Resume: the output itself records what is done, the progress file the time already spent
+    done = completed_ids(output)
+    progress = {"input": args.input, "output": output, "completed": len(done), "failed": 0, "incomplete_tables": 0, "new_tokens": 0, "elapsed_s": 0.0, "actions_per_minute": 0.0}
+    if done and os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        progress.update({key: previous[key] for key in ("incomplete_tables", "new_tokens", "elapsed_s") if key in previous})
+    previous_elapsed = progress["elapsed_s"]
+    if done:
+        print(f"Resuming: {len(done)} actions already in {output}")
+
+    # Spawned rather than forked, so every shard starts torch and its threads cleanly
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [context.Process(target=run_shard, args=(shard, args, done, results), daemon=True) for shard in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    start = time.perf_counter()
+    finished = 0
+    run_completed = 0
+    shard_errors = []
+    with open(output, "a", encoding="utf-8") as out:
+        while finished < len(workers):
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                # A shard killed outright (e.g. out of memory) never reports back
+                if not any(worker.is_alive() for worker in workers) and results.empty():
+                    shard_errors.append("worker exited without finishing")
+                    break
+                continue
+            if "shard_done" in result:
+                finished += 1
+                continue
+            if "shard_error" in result:
+                shard_errors.append(result["shard_error"])
+                continue
+
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if "error" in result:
+                progress["failed"] += 1
+            else:
+                progress["completed"] += 1
+                run_completed += 1
+                progress["incomplete_tables"] += bool(result.get("missing"))
+                progress["new_tokens"] += result["new_tokens"]
+
+            elapsed = time.perf_counter() - start
+            progress["elapsed_s"] = previous_elapsed + elapsed
+            progress["actions_per_minute"] = run_completed / elapsed * 60 if elapsed else 0.0
+            if (progress["completed"] + progress["failed"]) % args.checkpoint_every == 0:
+                write_progress(progress_path, progress)
+                print(f"{progress['completed']} done, {progress['failed']} failed, {progress['actions_per_minute']:.1f} actions/min")
+
+    for worker in workers:
+        worker.join()
+    progress["shard_errors"] = shard_errors
+    write_progress(progress_path, progress)
+    print(json.dumps(progress, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,792 @@
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Make the dungeon scripts importable when run from another directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def median_ms(timings):
+    return statistics.median(timings) * 1000 if timings else 0.0
+
+def sample_entry(i):
+    return f"DM [Rolled {i % 6 + 1}]: Entry {i}. You press on through the corridor as torchlight flickers over the damp stone walls."
+
+def bench_history_render(args):
+    """Time update_context as the history grows, against the old delete-and-reinsert rendering."""
+    import tkinter as tk
+    from tkinter_ai_dungeon_Lm_studio_version import DnDGameInterface
+
+    root = tk.Tk()
+    root.withdraw()
+    app = DnDGameInterface(root)
+    checkpoints = [n for n in (100, 1000, 10000, 100000) if n <= args.entries]
+    results = {"entries": args.entries, "incremental_ms": {}, "full_rewrite_ms": {}}
+
+    timings = []
+    for i in range(args.entries):
+        start = time.perf_counter()
+        app.update_context(sample_entry(i))
+        root.update_idletasks()
+        timings.append(time.perf_counter() - start)
+    for n in checkpoints:
+        results["incremental_ms"][n] = median_ms(timings[max(0, n - args.sample):n])
+
+    rerolls = []
+    for i in range(args.sample):
+        start = time.perf_counter()
+        app.update_context(sample_entry(i), replace_last=True)
+        root.update_idletasks()
+        rerolls.append(time.perf_counter() - start)
+    results["reroll_ms"] = median_ms(rerolls)
+
+    # The previous implementation rewrote the whole widget on every entry
+    box = tk.Text(root)
+    history = []
+    timings = []
+    for i in range(args.full_rewrite_entries):
+        history.append(sample_entry(i))
+        start = time.perf_counter()
+        box.delete(1.0, tk.END)
+        box.insert(tk.END, "\n\n".join(history))
+        box.see(tk.END)
+        root.update_idletasks()
+        timings.append(time.perf_counter() - start)
+    for n in (100, 1000, 10000):
+        if n <= args.full_rewrite_entries:
+            results["full_rewrite_ms"][n] = median_ms(timings[max(0, n - args.sample):n])
+
+    root.destroy()
+    return results
+
+def bench_load_mode(args):
+    """Load the model in one mode and time a short generation; run in its own process so peak RSS is per mode."""
+    from dungeon_common import DnDResponseSchema, OUTCOME_SYSTEM_PROMPT, peak_rss_mb
+    from qwen_backend import QwenModel
+
+    model = QwenModel(load_mode=args.mode)
+    results = dict(model.load_stats)
+    messages = [
+        {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+        {"role": "user", "content": f"My action: {args.action}"}
+    ]
+    model.generate_response(messages, max_new_tokens=8)
+    rates = []
+    for _ in range(args.repeats):
+        model.generate_response(messages, max_new_tokens=args.max_new_tokens, json_keys=DnDResponseSchema.keys)
+        rates.append(model.last_stats["tokens_per_sec"])
+    results["tokens_per_sec"] = statistics.median(rates)
+    # Includes the KV cache and activations of the runs above
+    results["peak_rss_mb_after_generate"] = peak_rss_mb()
+    return results
+
+def bench_load_modes(args):
+    """Peak RSS, load time and tokens/sec for each QwenModel load mode, each in a fresh process."""
+    results = {}
+    for mode in args.modes:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "load-mode", "--mode", mode,
+             "--action", args.action, "--max-new-tokens", str(args.max_new_tokens), "--repeats", str(args.repeats)],
+            capture_output=True, text=True
+        )
+        if output.returncode != 0:
+            results[mode] = {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed"}
+            continue
+        # The model prints progress before the JSON result
+        results[mode] = json.loads(output.stdout[output.stdout.index("{"):])
+    return results
+
+def bench_kv_cache_mode(args):
+    """Decode speed and peak memory of one KV cache mode at growing context lengths, in this process."""
+    import torch
+    from dungeon_common import OUTCOME_SYSTEM_PROMPT, peak_rss_mb
+    from qwen_backend import QwenModel
+
+    model = QwenModel(kv_cache=args.mode)
+    baseline_mb = peak_rss_mb()
+    results = {"mode": args.mode, "kv_bytes_per_token": model.kv_bytes_per_token(args.mode), "context": {}}
+    # Lengths run in ascending order, so the process's peak RSS after each run is that run's peak
+    for length in sorted(args.lengths):
+        entries = []
+        while model.count_tokens("\n\n".join(entries)) < length:
+            entries.extend(sample_entry(i) for i in range(len(entries), len(entries) + 50))
+        messages = [
+            {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": "Story context: " + "\n\n".join(entries) + "\n\nMy action: I look around"}
+        ]
+        if model.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        model.generate_response(messages, max_new_tokens=args.max_new_tokens)
+        row = {
+            "tokens_per_sec": model.last_stats["tokens_per_sec"],
+            "ttft_s": model.last_stats["ttft"],
+            "peak_rss_over_load_mb": peak_rss_mb() - baseline_mb if baseline_mb is not None else None,
+        }
+        if model.device == "cuda":
+            row["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        results["context"][length] = row
+    return results
+
+def bench_kv_cache(args):
+    """Each KV cache mode against the dynamic cache at 4k/8k/16k context, each mode in a fresh process."""
+    results = {}
+    for mode in args.modes:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "kv-cache-mode", "--mode", mode,
+             "--max-new-tokens", str(args.max_new_tokens), "--lengths", *map(str, args.lengths)],
+            capture_output=True, text=True
+        )
+        if output.returncode != 0:
+            results[mode] = {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed"}
+            continue
+        results[mode] = json.loads(output.stdout[output.stdout.index("{"):])
+    return results
+
+def bench_startup(args):
+    """Time-to-window, time-to-model-ready and time-to-first-turn of the transformers version, from process start."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Ai_dungeon_transformers_version.py")
+    runs = []
+    for _ in range(args.repeats):
+        output = subprocess.run([sys.executable, script, "--startup-probe", args.action], capture_output=True, text=True)
+        if output.returncode != 0:
+            return {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed"}
+        # The timings are the last line the probe prints
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+
+def bench_history_store(args):
+    """Python heap held by the history, its context window and retrieval index, plus per-turn snapshot and context cost.
+
+    "list" keeps everything in memory: a plain list and a VectorMemory that never spills. "store"
+    is a HistoryStore with a VectorMemory that moves to a memory-mapped file past its spill size.
+    Both fold entries into a placeholder summary whenever the window asks for one, as the games do.
+    """
+    import tracemalloc
+    from dungeon_common import ContextWindow, HistoryStore, VectorMemory
+
+    checkpoints = [n for n in (1000, 10000, 100000, 1000000) if n <= args.entries]
+    results = {"entries": args.entries, "ring_size": args.ring_size, "retrieval_k": args.retrieval_k}
+    variants = (
+        ("list", list, lambda: VectorMemory(spill_rows=None)),
+        ("store", lambda: HistoryStore(ring_size=args.ring_size), VectorMemory),
+    )
+    for name, make, make_memory in variants:
+        tracemalloc.start()
+        history = make()
+        context = ContextWindow(
+            lambda text: len(text.split()),
+            lambda text, max_tokens: text,
+            max_tokens=1024,
+            memory=make_memory() if args.retrieval_k else None,
+            retrieval_k=args.retrieval_k
+        )
+        row = results[name] = {"heap_mb": {}, "turn_us": {}, "counts": {}}
+        timings = []
+        for i in range(args.entries):
+            history.append(sample_entry(i))
+            if i % 2:
+                # A turn: the worker gets a snapshot of the history and builds its prompt context
+                start = time.perf_counter()
+                snapshot = list(history) if name == "list" else history.snapshot()
+                context.build(snapshot, query="\n".join(snapshot[-2:]))
+                timings.append(time.perf_counter() - start)
+                pending = context.pending_summary(snapshot)
+                if pending is not None:
+                    context.apply_summary(f"The story of the first {pending[2]} entries, condensed.", pending[2])
+            if i + 1 in checkpoints:
+                row["heap_mb"][i + 1] = tracemalloc.get_traced_memory()[0] / 2**20
+                row["turn_us"][i + 1] = statistics.median(timings[-args.sample:]) * 1e6
+                row["counts"][i + 1] = len(context.counts)
+        tracemalloc.stop()
+    return results
+
+def bench_vector_memory(args):
+    """Build and top-k query cost of the history retrieval index as it grows."""
+    from dungeon_common import VectorMemory
+
+    places = ["tavern", "tower", "crypt", "forest", "harbor", "keep", "market", "swamp"]
+    names = ["Aldric", "Mira", "Thorne", "Vex", "Oona", "Brannoc", "Ilse", "Kestrel"]
+    def entry(i):
+        return f"{sample_entry(i)} Near the {places[i % 8]}, {names[(i // 8) % 8]} mentions the relic of {names[i % 7]}."
+
+    memory = VectorMemory()
+    checkpoints = [n for n in (1000, 10000, 100000) if n <= args.entries]
+    results = {"entries": args.entries, "k": args.k, "add_us": {}, "query_ms": {}, "index_mb": {}}
+    timings = []
+    for i in range(args.entries):
+        text = entry(i)
+        start = time.perf_counter()
+        memory.add(text)
+        timings.append(time.perf_counter() - start)
+        if i + 1 in checkpoints:
+            n = i + 1
+            results["add_us"][n] = statistics.median(timings[max(0, n - args.sample):n]) * 1e6
+            queries = []
+            for q in range(args.sample):
+                query = f"What did {names[q % 8]} say at the {places[q % 8]}?"
+                start = time.perf_counter()
+                memory.search(query, args.k)
+                queries.append(time.perf_counter() - start)
+            results["query_ms"][n] = median_ms(queries)
+            results["index_mb"][n] = memory.vectors[:memory.count].nbytes / 2**20
+    results["build_s"] = sum(timings)
+    return results
+
+def timed(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def bench_outcome_batching(args):
+    """Wall-clock for an outcome table as one JSON object, as sequential per-tier calls, and as batched rows."""
+    from dungeon_common import DnDResponseSchema, OUTCOME_SYSTEM_PROMPT
+    from qwen_backend import QwenModel
+
+    model = QwenModel()
+    messages = [
+        {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+        {"role": "user", "content": f"My action: {args.action}"}
+    ]
+    # Pay for the system prompt prefill and kernel warm-up outside the measurements
+    model.generate_parallel_values(messages, ["1"], max_new_tokens=4)
+
+    results = {
+        "action": args.action,
+        "json_table_s": timed(lambda: model.generate_response(messages, json_keys=DnDResponseSchema.keys), args.repeats),
+        "rows": {},
+    }
+    for n in range(1, len(DnDResponseSchema.keys) + 1):
+        keys = DnDResponseSchema.keys[:n]
+        sequential = timed(
+            lambda: [model.generate_parallel_values(messages, [key], max_new_tokens=args.max_new_tokens) for key in keys],
+            args.repeats
+        )
+        batched = timed(lambda: model.generate_parallel_values(messages, keys, max_new_tokens=args.max_new_tokens), args.repeats)
+        results["rows"][n] = {"sequential_s": sequential, "batched_s": batched, "speedup": sequential / batched}
+
+    # The first row count at which one batched call beats the same tiers decoded one by one
+    results["crossover_rows"] = next((n for n, row in results["rows"].items() if row["speedup"] > 1.0), None)
+    return results
+
+def bench_continuous_batching(args):
+    """Aggregate tokens/sec of the shared-model scheduler as the number of concurrent sessions grows."""
+    from dungeon_common import DnDResponseSchema, OUTCOME_SYSTEM_PROMPT
+    from qwen_backend import QwenModel, ContinuousBatcher
+
+    model = QwenModel()
+    batcher = ContinuousBatcher(model, max_batch=max(args.sessions))
+    messages = [
+        {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+        {"role": "user", "content": f"My action: {args.action}"}
+    ]
+    # Pay for the system prompt prefill and kernel warm-up outside the measurements
+    batcher.submit(messages, max_new_tokens=4).result()
+
+    results = {"action": args.action, "sessions": {}}
+    for sessions in args.sessions:
+        start = time.perf_counter()
+        futures = [
+            batcher.submit(messages, max_new_tokens=args.max_new_tokens, json_keys=DnDResponseSchema.keys)
+            for _ in range(sessions)
+        ]
+        replies = [future.result() for future in futures]
+        wall = time.perf_counter() - start
+        tokens = sum(stats["new_tokens"] for _, stats in replies)
+        results["sessions"][sessions] = {
+            "wall_s": wall,
+            "tokens": tokens,
+            "aggregate_tokens_per_sec": tokens / wall,
+            "median_ttft_ms": median_ms([stats["ttft"] for _, stats in replies]),
+        }
+    results["scheduler"] = batcher.stats()
+    return results
+
+def bench_client_stub(args):
+    """Run concurrent completions through the LM Studio client against the stub server with injected faults."""
+    from concurrent.futures import ThreadPoolExecutor
+    from stub_openai_server import start_server
+    from lmstudio_client import AsyncLMStudioClient
+
+    server = start_server(
+        latency=args.latency,
+        token_delay=args.token_delay,
+        failure_rate=args.failure_rate,
+        hang_rate=args.hang_rate,
+        seed=0
+    )
+    client = AsyncLMStudioClient(
+        base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        timeout=args.timeout,
+        max_retries=args.max_retries,
+        backoff=0.05,
+        max_concurrency=args.max_concurrency
+    )
+    messages = [{"role": "system", "content": "x"}, {"role": "user", "content": "My action: open the door"}]
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            # Alternate plain and streamed requests so both paths see the faults
+            client.complete(messages, 0.8, on_token=(lambda text: None) if i % 2 else None)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, type(e).__name__
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_concurrency * 2) as pool:
+        outcomes = list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    errors = {}
+    for _, error in outcomes:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    return {
+        "requests": args.requests,
+        "succeeded": sum(1 for _, error in outcomes if error is None),
+        "errors": errors,
+        "retries": client.retries,
+        "server_requests": server.RequestHandlerClass.settings.requests,
+        "median_ms": median_ms([elapsed for elapsed, _ in outcomes]),
+        "wall_s": wall,
+    }
+
+def percentile_ms(timings, q):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1000 if ordered else 0.0
+
+# Played in order and repeated, unless --transcript gives another script
+DEFAULT_TRANSCRIPT = [
+    "I push open the tavern door and look around",
+    "I ask the innkeeper about the missing caravan",
+    "I buy a round of drinks for the dwarves in the corner",
+    "I follow the hooded stranger out into the alley",
+    "I try to pick the lock on the warehouse door",
+    "I search the crates for the caravan's seal",
+    "I hide behind the barrels when the guards arrive",
+    "I bluff that I was sent by the harbor master",
+    "I climb onto the roof and run toward the docks",
+    "I cut the mooring rope of the smugglers' boat",
+]
+
+def load_transcript(path):
+    """Actions from a JSON list or a text file with one action per line."""
+    if path is None:
+        return DEFAULT_TRANSCRIPT
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            return [str(action) for action in json.load(f)]
+        return [line.strip() for line in f if line.strip()]
+
+class FakeModel:
+    """Deterministic stand-in for QwenModel: canned JSON replies streamed at a fixed pace, without torch."""
+    model_name = "fake"
+
+    def __init__(self, prefill_s=0.0, token_delay=0.0):
+        self.prefill_s = prefill_s
+        self.token_delay = token_delay
+        self.last_stats = {}
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def truncate_tokens(self, text, max_tokens):
+        words = text.split()
+        return " ".join(words[-max_tokens:]) if len(words) > max_tokens else text
+
+    def new_context_window(self, max_tokens=1024, summary_tokens=200, retrieval_k=4):
+        from dungeon_common import ContextWindow, VectorMemory
+        return ContextWindow(
+            self.count_tokens,
+            self.truncate_tokens,
+            max_tokens=max_tokens,
+            summary_tokens=summary_tokens,
+            memory=VectorMemory() if retrieval_k else None,
+            retrieval_k=retrieval_k
+        )
+
+    def new_session(self, max_tokens=16384):
+        return None
+
+    def generate_response(self, messages, temperature=0.8, max_new_tokens=1024, on_token=None, cancel_event=None, json_keys=None, kv_cache=None):
+        from dungeon_common import GenerationCancelled
+        from stub_openai_server import reply_for
+
+        start = time.perf_counter()
+        time.sleep(self.prefill_s)
+        text = reply_for(messages) if json_keys else "The party presses on, wiser for what came before."
+        pieces = re.findall(r"\S+\s*|\s+", text)[:max_new_tokens]
+        first_token = None
+        for piece in pieces:
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled()
+            time.sleep(self.token_delay)
+            if first_token is None:
+                first_token = time.perf_counter()
+            if on_token is not None:
+                on_token(piece)
+        end = time.perf_counter()
+        decode_start = first_token or start
+        self.last_stats = {
+            "ttft": (first_token or end) - start,
+            "tokens_per_sec": len(pieces) / (end - decode_start) if end > decode_start else 0.0,
+            "new_tokens": len(pieces),
+            "total_time": end - start,
+        }
+        return "".join(pieces)
+
+    def generate_session_response(self, session, system_prompt, header, entries, instruction, temperature=0.9, max_new_tokens=1024, on_token=None, cancel_event=None, json_keys=None):
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": header + "\n\n".join(entries) + "\n\n" + instruction}
+        ]
+        return self.generate_response(messages, temperature, max_new_tokens, on_token, cancel_event, json_keys)
+
+class HeadlessWorker:
+    """Stands in for InferenceWorker when turn logic runs without a window.
+    
+    The turn methods only post to the Tk thread to open error dialogs, so every post is an error.
+    """
+    def __init__(self):
+        self.errors = []
+
+    def post(self, callback, *args):
+        self.errors.append(args)
+
+def headless_app(module, **attributes):
+    """A DnDGameInterface from module with no window, for driving its turn logic directly."""
+    app = module.DnDGameInterface.__new__(module.DnDGameInterface)
+    app.worker = HeadlessWorker()
+    app.game_history = []
+    app.last_stats = {}
+    app.response_cache = None
+    app.reuse_cached = False
+    app.repair_stats = {"repairs": 0, "keys": 0, "tokens": 0, "tokens_saved": 0}
+    for name, value in attributes.items():
+        setattr(app, name, value)
+    return app
+
+def valid_reply(table, keys):
+    # The parse and error fallbacks have the right keys but placeholder values
+    return set(table) == set(keys) and all(
+        isinstance(value, str) and value and not value.startswith(("Error ", "Outcome ", "Suggested action "))
+        for value in table.values()
+    )
+
+def play_transformers_turn(app, action, roll):
+    """One turn of the transformers version's sequential path; returns the replies, outcome stats and turn time."""
+    start = time.perf_counter()
+    app.game_history.append(f"Player: {action}")
+    history = list(app.game_history)
+    outcomes = app.get_model_response(action, on_token=lambda text: None, context=app.outcome_context(action, history))
+    stats = dict(app.model.last_stats)
+    app.game_history.append(f"DM [Rolled {roll}]: {outcomes.get(str(roll), '')}")
+    suggestions = app.get_suggestions(list(app.game_history))
+    turn_s = time.perf_counter() - start
+    # The app folds old turns after the results are shown, so it isn't part of the turn time
+    app.update_summary(list(app.game_history), None)
+    return outcomes, suggestions, stats, turn_s
+
+def play_lm_studio_turn(app, action, roll):
+    """One turn of the LM Studio version's sequential path; returns the replies, outcome stats and turn time."""
+    start = time.perf_counter()
+    app.game_history.append(f"Player: {action}")
+    history = list(app.game_history)
+    outcomes = app.get_model_response(action, on_token=lambda text: None, context=app.outcome_context(action, history))
+    stats = dict(app.last_stats)
+    app.game_history.append(f"DM [Rolled {roll}]: {outcomes.get(str(roll), '')}")
+    suggestions = app.get_suggestions(app.context.build(list(app.game_history), query="\n".join(app.game_history[-2:])))
+    turn_s = time.perf_counter() - start
+    app.update_summary(list(app.game_history))
+    return outcomes, suggestions, stats, turn_s
+
+def compare_results(baseline, results):
+    """Ratio of each headline metric to the baseline run (above 1 is more latency, speed, memory or validity)."""
+    metrics = {
+        "turn_p50": ("turn_latency_ms", "p50"),
+        "turn_p95": ("turn_latency_ms", "p95"),
+        "turn_p99": ("turn_latency_ms", "p99"),
+        "ttft_p50": ("ttft_ms", "p50"),
+        "tokens_per_sec": ("tokens_per_sec",),
+        "peak_rss_mb": ("peak_rss_mb",),
+        "json_valid_rate": ("json_valid_rate",),
+    }
+    ratios = {}
+    for name, path in metrics.items():
+        old, new = baseline, results
+        for part in path:
+            old, new = old.get(part, {}), new.get(part, {})
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old:
+            ratios[name] = new / old
+    return ratios
+
+def bench_replay(args):
+    """Replay a scripted transcript through DnDGameInterface's turn logic without a window.
+    
+    Turns follow the sequential path both versions share: outcome table, roll, suggestions, then
+    the summary update. Rolls come from a seeded generator, so runs are comparable.
+    """
+    from dungeon_common import TRACER, peak_rss_mb
+
+    actions = load_transcript(args.transcript)
+    rng = random.Random(args.seed)
+    if args.trace_file:
+        TRACER.trace_path = args.trace_file
+        TRACER.metrics_path = args.metrics_file
+        TRACER.enabled = True
+    server = None
+    if args.backend == "lm-studio":
+        import tkinter_ai_dungeon_Lm_studio_version as dungeon
+        from concurrent.futures import ThreadPoolExecutor
+        from dungeon_common import ContextWindow, VectorMemory
+        from lmstudio_client import AsyncLMStudioClient, estimate_tokens, truncate_tokens
+        from stub_openai_server import start_server
+
+        base_url = args.base_url
+        if base_url is None:
+            server = start_server(latency=args.stub_latency, token_delay=args.token_delay, seed=args.seed)
+            base_url = f"http://127.0.0.1:{server.server_port}/v1"
+        context = ContextWindow(
+            estimate_tokens,
+            truncate_tokens,
+            max_tokens=args.context_tokens,
+            memory=VectorMemory() if args.retrieval_k else None,
+            retrieval_k=args.retrieval_k
+        )
+        app = headless_app(
+            dungeon,
+            client=AsyncLMStudioClient(base_url=base_url),
+            context=context,
+            executor=ThreadPoolExecutor(max_workers=2)
+        )
+        play_turn = play_lm_studio_turn
+    else:
+        import Ai_dungeon_transformers_version as dungeon
+        if args.backend == "transformers":
+            from qwen_backend import QwenModel
+            model = QwenModel(load_mode=args.load_mode)
+            model.warm_up(
+                [dungeon.OUTCOME_SYSTEM_PROMPT.strip(), dungeon.SUGGESTION_SYSTEM_PROMPT.strip()],
+                [dungeon.DnDResponseSchema.keys, dungeon.SuggestionsSchema.keys]
+            )
+        else:
+            model = FakeModel(prefill_s=args.fake_prefill, token_delay=args.token_delay)
+        context = model.new_context_window(max_tokens=args.context_tokens, retrieval_k=args.retrieval_k)
+        app = headless_app(
+            dungeon,
+            model=model,
+            context=context,
+            session=model.new_session(max_tokens=context.max_tokens + 512),
+            parallel_outcomes=False
+        )
+        play_turn = play_transformers_turn
+
+    turn_times, ttfts, rates = [], [], []
+    valid = 0
+    for turn in range(args.turns):
+        TRACER.next_turn()
+        errors = len(app.worker.errors)
+        outcomes, suggestions, stats, turn_s = play_turn(app, actions[turn % len(actions)], rng.randint(1, 6))
+        turn_times.append(turn_s)
+        ttfts.append(stats.get("ttft", 0.0))
+        rates.append(stats.get("tokens_per_sec", 0.0))
+        if len(app.worker.errors) == errors:
+            valid += valid_reply(outcomes, dungeon.DnDResponseSchema.keys) + valid_reply(suggestions, dungeon.SuggestionsSchema.keys)
+    if server is not None:
+        server.shutdown()
+    TRACER.flush()
+
+    results = {
+        "backend": args.backend,
+        "turns": args.turns,
+        "transcript": args.transcript or "built-in",
+        "seed": args.seed,
+        "ttft_ms": {"p50": percentile_ms(ttfts, 50), "p95": percentile_ms(ttfts, 95)},
+        "tokens_per_sec": statistics.median(rates) if rates else 0.0,
+        "turn_latency_ms": {q: percentile_ms(turn_times, int(q[1:])) for q in ("p50", "p95", "p99")},
+        "peak_rss_mb": peak_rss_mb(),
+        "json_valid_rate": valid / (2 * args.turns) if args.turns else 0.0,
+        "repairs": app.repair_stats,
+        "errors": [str(error[-1]) for error in app.worker.errors],
+    }
+    if TRACER.enabled:
+        results["stage_mean_ms"] = {name: total / count * 1000 for name, (count, total, _) in sorted(TRACER.totals.items())}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            results["vs_baseline"] = compare_results(json.load(f), results)
+    output = args.output or f"replay-{args.backend}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+def bench_resume(args):
+    """Resume a saved campaign from its KV snapshot, against replaying its history into a cold session.
+    
+    Both start from the campaign file; the cold path prefills every entry the suggestion session
+    holds, the resumed one loads the snapshot and its sync finds nothing left to prefill.
+    """
+    from dungeon_common import SUGGESTION_SYSTEM_PROMPT, CampaignLog
+    from qwen_backend import QwenModel
+
+    model = QwenModel(load_mode=args.load_mode)
+    system_prompt = SUGGESTION_SYSTEM_PROMPT.strip()
+    model.warm_up([system_prompt])
+    header = "Game context: "
+
+    results = {"load_mode": args.load_mode, "entries": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for entries in args.entries:
+            path = os.path.join(directory, f"campaign-{entries}.jsonl")
+            history = [sample_entry(i) for i in range(entries)]
+            log = CampaignLog(path)
+            # Saved a turn at a time, as the game does
+            for end in range(2, entries + 1, 2):
+                log.save(history[:end], {"roll": end % 6 + 1, "summary": "", "summarized": 0})
+
+            start = time.perf_counter()
+            loaded, _ = CampaignLog(path).load()
+            session = model.new_session(max_tokens=args.session_tokens)
+            with session.lock:
+                model._sync_session(session, system_prompt, header, loaded)
+            cold = time.perf_counter() - start
+            cold_tokens = session.last_prefill_tokens
+            snapshot_bytes = model.save_session(session, path + ".kv")
+
+            start = time.perf_counter()
+            loaded, _ = CampaignLog(path).load()
+            session = model.new_session(max_tokens=args.session_tokens)
+            restored = model.load_session(session, path + ".kv")
+            with session.lock:
+                model._sync_session(session, system_prompt, header, loaded)
+            resumed = time.perf_counter() - start
+
+            results["entries"][entries] = {
+                "campaign_kb": os.path.getsize(path) / 1024,
+                "snapshot_mb": snapshot_bytes / 2**20,
+                "cold_replay_s": cold,
+                "cold_prefill_tokens": cold_tokens,
+                "resume_s": resumed,
+                "restored_tokens": restored,
+                "resume_prefill_tokens": session.last_prefill_tokens,
+                "speedup": cold / resumed if resumed else 0.0,
+            }
+    return results
+
+def main():
+    from dungeon_common import KV_CACHE_MODES
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the AI dungeon scripts")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    history_render = subparsers.add_parser("history-render", help="cost of update_context as the history grows")
+    history_render.add_argument("--entries", type=int, default=10000)
+    history_render.add_argument("--full-rewrite-entries", type=int, default=2000)
+    history_render.add_argument("--sample", type=int, default=200)
+    history_render.set_defaults(run=bench_history_render)
+
+    outcome_batching = subparsers.add_parser("outcome-batching", help="JSON outcome table vs batched per-tier rows")
+    outcome_batching.add_argument("--action", default="I try to pick the lock on the treasury door")
+    outcome_batching.add_argument("--max-new-tokens", type=int, default=160)
+    outcome_batching.add_argument("--repeats", type=int, default=3)
+    outcome_batching.set_defaults(run=bench_outcome_batching)
+
+    continuous_batching = subparsers.add_parser("continuous-batching", help="aggregate tokens/sec vs concurrent sessions")
+    continuous_batching.add_argument("--action", default="I try to pick the lock on the treasury door")
+    continuous_batching.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8])
+    continuous_batching.add_argument("--max-new-tokens", type=int, default=256)
+    continuous_batching.set_defaults(run=bench_continuous_batching)
+
+    load_modes = subparsers.add_parser("load-modes", help="peak RSS and tokens/sec for each model load mode")
+    load_modes.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    load_modes.add_argument("--action", default="I try to pick the lock on the treasury door")
+    load_modes.add_argument("--max-new-tokens", type=int, default=128)
+    load_modes.add_argument("--repeats", type=int, default=3)
+    load_modes.set_defaults(run=bench_load_modes)
+
+    load_mode = subparsers.add_parser("load-mode", help="one load mode, measured in this process")
+    load_mode.add_argument("--mode", default="fp32")
+    load_mode.add_argument("--action", default="I try to pick the lock on the treasury door")
+    load_mode.add_argument("--max-new-tokens", type=int, default=128)
+    load_mode.add_argument("--repeats", type=int, default=3)
+    load_mode.set_defaults(run=bench_load_mode)
+
+    kv_cache = subparsers.add_parser("kv-cache", help="peak memory and decode speed per KV cache mode at long context")
+    kv_cache.add_argument("--modes", nargs="+", default=list(KV_CACHE_MODES))
+    kv_cache.add_argument("--lengths", type=int, nargs="+", default=[4096, 8192, 16384])
+    kv_cache.add_argument("--max-new-tokens", type=int, default=64)
+    kv_cache.set_defaults(run=bench_kv_cache)
+
+    kv_cache_mode = subparsers.add_parser("kv-cache-mode", help="one KV cache mode, measured in this process")
+    kv_cache_mode.add_argument("--mode", default="dynamic")
+    kv_cache_mode.add_argument("--lengths", type=int, nargs="+", default=[4096, 8192, 16384])
+    kv_cache_mode.add_argument("--max-new-tokens", type=int, default=64)
+    kv_cache_mode.set_defaults(run=bench_kv_cache_mode)
+
+    startup = subparsers.add_parser("startup", help="time-to-window and time-to-first-turn of the transformers version")
+    startup.add_argument("--action", default="I try to pick the lock on the treasury door")
+    startup.add_argument("--repeats", type=int, default=3)
+    startup.set_defaults(run=bench_startup)
+
+    history_store = subparsers.add_parser("history-store", help="memory and per-turn cost of the disk-backed history up to 1M entries")
+    history_store.add_argument("--entries", type=int, default=100000)
+    history_store.add_argument("--ring-size", type=int, default=512)
+    history_store.add_argument("--sample", type=int, default=200)
+    history_store.add_argument("--retrieval-k", type=int, default=4, help="earlier entries recalled per turn from a VectorMemory (0 for none)")
+    history_store.set_defaults(run=bench_history_store)
+
+    vector_memory = subparsers.add_parser("vector-memory", help="retrieval index build and query cost up to 100k entries")
+    vector_memory.add_argument("--entries", type=int, default=100000)
+    vector_memory.add_argument("--k", type=int, default=4)
+    vector_memory.add_argument("--sample", type=int, default=200)
+    vector_memory.set_defaults(run=bench_vector_memory)
+
+    client_stub = subparsers.add_parser("client-stub", help="LM Studio client against a stub server with injected faults")
+    client_stub.add_argument("--requests", type=int, default=50)
+    client_stub.add_argument("--latency", type=float, default=0.05)
+    client_stub.add_argument("--token-delay", type=float, default=0.0)
+    client_stub.add_argument("--failure-rate", type=float, default=0.2)
+    client_stub.add_argument("--hang-rate", type=float, default=0.0)
+    client_stub.add_argument("--timeout", type=float, default=5.0)
+    client_stub.add_argument("--max-retries", type=int, default=3)
+    client_stub.add_argument("--max-concurrency", type=int, default=4)
+    client_stub.set_defaults(run=bench_client_stub)
+
+    replay = subparsers.add_parser("replay", help="scripted turns through the game logic, headless, with a JSON results file")
+    replay.add_argument("--backend", choices=["transformers", "lm-studio", "fake"], default="fake")
+    replay.add_argument("--transcript", help="JSON list or text file of actions, one per line (default: built-in script)")
+    replay.add_argument("--turns", type=int, default=20)
+    replay.add_argument("--seed", type=int, default=0)
+    replay.add_argument("--output", help="results file (default: replay-<backend>.json)")
+    replay.add_argument("--baseline", help="earlier results file to compare against")
+    replay.add_argument("--context-tokens", type=int, default=1024)
+    replay.add_argument("--retrieval-k", type=int, default=0, help="earlier entries recalled per prompt (transformers and lm-studio)")
+    replay.add_argument("--load-mode", default="fp32", help="QwenModel load mode (transformers)")
+    replay.add_argument("--base-url", help="OpenAI-compatible server to use instead of the stub (lm-studio)")
+    replay.add_argument("--stub-latency", type=float, default=0.05, help="stub server delay before answering (lm-studio)")
+    replay.add_argument("--fake-prefill", type=float, default=0.05, help="fake model delay before the first token")
+    replay.add_argument("--token-delay", type=float, default=0.005, help="seconds per token for the fake model and the stub server")
+    replay.add_argument("--trace-file", help="record timing spans for every stage to this JSONL file")
+    replay.add_argument("--metrics-file", default="replay-metrics.prom", help="Prometheus textfile written with --trace-file")
+    replay.set_defaults(run=bench_replay)
+
+    resume = subparsers.add_parser("resume", help="campaign resume from a KV snapshot vs cold replay of its history")
+    resume.add_argument("--entries", type=int, nargs="+", default=[50, 200, 500])
+    resume.add_argument("--session-tokens", type=int, default=16384, help="token budget of the suggestion session")
+    resume.add_argument("--load-mode", default="fp32", help="QwenModel load mode")
+    resume.set_defaults(run=bench_resume)
+
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+if __name__ == "__main__":
+    main()
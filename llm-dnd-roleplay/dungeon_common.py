@@ -0,0 +1,821 @@
+import functools
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from typing import ClassVar, Dict, List
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module; peak_rss_mb falls back to psutil there
+    resource = None
+
+import numpy as np
+from pydantic import RootModel
+
+# Prompts, schemas, errors, the inference worker and game-context helpers shared by the Tk games,
+# the server and the model backend. Besides the standard library it only needs pydantic and
+# NumPy, so importing it pulls in neither torch nor tkinter.
+
+# System prompts for the two kinds of model call
+OUTCOME_SYSTEM_PROMPT = """
+You are a fantasy roleplaying assistant. Your task is to return 6 different interpretations or outcomes of a user's in-game action.
+The replies will be from failure to success with the lowest being failure, and the highest success.
+
+Respond ONLY in JSON format, using the following schema:
+{
+  "1": "An epic and funny failure.",
+  "2": "The request fails perhaps the opposite effect the user wanted.",
+  "3": "The action was not successful but the outcome is neutral",
+  "4": "A fair success",
+  "5": "An elegant success",
+  "6": "an amazing success"
+}
+
+Here's an example for the action "I try to climb the tower":
+{
+  "1": "You slip on the first foothold and fall flat on your back, knocking the wind out of yourself as nearby creatures snicker at your clumsiness.",
+  "2": "Your aggressive climbing causes several loose stones to break free. They crash down around you, alerting the tower guards to your presence.",
+  "3": "After several attempts, you realize the tower's surface is too smooth to climb without proper equipment. You're back where you started.",
+  "4": "With careful movements, you manage to scale about halfway up the tower, finding a small window ledge where you can rest and observe.",
+  "5": "Your nimble fingers find perfect handholds in the weathered stone, allowing you to scale the tower with remarkable speed and silence.",
+  "6": "Not only do you scale the tower effortlessly, but you discover a hidden entrance near the top that appears to have been unused for centuries."
+}
+
+Each response should be a short narrative or description (1–3 sentences), styled as if spoken by a dungeon master. Keep it creative and immersive.
+"""
+
+SUGGESTION_SYSTEM_PROMPT = """
+You are a fantasy roleplaying assistant. You are now an expert Dungeon Master for a fantasy role-playing adventure. Your task is to suggest 3 different possible actions the player might want to take next based on the context.
+
+Respond ONLY in JSON format, using the following schema:
+{
+  "1": "A possible action described in 5-10 words",
+  "2": "A possible action described in 5-10 words",
+  "3": "A possible action described in 5-10 words"
+}
+
+Here's an example for a context where the player just entered a tavern:
+{
+  "1": "Order a drink from the bartender",
+  "2": "Ask locals about recent rumors",
+  "3": "Look for suspicious characters"
+}
+
+Make the suggestions creative, varied, and appropriate to the current situation.
+"""
+
+# Define the Pydantic model for validation
+class DnDResponseSchema(RootModel[Dict[str, str]]):
+    keys: ClassVar[List[str]] = [str(i) for i in range(1, 7)]
+    
+    def validate_keys(self):
+        expected_keys = set(self.keys)
+        actual_keys = set(self.root.keys())
+        if expected_keys != actual_keys:
+            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
+
+class SuggestionsSchema(RootModel[Dict[str, str]]):
+    keys: ClassVar[List[str]] = ["1", "2", "3"]
+    
+    def validate_keys(self):
+        expected_keys = set(self.keys)
+        actual_keys = set(self.root.keys())
+        if expected_keys != actual_keys:
+            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
+
+SUMMARY_SYSTEM_PROMPT = """
+You are the chronicler of a fantasy roleplaying adventure. Condense the story so far into a short summary the Dungeon Master can rely on.
+
+Keep the facts that matter later: names, places, items, allies, enemies, injuries, promises and unresolved threads. Leave out dice rolls and repetition.
+Respond with the summary only, as plain prose of at most 120 words.
+"""
+
+# Model options, defined here so the command line can list them before the backend is imported.
+# CPU load modes: float32 weights (~7 GB), bfloat16 (~3.5 GB), or dynamic int8 linear layers
+LOAD_MODES = ("fp32", "bf16", "int8")
+
+def cuda_driver_present():
+    """Whether an NVIDIA driver is installed, checked from its files so torch needn't be imported."""
+    if sys.platform == "win32":
+        return os.path.exists(os.path.join(os.environ.get("SystemRoot", r"C:\Windows"), "System32", "nvcuda.dll"))
+    return os.path.exists("/proc/driver/nvidia/version") or os.path.exists("/usr/lib/wsl/lib/libcuda.so")
+
+# KV cache for generate_response: transformers' dynamic cache, quantized caches, or layers offloaded
+# to CPU, which is only offered where there is a GPU to offload from
+KV_CACHE_MODES = ("dynamic", "int8", "int4") + (("offloaded",) if cuda_driver_present() else ())
+
+class GenerationCancelled(Exception):
+    """Raised inside a worker job when its generation was cancelled."""
+
+class InferenceWorker:
+    """Runs model calls on a background thread and hands results back to the Tk thread.
+    
+    Jobs are called as fn(cancel_event, *args). Submitting a new job cancels the running one and
+    drops anything still queued, so only the latest action's results ever reach the UI.
+    """
+    def __init__(self, root, poll_ms=16):
+        self.root = root
+        self.poll_ms = poll_ms  # ~60 fps
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.generation = 0
+        self.running_generation = None
+        self.current_cancel = None
+        # Guards generation and current_cancel, so a cancel can't slip in between a job's check and its start
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.root.after(self.poll_ms, self._poll)
+    
+    def submit(self, fn, *args, on_done=None, on_error=None):
+        self.cancel_all()
+        return self.submit_idle(fn, *args, on_done=on_done, on_error=on_error)
+    
+    def submit_idle(self, fn, *args, on_done=None, on_error=None):
+        """Queue a job behind the current one without cancelling it; the next submit() drops or cancels it."""
+        cancel_event = threading.Event()
+        self.jobs.put((self.generation, cancel_event, fn, args, on_done, on_error))
+        return cancel_event
+    
+    def cancel_all(self):
+        with self.lock:
+            self.generation += 1
+            if self.current_cancel is not None:
+                self.current_cancel.set()
+    
+    def post(self, callback, *args):
+        """Schedule callback(*args) on the Tk thread; dropped if its job has gone stale."""
+        generation = self.running_generation if self.running_generation is not None else self.generation
+        self.results.put((generation, callback, args))
+    
+    def _run(self):
+        while True:
+            generation, cancel_event, fn, args, on_done, on_error = self.jobs.get()
+            with self.lock:
+                if generation != self.generation or cancel_event.is_set():
+                    continue
+                self.current_cancel = cancel_event
+                self.running_generation = generation
+            try:
+                result = fn(cancel_event, *args)
+            except GenerationCancelled:
+                pass
+            except Exception as e:
+                if on_error is not None:
+                    self.post(on_error, e)
+            else:
+                if on_done is not None:
+                    self.post(on_done, result)
+            finally:
+                with self.lock:
+                    self.current_cancel = None
+                    self.running_generation = None
+    
+    def _poll(self):
+        while True:
+            try:
+                generation, callback, args = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                callback(*args)
+        self.root.after(self.poll_ms, self._poll)
+
+class VectorMemory:
+    """Cosine top-k retrieval over game history entries, kept in a growable NumPy matrix.
+    
+    Entries are embedded by signed feature hashing of their words and word pairs, so adding one
+    needs no model or external service. Vectors are unit length, so a query is one matrix-vector
+    product plus a partial sort. Past spill_rows entries the matrix moves to a memory-mapped
+    temporary file, so a marathon session's index lives in the page cache rather than the heap.
+    """
+    STOP_WORDS = frozenset(
+        "a an and are as at be but by dm for from has have he her his i in into is it its me my "
+        "of on or player rolled she so that the their them then they this to was were with you your".split()
+    )
+    
+    def __init__(self, dim=256, capacity=1024, spill_rows=4096, path=None):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.count = 0
+        self.spill_rows = spill_rows  # None keeps the matrix in memory however large it gets
+        self.path = path              # an unnamed temporary file unless a path is given
+        self.file = None
+    
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = [word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in self.STOP_WORDS]
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode())
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def add(self, text):
+        if self.count == len(self.vectors):
+            # Double the matrix so appends stay amortized O(1)
+            self.grow(2 * len(self.vectors))
+        self.vectors[self.count] = self.embed(text)
+        self.count += 1
+    
+    def grow(self, capacity):
+        if self.spill_rows is None or capacity <= self.spill_rows:
+            self.vectors = np.concatenate([self.vectors, np.zeros((capacity - len(self.vectors), self.dim), dtype=np.float32)])
+            return
+        if self.file is None:
+            self.file = open(self.path, "w+b", buffering=0) if self.path else tempfile.TemporaryFile(buffering=0)
+            self.file.write(self.vectors.tobytes())
+        # Extending the file zero-fills the new rows; only the pages a search touches are resident
+        self.file.truncate(capacity * self.dim * self.vectors.itemsize)
+        self.vectors = np.memmap(self.file, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+    
+    def truncate(self, n):
+        self.count = min(self.count, n)
+    
+    def search(self, query, k, limit=None):
+        """Indices of the (at most) k entries before limit most similar to query, best first."""
+        limit = self.count if limit is None else min(limit, self.count)
+        if k <= 0 or limit <= 0:
+            return []
+        scores = self.vectors[:limit] @ self.embed(query)
+        top = np.argpartition(-scores, k)[:k] if k < limit else np.arange(limit)
+        top = top[np.argsort(-scores[top])]
+        return [int(i) for i in top if scores[i] > 0]
+
+class ContextWindow:
+    """Token-budgeted view of the game history for prompts.
+    
+    Token counts are cached per history entry. A prompt gets the running summary of older entries
+    plus as many of the newest entries as fit in max_tokens. Once the entries after the summary
+    outgrow the budget, the oldest of them are folded into the summary by a separate model call,
+    so prompt size stays bounded however long the campaign runs, and their counts are dropped so
+    this window's memory stays bounded too. With a VectorMemory, entries that didn't make it into
+    a prompt can be recalled by similarity to a query.
+    """
+    def __init__(self, count_tokens, truncate_tokens, max_tokens=1024, summary_tokens=200, keep_recent=4, memory=None, retrieval_k=4):
+        self.count_tokens = count_tokens
+        self.truncate_tokens = truncate_tokens
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.keep_recent = keep_recent  # newest entries never folded, so rerolls can still replace them
+        self.counts = []                # token count of each history entry from counts_start on
+        self.counts_start = 0           # entries before it are summarized, so only recall counts them again
+        self.last_entry = None
+        self.summary = ""
+        self.summary_count = 0
+        self.summarized = 0             # history entries already folded into the summary
+        self.summarizing = False
+        self.memory = memory
+        self.retrieval_k = retrieval_k
+        # Reentrant, so build() and recall() can hold it from sync() through their reads of counts
+        # while the summary or a prefetch syncs the same window from another thread
+        self.lock = threading.RLock()
+    
+    def sync(self, history):
+        """Update the cached counts; the history only grows at the end or has its last entry replaced."""
+        with self.lock:
+            if len(history) < self.summarized:
+                self.summary = ""
+                self.summary_count = 0
+                self.summarized = 0
+            if self.summarized < self.counts_start:
+                # The summary was reset after its entries' counts were dropped, so count them again
+                stop = min(self.counts_start, len(history))
+                self.counts = [self.count_tokens(entry + "\n\n") for entry in history[:stop]] + (self.counts if stop == self.counts_start else [])
+                self.counts_start = 0
+            del self.counts[max(0, len(history) - self.counts_start):]
+            end = self.counts_start + len(self.counts)
+            if end and history[end - 1] != self.last_entry:
+                end -= 1
+                if self.counts:
+                    self.counts.pop()
+                else:
+                    self.counts_start = end
+            if self.memory is not None:
+                self.memory.truncate(end)
+            for entry in history[end:]:
+                self.counts.append(self.count_tokens(entry + "\n\n"))
+                if self.memory is not None:
+                    self.memory.add(entry)
+            self.last_entry = history[-1] if history else None
+            # Prompts never include summarized entries whole again
+            del self.counts[:self.summarized - self.counts_start]
+            self.counts_start = self.summarized
+    
+    def window(self, history):
+        """Return the summary and the entries it doesn't cover yet."""
+        with self.lock:
+            self.sync(history)
+            return self.summary, history[self.summarized:]
+    
+    def recall(self, history, query, limit, max_tokens):
+        """Entries before index limit most relevant to query, oldest first, within max_tokens."""
+        if self.memory is None or not query or limit <= 0:
+            return []
+        with self.lock:
+            self.sync(history)
+            picked = []
+            used = 0
+            for i in self.memory.search(query, self.retrieval_k, limit):
+                count = self.counts[i - self.counts_start] if i >= self.counts_start else self.count_tokens(history[i] + "\n\n")
+                if used + count <= max_tokens:
+                    picked.append(i)
+                    used += count
+            return [history[i] for i in sorted(picked)]
+    
+    def build(self, history, query=None, max_tokens=None):
+        """Return the summary, entries relevant to query and the newest entries as one context string within max_tokens."""
+        with self.lock:
+            self.sync(history)
+            budget = (max_tokens or self.max_tokens) - self.summary_count
+            # A quarter of the budget is set aside for recalled entries when there is something to recall by
+            recall_budget = budget // 4 if query and self.memory is not None else 0
+            picked = []
+            used = 0
+            start = len(history)
+            while start > self.summarized and used + self.counts[start - 1 - self.counts_start] <= budget - recall_budget:
+                start -= 1
+                picked.append(history[start])
+                used += self.counts[start - self.counts_start]
+            if not picked and len(history) > self.summarized:
+                # The newest entry alone is over budget, so keep its last tokens
+                start = len(history) - 1
+                picked.append(self.truncate_tokens(history[-1], budget - recall_budget))
+            
+            parts = [f"Story so far: {self.summary}"] if self.summary else []
+            recalled = self.recall(history, query, start, recall_budget)
+            if recalled:
+                parts.append("Relevant earlier events:\n" + "\n".join(recalled))
+            return "\n\n".join(parts + picked[::-1])
+    
+    def pending_summary(self, history):
+        """Claim the next entries to fold into the summary, as (previous summary, entries, end index), or None."""
+        with self.lock:
+            self.sync(history)
+            end = len(history) - self.keep_recent
+            if self.summarizing or end <= self.summarized:
+                return None
+            if sum(self.counts) <= self.max_tokens - self.summary_count:
+                return None
+            # Fold at most one budget's worth at a time so the summary prompt stays bounded too
+            stop = self.summarized
+            used = 0
+            while stop < end and (stop == self.summarized or used + self.counts[stop - self.counts_start] <= self.max_tokens):
+                used += self.counts[stop - self.counts_start]
+                stop += 1
+            self.summarizing = True
+            return self.summary, history[self.summarized:stop], stop
+    
+    def summary_messages(self, previous, entries):
+        events = "\n\n".join(entries)
+        content = f"Summary so far: {previous}\n\nWhat happened next:\n{events}" if previous else f"What happened:\n{events}"
+        return [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"{content}\n\nWrite the updated summary:"}
+        ]
+    
+    def apply_summary(self, summary, end):
+        with self.lock:
+            self.summary = summary.strip()
+            self.summary_count = self.count_tokens(self.summary)
+            self.summarized = end
+            self.summarizing = False
+    
+    def cancel_summary(self):
+        with self.lock:
+            self.summarizing = False
+
+class HistoryStore(Sequence):
+    """Game history that keeps only its newest entries in memory.
+    
+    The last ring_size entries live in a deque; older ones are appended, UTF-8 encoded, to a log
+    file that is memory-mapped for reads, with one offset per entry kept in a compact array. Only
+    the last entry can change (a reroll), so replace_last is O(1) and everything in the log is
+    immutable. That lets snapshot() hand worker threads an O(1) view instead of a copy of the list.
+    """
+    def __init__(self, ring_size=512, path=None):
+        self.ring_size = max(1, ring_size)
+        self.ring = deque()
+        self.ring_start = 0              # index of the first entry still in the ring
+        self.offsets = array("Q", [0])   # log offsets of entries before ring_start, plus the end of the log
+        # Scratch space for this process only; an unnamed temporary file unless a path is given
+        self.file = open(path, "w+b", buffering=0) if path else tempfile.TemporaryFile(buffering=0)
+        self.map = None
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return self.ring_start + len(self.ring)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.entry(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self.entry(index)
+    
+    def entry(self, index):
+        with self.lock:
+            if index >= self.ring_start:
+                return self.ring[index - self.ring_start]
+            end = self.offsets[index + 1]
+            if self.map is None or end > len(self.map):
+                # The log has grown since it was last mapped
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[self.offsets[index]:end].decode("utf-8")
+    
+    def append(self, entry):
+        with self.lock:
+            self.ring.append(entry)
+            if len(self.ring) > self.ring_size:
+                # The oldest entry can no longer change, so it moves to the log
+                self.file.write(self.ring[0].encode("utf-8"))
+                self.offsets.append(self.file.tell())
+                self.ring.popleft()
+                self.ring_start += 1
+    
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+    
+    def replace_last(self, entry):
+        with self.lock:
+            self.ring[-1] = entry
+    
+    def snapshot(self, end=None):
+        """A read-only view of the history (or its first end entries) as it is now, unaffected by later appends and rerolls."""
+        with self.lock:
+            if end is not None and end < len(self):
+                # Only the last entry can change, so a shorter prefix needs no pinned tail
+                return HistoryView(self, max(0, end), ())
+            if not self.ring:
+                return HistoryView(self, self.ring_start, ())
+            return HistoryView(self, len(self) - 1, (self.ring[-1],))
+    
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+class HistoryView(Sequence):
+    """The first base entries of a HistoryStore, which never change, followed by a pinned tail.
+    
+    Adding a list gives a longer view, so jobs can extend a snapshot with the action being
+    played without copying the history.
+    """
+    def __init__(self, store, base, tail):
+        self.store = store
+        self.base = base
+        self.tail = tail
+    
+    def __len__(self):
+        return self.base + len(self.tail)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self.store.entry(index) if index < self.base else self.tail[index - self.base]
+    
+    def __add__(self, entries):
+        return HistoryView(self.store, self.base, self.tail + tuple(entries))
+
+class ResponseCache:
+    """Memoized model replies in an in-memory LRU in front of an SQLite file.
+    
+    Keys hash the kind of call, the normalized action, a fingerprint of the scene it was made in
+    and the sampling parameters. Entries older than ttl seconds are treated as missing; the LRU
+    keeps max_entries and the database max_disk_entries, dropping the least recently used.
+    Each entry stores how long it took to generate, so hits can report the time they saved.
+    """
+    def __init__(self, path=None, max_entries=256, max_disk_entries=10000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, cost, created)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, cost REAL, created REAL, used REAL)"
+            )
+            self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+            self.db.commit()
+    
+    @staticmethod
+    def normalize(text):
+        # "Look around." and "look  around" are the same action
+        return re.sub(r"\s+", " ", text.lower()).strip().strip(".!?")
+    
+    @classmethod
+    def make_key(cls, kind, action, scene, **params):
+        fingerprint = hashlib.sha256(scene.encode("utf-8")).hexdigest()
+        raw = json.dumps([kind, cls.normalize(action), fingerprint, sorted(params.items())])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[2] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                self.saved_seconds += entry[1]
+                return entry[0]
+            self.entries.pop(key, None)
+            
+            if self.db is not None:
+                row = self.db.execute("SELECT value, cost, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[2] <= self.ttl:
+                    self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    self._remember(key, row)
+                    self.disk_hits += 1
+                    self.saved_seconds += row[1]
+                    return row[0]
+            self.misses += 1
+            return None
+    
+    def put(self, key, value, cost):
+        """Store a value that took cost seconds to generate."""
+        now = time.time()
+        with self.lock:
+            self._remember(key, (value, cost, now))
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, value, cost, now, now))
+                self.db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                )
+                self.db.commit()
+    
+    def _remember(self, key, entry):
+        self.entries[key] = tuple(entry)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
+
+# Default location of the on-disk reply cache
+DEFAULT_RESPONSE_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "llm-dnd-roleplay", "responses.sqlite")
+
+class CampaignLog:
+    """Append-only save file for a campaign: its history entries and the state of the current turn.
+    
+    Each line is a small JSON record: {"a": entry} appends a history entry, {"r": entry} replaces
+    the last one (a reroll) and {"m": {...}} sets the turn metadata (outcome table, roll, suggestions,
+    running summary). A save only writes what changed since the previous one, so a turn costs a line
+    or two however long the campaign has run; the file is rewritten with one record per entry once
+    superseded records outnumber the live ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.saved = 0          # history entries in the file
+        self.last_entry = None  # the last of them, to spot a reroll
+        self.meta = None        # metadata in the file, serialized for comparison
+        self.records = 0
+        self.damaged = False
+    
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+    
+    def load(self):
+        """Replay the file and return (history, meta); both are empty if it doesn't exist yet."""
+        history, meta = [], {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash; everything before it is intact
+                        self.damaged = True
+                        break
+                    if "a" in record:
+                        history.append(record["a"])
+                    elif "r" in record and history:
+                        history[-1] = record["r"]
+                    elif "m" in record:
+                        meta = record["m"]
+                    self.records += 1
+        self.saved = len(history)
+        self.last_entry = history[-1] if history else None
+        self.meta = json.dumps(meta, sort_keys=True)
+        return history, meta
+    
+    def save(self, history, meta):
+        """Append whatever changed; the history only grows at the end or has its last entry replaced."""
+        if len(history) < self.saved or self.damaged:
+            self.compact(history, meta)
+            return
+        records = []
+        if self.saved and history[self.saved - 1] != self.last_entry:
+            records.append({"r": history[self.saved - 1]})
+        records.extend({"a": entry} for entry in history[self.saved:])
+        serialized = json.dumps(meta, sort_keys=True)
+        if serialized != self.meta:
+            records.append({"m": meta})
+        if not records:
+            return
+        if self.records + len(records) > 2 * (len(history) + 1) + 64:
+            self.compact(history, meta)
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(self.encode(record) for record in records))
+        self.records += len(records)
+        self.saved = len(history)
+        self.last_entry = history[-1] if history else None
+        self.meta = serialized
+    
+    def compact(self, history, meta):
+        """Rewrite the file as one record per entry plus the metadata, swapped in whole."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("".join(self.encode({"a": entry}) for entry in history))
+            f.write(self.encode({"m": meta}))
+        os.replace(self.path + ".tmp", self.path)
+        self.records = len(history) + 1
+        self.saved = len(history)
+        self.last_entry = history[-1] if history else None
+        self.meta = json.dumps(meta, sort_keys=True)
+        self.damaged = False
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far in MB, or None where it can't be measured."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    # Windows tracks the peak working set; elsewhere psutil only has the current RSS
+    return getattr(memory, "peak_wset", memory.rss) / 2**20
+
+class Span:
+    """A timed stage of a turn; use as a context manager, adding attributes with set()."""
+    __slots__ = ("tracer", "name", "attrs", "start")
+    
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, time.perf_counter(), **self.attrs)
+        return False
+
+class NoSpan:
+    """Handed out while tracing is off, so instrumented code costs one attribute check."""
+    __slots__ = ()
+    
+    def set(self, **attrs):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NO_SPAN = NoSpan()
+
+class Tracer:
+    """Timing spans for the stages of each turn, switchable on and off at runtime.
+    
+    Finished spans are buffered in memory; flush() appends them to a JSONL trace file and
+    rewrites a Prometheus textfile with the count, total and worst time of each stage.
+    """
+    def __init__(self, trace_path=None, metrics_path=None, enabled=False):
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.origin = time.perf_counter()
+        self.turn = 0
+        self.pending = []
+        self.totals = {}  # span name -> [count, total seconds, max seconds]
+        self.lock = threading.Lock()
+    
+    def span(self, name, **attrs):
+        return Span(self, name, attrs) if self.enabled else NO_SPAN
+    
+    def traced(self, name):
+        """Decorator timing every call of a function as a span."""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def call(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with Span(self, name, {}):
+                    return fn(*args, **kwargs)
+            return call
+        return decorate
+    
+    def record(self, name, start, end, **attrs):
+        """Record a stage that ran from start to end (perf_counter seconds)."""
+        duration = end - start
+        with self.lock:
+            self.pending.append({
+                "turn": self.turn,
+                "name": name,
+                "start_ms": (start - self.origin) * 1000,
+                "duration_ms": duration * 1000,
+                "thread": threading.current_thread().name,
+                **attrs
+            })
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+    
+    def next_turn(self):
+        self.turn += 1
+    
+    def flush(self):
+        """Write buffered spans and the per-stage summary to the configured files."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            totals = {name: list(values) for name, values in self.totals.items()}
+        if self.trace_path and pending:
+            with open(self.trace_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(span) + "\n" for span in pending)
+        if self.metrics_path and totals:
+            lines = [
+                "# HELP dungeon_stage_seconds Time spent in each stage of a turn.",
+                "# TYPE dungeon_stage_seconds summary",
+            ]
+            for name, (count, total, _) in sorted(totals.items()):
+                lines.append(f'dungeon_stage_seconds_count{{stage="{name}"}} {count}')
+                lines.append(f'dungeon_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+            lines += [
+                "# HELP dungeon_stage_seconds_max Slowest single run of each stage.",
+                "# TYPE dungeon_stage_seconds_max gauge",
+            ]
+            lines += [f'dungeon_stage_seconds_max{{stage="{name}"}} {worst:.6f}' for name, (_, _, worst) in sorted(totals.items())]
+            # Written whole and renamed so the node exporter never reads a partial file
+            temp_path = self.metrics_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(temp_path, self.metrics_path)
+    
+    def close(self):
+        """Stop recording and write out what is still buffered, such as spans of background jobs after the last turn."""
+        self.enabled = False
+        self.flush()
+
+# Shared by the model backend and the apps; off until enabled with --trace or the checkbox
+TRACER = Tracer()
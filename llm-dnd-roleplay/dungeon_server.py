@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from urllib.parse import urlsplit
+
+from dungeon_common import DnDResponseSchema, SuggestionsSchema, OUTCOME_SYSTEM_PROMPT, SUGGESTION_SYSTEM_PROMPT
+from qwen_backend import QwenModel, ContinuousBatcher
+
+class GameSession:
+    """Turn state for one player, the headless counterpart of DnDGameInterface."""
+    def __init__(self, session_id, context):
+        self.session_id = session_id
+        self.context = context
+        self.game_history = []
+        self.current_outcomes = {}
+        self.current_roll = None
+        self.last_action = ""
+        self.suggestions = {}
+        # One turn at a time per session; different sessions run concurrently
+        self.lock = asyncio.Lock()
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "history": self.game_history,
+            "summary": self.context.summary,
+            "roll": self.current_roll,
+            "suggestions": self.suggestions,
+        }
+
+def parse_table(response_text, keys, fallback):
+    """Pull the JSON object out of a reply, filling any missing key from fallback."""
+    start_idx = response_text.find('{')
+    end_idx = response_text.rfind('}') + 1
+    table = {}
+    if start_idx != -1 and end_idx > start_idx:
+        try:
+            table = json.loads(response_text[start_idx:end_idx])
+        except json.JSONDecodeError:
+            pass
+    return {key: str(table.get(key, fallback(key))) for key in keys}
+
+class DungeonServer:
+    """Serves the send/reroll/suggest turn logic over HTTP for many sessions on one model."""
+    def __init__(self, batcher, context_tokens=1024, retrieval_k=4):
+        self.batcher = batcher
+        self.context_tokens = context_tokens
+        self.retrieval_k = retrieval_k
+        self.sessions = {}
+        self.tasks = set()  # background summaries, held so they aren't garbage collected mid-run
+
+    async def generate(self, messages, temperature, json_keys):
+        return await asyncio.wrap_future(self.batcher.submit(messages, temperature=temperature, json_keys=json_keys))
+
+    async def send(self, session, action):
+        async with session.lock:
+            # A failed or cancelled request leaves the session as it was, rather than with a half-played turn
+            previous = (len(session.game_history), session.last_action, session.current_outcomes, session.current_roll)
+            try:
+                session.last_action = action
+                session.game_history.append(f"Player: {action}")
+
+                # Get 6 possible outcomes from the model, with earlier events relevant to the action
+                context = session.context.build(session.game_history, query=action, max_tokens=session.context.max_tokens // 2)
+                response_text, stats = await self.generate(
+                    [
+                        {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+                        {"role": "user", "content": f"Story context: {context}\n\nMy action: {action}"}
+                    ],
+                    0.8,
+                    DnDResponseSchema.keys
+                )
+                session.current_outcomes = parse_table(response_text, DnDResponseSchema.keys, lambda key: f"Error parsing outcome {key}")
+
+                # Roll die and get outcome
+                session.current_roll = random.randint(1, 6)
+                outcome = session.current_outcomes[str(session.current_roll)]
+                session.game_history.append(f"DM [Rolled {session.current_roll}]: {outcome}")
+
+                # Get suggestions for next actions
+                context = session.context.build(session.game_history, query="\n".join(session.game_history[-2:]))
+                suggestion_text, _ = await self.generate(
+                    [
+                        {"role": "system", "content": SUGGESTION_SYSTEM_PROMPT.strip()},
+                        {"role": "user", "content": f"Game context: {context}\n\nSuggest three possible actions for the player:"}
+                    ],
+                    0.9,
+                    SuggestionsSchema.keys
+                )
+                session.suggestions = parse_table(suggestion_text, SuggestionsSchema.keys, lambda key: f"Suggested action {key}")
+                # Compress older turns without holding up the reply
+                task = asyncio.get_running_loop().create_task(self.update_summary(session))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+                return {
+                    "roll": session.current_roll,
+                    "outcome": outcome,
+                    "outcomes": session.current_outcomes,
+                    "suggestions": session.suggestions,
+                    "stats": stats,
+                }
+            except BaseException:
+                del session.game_history[previous[0]:]
+                session.last_action, session.current_outcomes, session.current_roll = previous[1:]
+                raise
+
+    async def update_summary(self, session):
+        """Fold older entries into the session's running summary once they outgrow the context budget."""
+        pending = session.context.pending_summary(list(session.game_history))
+        if pending is None:
+            return
+        previous, entries, end = pending
+        try:
+            summary, _ = await asyncio.wrap_future(self.batcher.submit(
+                session.context.summary_messages(previous, entries),
+                temperature=0.3,
+                max_new_tokens=session.context.summary_tokens
+            ))
+        except Exception:
+            session.context.cancel_summary()
+            return
+        session.context.apply_summary(summary, end)
+
+    async def reroll(self, session):
+        async with session.lock:
+            if not session.current_outcomes:
+                raise ValueError("Nothing to reroll yet")
+            old_roll = session.current_roll
+            while session.current_roll == old_roll:
+                session.current_roll = random.randint(1, 6)
+            outcome = session.current_outcomes[str(session.current_roll)]
+            session.game_history[-1] = f"DM [Rolled {session.current_roll}]: {outcome}"
+            return {"roll": session.current_roll, "outcome": outcome}
+
+    async def route(self, method, path, body):
+        """Return (status, payload) for a request."""
+        parts = [part for part in urlsplit(path).path.split("/") if part]
+        if parts == ["stats"] and method == "GET":
+            return 200, self.batcher.stats()
+        if parts == ["sessions"] and method == "POST":
+            session = GameSession(uuid.uuid4().hex, self.batcher.model.new_context_window(
+                max_tokens=self.context_tokens, retrieval_k=self.retrieval_k
+            ))
+            self.sessions[session.session_id] = session
+            return 201, session.to_dict()
+        if len(parts) < 2 or parts[0] != "sessions":
+            return 404, {"error": f"Unknown path {path}"}
+
+        session = self.sessions.get(parts[1])
+        if session is None:
+            return 404, {"error": f"Unknown session {parts[1]}"}
+        command = parts[2] if len(parts) > 2 else None
+        if command is None and method == "GET":
+            return 200, session.to_dict()
+        if command is None and method == "DELETE":
+            del self.sessions[session.session_id]
+            return 200, {"deleted": session.session_id}
+        if command == "send" and method == "POST":
+            action = str(body.get("action", "")).strip()
+            if not action:
+                return 400, {"error": "Missing action"}
+            return 200, await self.send(session, action)
+        if command == "reroll" and method == "POST":
+            try:
+                return 200, await self.reroll(session)
+            except ValueError as e:
+                return 409, {"error": str(e)}
+        if command == "suggestions" and method == "GET":
+            return 200, session.suggestions
+        return 405, {"error": f"{method} not allowed on {path}"}
+
+    async def handle(self, reader, writer):
+        """Minimal HTTP/1.1 handling with keep-alive and JSON bodies."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+
+                try:
+                    body = json.loads(raw) if raw else {}
+                    status, payload = await self.route(method.upper(), path, body)
+                except json.JSONDecodeError as e:
+                    status, payload = 400, {"error": f"Invalid JSON: {e}"}
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+
+                data = json.dumps(payload).encode()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host, port, max_batch, context_tokens, retrieval_k, load_mode):
+    print("Loading Qwen/Qwen3-1.7B model...")
+    model = await asyncio.to_thread(QwenModel, load_mode=load_mode)
+    peak_mb = model.load_stats["peak_rss_mb"]
+    print(f"Loaded in {model.load_stats['load_time']:.1f}s" + (f", peak RSS {peak_mb:.0f} MB" if peak_mb is not None else ""))
+    server = DungeonServer(ContinuousBatcher(model, max_batch=max_batch), context_tokens=context_tokens, retrieval_k=retrieval_k)
+    listener = await asyncio.start_server(server.handle, host, port)
+    print(f"Dungeon server listening on http://{host}:{port}")
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless multi-session AI dungeon server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=16, help="most sequences decoded together per step")
+    parser.add_argument("--context-tokens", type=int, default=1024, help="token budget for each session's game context")
+    parser.add_argument("--retrieval-k", type=int, default=4, help="earlier entries recalled by relevance per prompt (0 to disable)")
+    parser.add_argument("--load-mode", choices=QwenModel.LOAD_MODES, default="fp32", help="weight precision: fp32, bf16, or int8 linear layers (CPU)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_batch, args.context_tokens, args.retrieval_k, args.load_mode))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Client, prompts and token helpers for an OpenAI-compatible server such as LM Studio.
+
+Kept apart from the Tk game so headless tools (bulk_generate, the replay benchmark) can use them
+without importing tkinter.
+"""
+import asyncio
+import concurrent.futures
+import json
+import random
+import re
+import threading
+import time
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+# The outcome prompt is shared; only the suggestion prompt is worded for LM Studio's models
+from dungeon_common import OUTCOME_SYSTEM_PROMPT, GenerationCancelled, TRACER
+
+# System prompt for the suggested next actions
+SUGGESTION_SYSTEM_PROMPT = """
+You are a fantasy roleplaying assistant.
+Maintain the world's internal logic and consistency Based on the provided game context, suggest 3 different possible actions the player might want to take next.
+
+Respond ONLY in JSON format, using the following schema:
+{
+  "1": "A possible action described in 5-10 words",
+  "2": "A possible action described in 5-10 words",
+  "3": "A possible action described in 5-10 words"
+}
+
+Here's an example for a context where the player just entered a tavern:
+{
+  "1": "Order a drink from the bartender",
+  "2": "Ask locals about recent rumors",
+  "3": "Look for suspicious characters"
+}
+
+And another example for combat context:
+{
+  "1": "Attack with your sword",
+  "2": "Take cover behind the boulder",
+  "3": "Try to negotiate with the enemy"
+}
+
+Make the suggestions creative, varied, and appropriate to the current situation.
+"""
+
+class AsyncLMStudioClient:
+    """Pooled, retrying async client for an OpenAI-compatible server such as LM Studio.
+    
+    Requests run on a private event loop thread so the Tk and worker threads can call complete()
+    directly. Connections are kept alive in a bounded pool, every request has its own timeout,
+    transient failures are retried with exponential backoff, and a semaphore caps how many
+    requests are in flight at once.
+    """
+    RETRYABLE = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+    CANCEL_POLL = 0.05  # seconds between checks of a request's cancel event
+    
+    def __init__(self, base_url="http://localhost:1234/v1", api_key="lm-studio", timeout=120.0, connect_timeout=5.0,
+                 max_retries=3, backoff=0.5, max_concurrency=4):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self.failures = 0
+        
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            max_retries=0,  # retried here so streamed requests are only retried before their first token
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+                timeout=httpx.Timeout(timeout, connect=connect_timeout)
+            )
+        )
+    
+    def complete(self, messages, temperature, on_token=None, cancel_event=None, max_tokens=None):
+        """Blocking wrapper around the async request, safe to call from any thread but the loop's own."""
+        future = asyncio.run_coroutine_threadsafe(
+            self._complete(messages, temperature, on_token, cancel_event, max_tokens), self.loop
+        )
+        if cancel_event is None:
+            return future.result()
+        # Checked while waiting rather than between chunks, so a server slow to its first token (or
+        # a retry's backoff) doesn't hold the worker; cancelling the future cancels the request's task
+        while True:
+            try:
+                return future.result(timeout=self.CANCEL_POLL)
+            except concurrent.futures.TimeoutError:
+                if cancel_event.is_set():
+                    future.cancel()
+                    raise GenerationCancelled()
+    
+    async def _complete(self, messages, temperature, on_token, cancel_event, max_tokens):
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                emitted = []
+                try:
+                    return await self._request(messages, temperature, on_token, cancel_event, max_tokens, emitted)
+                except self.RETRYABLE:
+                    # Tokens already shown can't be taken back, so only retry before the first one
+                    if attempt == self.max_retries or emitted:
+                        self.failures += 1
+                        raise
+                self.retries += 1
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+                if cancel_event is not None and cancel_event.is_set():
+                    raise GenerationCancelled()
+    
+    async def _request(self, messages, temperature, on_token, cancel_event, max_tokens, emitted):
+        start = time.perf_counter()
+        first_token = None
+        new_tokens = 0
+        extra = {"max_tokens": max_tokens} if max_tokens is not None else {}
+        
+        if on_token is None and cancel_event is None:
+            completion = await self.client.chat.completions.create(
+                model="model-identifier",  # Replace with your actual model name
+                messages=messages,
+                temperature=temperature,
+                **extra
+            )
+            response_text = completion.choices[0].message.content
+            if completion.usage is not None:
+                new_tokens = completion.usage.completion_tokens
+        else:
+            stream = await self.client.chat.completions.create(
+                model="model-identifier",  # Replace with your actual model name
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                **extra
+            )
+            try:
+                async for chunk in stream:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise GenerationCancelled()
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if not text:
+                        continue
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    # LM Studio sends one token per chunk
+                    new_tokens += 1
+                    emitted.append(text)
+                    if on_token is not None:
+                        on_token(text)
+            finally:
+                await stream.close()
+            response_text = "".join(emitted)
+        
+        end = time.perf_counter()
+        decode_start = first_token or start
+        stats = {
+            "ttft": (first_token or end) - start,
+            "tokens_per_sec": new_tokens / (end - decode_start) if end > decode_start else 0.0,
+            "new_tokens": new_tokens,
+            "total_time": end - start,
+        }
+        if TRACER.enabled:
+            TRACER.record("http_request", start, end, tokens=new_tokens, streamed=on_token is not None or cancel_event is not None, ttft_ms=stats["ttft"] * 1000)
+        return response_text.strip(), stats
+
+# LM Studio doesn't expose its tokenizer, so budgets use the usual ~4 characters per token
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def truncate_tokens(text, max_tokens):
+    """Keep roughly the last max_tokens tokens of text, starting on a word boundary."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    tail = text[-max_tokens * 4:]
+    return tail.split(" ", 1)[-1]
+
+def find_completed_value(text, key):
+    """Return the string value for key in partially streamed JSON once it has been closed, else None."""
+    match = re.search(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % re.escape(key), text)
+    if match is None:
+        return None
+    try:
+        return json.loads(f'"{match.group(1)}"')
+    except json.JSONDecodeError:
+        return match.group(1)
\ No newline at end of file
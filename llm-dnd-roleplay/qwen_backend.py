@@ -0,0 +1,1168 @@
+import copy
+import hashlib
+import importlib.util
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+import torch
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, DynamicCache, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList,
+    LogitsProcessor, LogitsProcessorList, TopKLogitsWarper, TopPLogitsWarper
+)
+from dungeon_common import ContextWindow, GenerationCancelled, KV_CACHE_MODES, LOAD_MODES, TRACER, VectorMemory, peak_rss_mb
+
+# Left-pad a (batch, heads, length, dim) KV tensor along its length
+def pad_left(tensor, n):
+    return torch.nn.functional.pad(tensor, (0, 0, n, 0))
+
+# Approximate memory held by a transformers KV cache object
+def cache_nbytes(cache):
+    tensors = []
+    if hasattr(cache, "layers"):
+        for layer in cache.layers:
+            tensors.append(getattr(layer, "keys", None))
+            tensors.append(getattr(layer, "values", None))
+    else:
+        tensors.extend(getattr(cache, "key_cache", []))
+        tensors.extend(getattr(cache, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+class PromptPrefixCache:
+    """LRU store of prefilled past-key-values for static system prompts, keyed by prompt hash."""
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (input_ids, past_key_values, nbytes)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(prefix_text):
+        return hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key, input_ids, past_key_values):
+        nbytes = cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            # A single prompt larger than the cap is never worth keeping
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[2]
+        self.entries[key] = (input_ids, past_key_values, nbytes)
+        self.total_bytes += nbytes
+        
+        # Evict least recently used prompts until we are back under the cap
+        while self.total_bytes > self.max_bytes:
+            _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+class CancelCriteria(StoppingCriteria):
+    """Stops generate() as soon as the owning job's cancel event is set."""
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel_event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class FirstStepCriteria(StoppingCriteria):
+    """Never stops; notes when the first decode step finished, which is where prefill ends."""
+    def __init__(self):
+        self.time = None
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.time is None:
+            self.time = time.perf_counter()
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    """Stops each row as soon as the top-level JSON object in its reply has closed.
+    
+    Brace depth is tracked incrementally from each new token, ignoring braces inside strings and
+    anything between <think> and </think>, so the per-step cost is one single-token decode.
+    """
+    def __init__(self, tokenizer, prompt_length, batch_size):
+        self.tokenizer = tokenizer
+        self.position = prompt_length
+        self.think_start = tokenizer.convert_tokens_to_ids("<think>")
+        self.think_end = tokenizer.convert_tokens_to_ids("</think>")
+        self.depth = [0] * batch_size
+        self.in_string = [False] * batch_size
+        self.escaped = [False] * batch_size
+        self.thinking = [False] * batch_size
+        self.done = [False] * batch_size
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        for row in range(input_ids.shape[0]):
+            for token_id in input_ids[row, self.position:].tolist():
+                if self.done[row]:
+                    break
+                self._feed(row, token_id)
+        self.position = input_ids.shape[-1]
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+    
+    def _feed(self, row, token_id):
+        if token_id == self.think_start:
+            self.thinking[row] = True
+            return
+        if token_id == self.think_end:
+            self.thinking[row] = False
+            return
+        if self.thinking[row]:
+            return
+        for char in self.tokenizer.decode([token_id]):
+            if self.in_string[row]:
+                if self.escaped[row]:
+                    self.escaped[row] = False
+                elif char == "\\":
+                    self.escaped[row] = True
+                elif char == '"':
+                    self.in_string[row] = False
+            elif char == '"' and self.depth[row] > 0:
+                self.in_string[row] = True
+            elif char == "{":
+                self.depth[row] += 1
+            elif char == "}" and self.depth[row] > 0:
+                self.depth[row] -= 1
+                if self.depth[row] == 0:
+                    self.done[row] = True
+                    return
+
+class JsonShapeGrammar:
+    """Token-level automaton for a flat JSON object with fixed keys and free-text string values.
+    
+    The output is forced into the layout used by the prompt examples:
+    {
+      "1": "...",
+      ...
+    }
+    Structural text between values is matched against a trie of the vocabulary tokens that can
+    appear in it, and the allowed token set for every position is memoized, so each decode step
+    costs a dict lookup plus one mask.
+    """
+    def __init__(self, keys, token_strings, special_ids, max_value_tokens=160):
+        self.max_value_tokens = max_value_tokens
+        
+        # Segments alternate literal text and string content, ending on the closing brace
+        self.literals = [f'{{\n  "{keys[0]}": "']
+        self.literals += [f'",\n  "{key}": "' for key in keys[1:]]
+        self.literals.append('"\n}')
+        
+        # Trie over the few tokens made only of characters that occur in the literals
+        literal_chars = set("".join(self.literals))
+        self.trie = {}
+        content_ids = []
+        for token_id, text in enumerate(token_strings):
+            if not text or token_id in special_ids:
+                continue
+            if set(text) <= literal_chars:
+                node = self.trie
+                for char in text:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(token_id)
+            if not any(char in '"\\' or char < " " or char == "\ufffd" for char in text):
+                content_ids.append(token_id)
+        self.content_ids = torch.tensor(content_ids, dtype=torch.long)
+        self.prefix_ids = {}
+        self.content_masks = {}
+    
+    def literal_prefix_ids(self, literal_index, pos):
+        """Tokens that are a non-empty prefix of the rest of a literal."""
+        key = (literal_index, pos)
+        if key not in self.prefix_ids:
+            ids = []
+            node = self.trie
+            for char in self.literals[literal_index][pos:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                ids.extend(node.get(None, []))
+            self.prefix_ids[key] = torch.tensor(ids, dtype=torch.long)
+        return self.prefix_ids[key]
+    
+    def new_state(self):
+        return {"literal": 0, "pos": 0, "in_value": False, "value_tokens": 0}
+    
+    def allowed(self, state):
+        """Return (token ids, include content tokens) allowed next, or None once the object is closed."""
+        if state["literal"] >= len(self.literals):
+            return None
+        if not state["in_value"]:
+            return self.literal_prefix_ids(state["literal"], state["pos"]), False
+        closing = self.literal_prefix_ids(state["literal"], 0)
+        if state["value_tokens"] == 0:
+            return torch.tensor([], dtype=torch.long), True
+        if state["value_tokens"] >= self.max_value_tokens:
+            return closing, False
+        return closing, True
+    
+    def advance(self, state, text):
+        wrote_content = False
+        for char in text:
+            if state["literal"] >= len(self.literals):
+                return
+            if state["in_value"]:
+                if char != '"':
+                    wrote_content = True
+                    continue
+                state["in_value"] = False
+                state["pos"] = 0
+            state["pos"] += 1
+            if state["pos"] == len(self.literals[state["literal"]]):
+                state["literal"] += 1
+                state["pos"] = 0
+                state["in_value"] = state["literal"] < len(self.literals)
+                state["value_tokens"] = 0
+                wrote_content = False
+        if state["in_value"] and wrote_content:
+            state["value_tokens"] += 1
+    
+    def mask(self, state, vocab_size, device):
+        """Boolean mask over the vocabulary of tokens allowed next, or None once the object is closed."""
+        allowed = self.allowed(state)
+        if allowed is None:
+            return None
+        ids, include_content = allowed
+        if include_content:
+            key = (vocab_size, device)
+            if key not in self.content_masks:
+                content = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+                content[self.content_ids.to(device)] = True
+                self.content_masks[key] = content
+            mask = self.content_masks[key].clone()
+        else:
+            mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        mask[ids.to(device)] = True
+        return mask
+
+class SchemaLogitsProcessor(LogitsProcessor):
+    """Masks logits so each row can only produce the JSON shape of its schema.
+    
+    start_texts gives text per row that is already part of the prompt (e.g. a forced opening).
+    """
+    def __init__(self, grammars, token_strings, prompt_length, start_texts=None):
+        self.grammars = grammars
+        self.token_strings = token_strings
+        self.states = [grammar.new_state() if grammar is not None else None for grammar in grammars]
+        for grammar, state, text in zip(grammars, self.states, start_texts or []):
+            if grammar is not None:
+                grammar.advance(state, text)
+        self.position = prompt_length
+    
+    def __call__(self, input_ids, scores):
+        for row, grammar in enumerate(self.grammars):
+            if grammar is None:
+                continue
+            state = self.states[row]
+            for token_id in input_ids[row, self.position:].tolist():
+                grammar.advance(state, self.token_strings[token_id] if token_id < len(self.token_strings) else "")
+            
+            mask = grammar.mask(state, scores.shape[-1], scores.device)
+            if mask is None:
+                continue
+            scores[row] = scores[row].masked_fill(~mask, float("-inf"))
+        self.position = input_ids.shape[-1]
+        return scores
+
+class ClosingQuoteCriteria(StoppingCriteria):
+    """Stops each row once it closes the JSON string value it was seeded inside."""
+    def __init__(self, token_strings, prompt_length, batch_size):
+        self.token_strings = token_strings
+        self.position = prompt_length
+        self.escaped = [False] * batch_size
+        self.done = [False] * batch_size
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        for row in range(input_ids.shape[0]):
+            for token_id in input_ids[row, self.position:].tolist():
+                if self.done[row] or token_id >= len(self.token_strings):
+                    break
+                for char in self.token_strings[token_id]:
+                    if self.escaped[row]:
+                        self.escaped[row] = False
+                    elif char == "\\":
+                        self.escaped[row] = True
+                    elif char == '"':
+                        self.done[row] = True
+                        break
+        self.position = input_ids.shape[-1]
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+class RowStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that follows one row of a (possibly batched) generate() call."""
+    def __init__(self, tokenizer, row=0, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.row = row
+    
+    def put(self, value):
+        # The prompt arrives as (batch, seq); each decode step as (batch,)
+        if value.dim() > 1:
+            value = value[self.row]
+        else:
+            value = value[self.row:self.row + 1]
+        super().put(value)
+
+class RowTemperatureLogitsWarper(LogitsProcessor):
+    """Applies a separate sampling temperature to each row of a batch."""
+    def __init__(self, temperatures):
+        self.temperatures = temperatures.unsqueeze(-1)
+    
+    def __call__(self, input_ids, scores):
+        return scores / self.temperatures
+
+class SessionKVCache:
+    """Conversation KV state for one game session, extended entry by entry across turns."""
+    def __init__(self, max_tokens=16384):
+        self.max_tokens = max_tokens
+        self.header = None          # system block + user header the cache was seeded with
+        self.header_length = 0
+        self.offset = 0             # index of the first history entry held in the cache
+        self.entries = []           # history entries already prefilled
+        self.entry_lengths = []     # token count of each prefilled entry
+        self.input_ids = None
+        self.past_key_values = None
+        self.last_prefill_tokens = 0
+        # Held by the worker while it syncs or generates; the Tk thread only truncates when it's free
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.header = None
+        self.header_length = 0
+        self.offset = 0
+        self.entries = []
+        self.entry_lengths = []
+        self.input_ids = None
+        self.past_key_values = None
+
+    def committed_length(self):
+        return self.header_length + sum(self.entry_lengths)
+
+    def truncate(self, n_entries):
+        """Drop cached state for history entries from index n_entries onwards (e.g. a rerolled entry).
+        
+        If a generation currently holds the cache this is skipped; the next sync notices the
+        rewritten entry by comparing texts and truncates then.
+        """
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self._truncate(n_entries)
+        finally:
+            self.lock.release()
+
+    def _truncate(self, n_entries):
+        keep_entries = n_entries - self.offset
+        if self.past_key_values is None or keep_entries >= len(self.entries):
+            return
+        if keep_entries < 0:
+            self.reset()
+            return
+        del self.entries[keep_entries:]
+        del self.entry_lengths[keep_entries:]
+        keep = self.committed_length()
+        self.past_key_values.crop(keep)
+        self.input_ids = self.input_ids[:, :keep]
+
+# Set up the Hugging Face model and tokenizer
+class QwenModel:
+    LOAD_MODES = LOAD_MODES
+    KV_CACHE_MODES = KV_CACHE_MODES
+    
+    def __init__(self, prefix_cache_bytes=512 * 1024 * 1024, enable_thinking=False, constrain_json=True, load_mode="fp32",
+                 kv_cache="dynamic", kv_max_bytes=None, on_stage=None):
+        """Load the tokenizer and weights; on_stage, if given, is called with "tokenizer" and "weights" as each begins."""
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"Using device: {self.device}")
+        self.model_name = "Qwen/Qwen3-1.7B"
+        if load_mode not in self.LOAD_MODES:
+            raise ValueError(f"Unknown load mode {load_mode!r}, expected one of {self.LOAD_MODES}")
+        if self.device == "cuda" and load_mode == "int8":
+            raise ValueError("int8 dynamic quantization only runs on CPU")
+        self.load_mode = load_mode
+        
+        # Load tokenizer and model
+        start = time.perf_counter()
+        if on_stage is not None:
+            on_stage("tokenizer")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        if self.device == "cuda":
+            dtype = torch.bfloat16 if load_mode == "bf16" else torch.float16
+        else:
+            dtype = torch.bfloat16 if load_mode == "bf16" else torch.float32
+        if on_stage is not None:
+            on_stage("weights")
+        # Weights are mmapped from the safetensors file and materialized once, in the target dtype,
+        # instead of being built at random and then overwritten
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            use_safetensors=True
+        )
+        if self.device != "cpu":
+            self.model = self.model.to(self.device)
+        if load_mode == "int8":
+            # Linear weights become int8 with per-step dynamic activation scales; the rest stays float32
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.eval()
+        self.load_stats = {"load_mode": load_mode, "load_time": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+        # Batched generation needs prompts aligned on the right
+        self.tokenizer.padding_side = "left"
+        
+        # System prompts are static, so their prefill is computed once and reused
+        self.prefix_cache = PromptPrefixCache(max_bytes=prefix_cache_bytes)
+        self.last_stats = {}
+        
+        # Qwen3 thinks before answering unless the chat template is told not to
+        self.enable_thinking = enable_thinking
+        
+        # JSON replies are decoded under a grammar for their schema's keys
+        self.constrain_json = constrain_json
+        self.token_strings = None
+        self.grammars = {}
+        
+        # KV cache used by generate_response, and an optional ceiling on its size
+        self.check_kv_cache(kv_cache)
+        self.kv_cache = kv_cache
+        self.kv_max_bytes = kv_max_bytes
+        
+    def check_kv_cache(self, mode):
+        if mode not in self.KV_CACHE_MODES:
+            raise ValueError(f"Unknown KV cache mode {mode!r}, expected one of {self.KV_CACHE_MODES}")
+        if mode == "int8" and importlib.util.find_spec("hqq") is None:
+            raise ValueError("The int8 KV cache needs the hqq package (pip install hqq)")
+        if mode == "int4" and (importlib.util.find_spec("optimum") is None or importlib.util.find_spec("optimum.quanto") is None):
+            raise ValueError("The int4 KV cache needs optimum-quanto (pip install optimum-quanto)")
+        if mode == "offloaded" and self.device == "cpu":
+            raise ValueError("The offloaded KV cache moves layers from the GPU to CPU memory, so it needs CUDA")
+    
+    def kv_cache_kwargs(self, mode):
+        """generate() arguments that select a KV cache mode; the dynamic cache needs none."""
+        if mode == "int8":
+            return {"cache_implementation": "quantized", "cache_config": {"backend": "HQQ", "nbits": 8, "device": self.device}}
+        if mode == "int4":
+            return {"cache_implementation": "quantized", "cache_config": {"backend": "quanto", "nbits": 4}}
+        if mode == "offloaded":
+            return {"cache_implementation": "offloaded"}
+        return {}
+    
+    def kv_bytes_per_token(self, mode):
+        """Approximate KV cache bytes per token of context; quantized caches keep a short full-precision tail on top."""
+        config = self.model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        values = 2 * config.num_hidden_layers * config.num_key_value_heads * head_dim
+        bits = {"int8": 8, "int4": 4}.get(mode, torch.finfo(self.model.dtype).bits)
+        return values * bits // 8
+    
+    def fit_kv_ceiling(self, input_ids, keep_start, max_new_tokens, mode):
+        """Slide the prompt window so prompt and reply fit in kv_max_bytes of KV cache.
+        
+        The first keep_start tokens (system prompt and user header) are always kept and the oldest
+        tokens after them are dropped; the reply keeps at most half the budget. Returns the input
+        ids, the max_new_tokens to use and how many prompt tokens were dropped.
+        """
+        if self.kv_max_bytes is None:
+            return input_ids, max_new_tokens, 0
+        capacity = self.kv_max_bytes // self.kv_bytes_per_token(mode)
+        max_new_tokens = min(max_new_tokens, capacity // 2)
+        prompt_capacity = capacity - max_new_tokens
+        if keep_start >= prompt_capacity:
+            raise ValueError(f"A KV ceiling of {self.kv_max_bytes} bytes ({capacity} tokens) can't hold the system prompt")
+        dropped = max(0, input_ids.shape[-1] - prompt_capacity)
+        if dropped:
+            input_ids = torch.cat([input_ids[:, :keep_start], input_ids[:, keep_start + dropped:]], dim=-1)
+        return input_ids, max_new_tokens, dropped
+    
+    def format_messages(self, messages):
+        """Split a chat into the leading system block (cacheable) and the rest of the prompt."""
+        full = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True, enable_thinking=self.enable_thinking
+        )
+        system = []
+        for msg in messages:
+            if msg["role"] != "system":
+                break
+            system.append(msg)
+        
+        prefix = self.tokenizer.apply_chat_template(system, tokenize=False) if system else ""
+        if prefix and full.startswith(prefix):
+            return prefix, full[len(prefix):]
+        return "", full
+    
+    def generation_prompt(self):
+        """The assistant header the chat template appends, including an empty think block when thinking is off."""
+        probe = self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": ""}], tokenize=False, add_generation_prompt=True, enable_thinking=self.enable_thinking
+        )
+        return probe[probe.rindex("<|im_start|>assistant"):]
+    
+    def decode_reply(self, token_ids):
+        """Decode only the generated tokens, dropping any think block."""
+        with TRACER.span("detokenize", tokens=len(token_ids)):
+            text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        if "</think>" in text:
+            text = text.split("</think>", 1)[1]
+        return text.strip()
+    
+    def get_prefix_cache(self, prefix_text):
+        """Return (input_ids, past_key_values) for a system block, prefilling it on a miss."""
+        key = PromptPrefixCache.key_for(prefix_text)
+        cached = self.prefix_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        input_ids = self.tokenizer(prefix_text, return_tensors="pt").input_ids.to(self.device)
+        with TRACER.span("prefix_prefill", tokens=input_ids.shape[-1]), torch.no_grad():
+            past_key_values = self.model(
+                input_ids=input_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True
+            ).past_key_values
+        self.prefix_cache.put(key, input_ids, past_key_values)
+        return input_ids, past_key_values
+        
+    def warm_up(self, system_prompts, json_keys=()):
+        """Pay one-time costs before the first turn: kernel setup, system prompt prefills and JSON grammars."""
+        for system_prompt in system_prompts:
+            self.generate_response(
+                [{"role": "system", "content": system_prompt}, {"role": "user", "content": "Hello"}],
+                max_new_tokens=2
+            )
+        for keys in json_keys:
+            self.get_grammar(keys)
+    
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+    
+    def truncate_tokens(self, text, max_tokens):
+        """Keep the last max_tokens tokens of text, cutting on a token boundary."""
+        ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        return self.tokenizer.decode(ids[-max_tokens:]) if len(ids) > max_tokens else text
+    
+    def context_length(self):
+        return self.model.config.max_position_embeddings
+    
+    def new_context_window(self, max_tokens=1024, summary_tokens=200, retrieval_k=4):
+        # Leave room in the model's context for the system prompt and the reply
+        max_tokens = min(max_tokens, self.context_length() - 2048)
+        return ContextWindow(
+            self.count_tokens,
+            self.truncate_tokens,
+            max_tokens=max_tokens,
+            summary_tokens=summary_tokens,
+            memory=VectorMemory() if retrieval_k else None,
+            retrieval_k=retrieval_k
+        )
+    
+    def get_token_strings(self):
+        if self.token_strings is None:
+            self.token_strings = self.tokenizer.batch_decode([[i] for i in range(len(self.tokenizer))])
+        return self.token_strings
+    
+    def get_grammar(self, keys):
+        """Build (once per key set) the constrained-decoding grammar for a JSON object with these keys."""
+        keys = tuple(keys)
+        if keys not in self.grammars:
+            self.grammars[keys] = JsonShapeGrammar(keys, self.get_token_strings(), set(self.tokenizer.all_special_ids))
+        return self.grammars[keys]
+    
+    def _run_generate(self, on_token=None, cancel_event=None, stop_at_json=True, json_keys=None, json_start_texts=None, **generate_kwargs):
+        """Run model.generate, optionally streaming text to on_token, and record TTFT and tokens/sec.
+        
+        Setting cancel_event stops decoding at the next step and raises GenerationCancelled. With
+        stop_at_json each row stops as soon as its top-level JSON object closes. json_keys gives
+        the expected keys for every row (or None for a row) to decode under a schema grammar, and
+        json_start_texts any part of each row's object that is already in the prompt.
+        """
+        prompt_length = generate_kwargs["input_ids"].shape[-1]
+        if json_keys is not None and self.constrain_json:
+            grammars = [self.get_grammar(keys) if keys else None for keys in json_keys]
+            processors = generate_kwargs.pop("logits_processor", None) or LogitsProcessorList()
+            processors.append(SchemaLogitsProcessor(grammars, self.token_strings, prompt_length, json_start_texts))
+            generate_kwargs["logits_processor"] = processors
+        stopping_criteria = generate_kwargs.pop("stopping_criteria", None) or StoppingCriteriaList()
+        if cancel_event is not None:
+            if cancel_event.is_set():
+                raise GenerationCancelled()
+            stopping_criteria.append(CancelCriteria(cancel_event))
+        json_stop = None
+        if stop_at_json:
+            json_stop = JsonObjectStoppingCriteria(self.tokenizer, prompt_length, generate_kwargs["input_ids"].shape[0])
+            stopping_criteria.append(json_stop)
+        first_step = None
+        if TRACER.enabled:
+            first_step = FirstStepCriteria()
+            stopping_criteria.append(first_step)
+        if stopping_criteria:
+            generate_kwargs["stopping_criteria"] = stopping_criteria
+        start = time.perf_counter()
+        first_token = None
+        
+        if on_token is None:
+            with torch.no_grad():
+                outputs = self.model.generate(**generate_kwargs)
+        else:
+            streamer = RowStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            result = {}
+            
+            def generate_in_background():
+                try:
+                    with torch.no_grad():
+                        result["outputs"] = self.model.generate(streamer=streamer, **generate_kwargs)
+                except Exception as e:
+                    result["error"] = e
+                    streamer.end()
+            
+            thread = threading.Thread(target=generate_in_background, daemon=True)
+            thread.start()
+            for text in streamer:
+                if not text:
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter()
+                on_token(text)
+            thread.join()
+            if "error" in result:
+                raise result["error"]
+            outputs = result["outputs"]
+        
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled()
+        
+        end = time.perf_counter()
+        new_tokens = outputs.shape[-1] - prompt_length
+        decode_start = first_token or start
+        self.last_stats = {
+            "ttft": (first_token or end) - start,
+            "tokens_per_sec": new_tokens / (end - decode_start) if end > decode_start else 0.0,
+            "new_tokens": new_tokens,
+            "total_time": end - start,
+            "stopped_at_json": bool(json_stop and all(json_stop.done)),
+        }
+        if first_step is not None:
+            # generate() runs prefill and decode in one call; the first step's end splits them
+            rows = generate_kwargs["input_ids"].shape[0]
+            TRACER.record("prefill", start, first_step.time or end, tokens=prompt_length, rows=rows)
+            TRACER.record("decode", first_step.time or end, end, tokens=new_tokens, rows=rows, streamed=on_token is not None)
+        return outputs
+    
+    def new_session(self, max_tokens=16384):
+        return SessionKVCache(max_tokens=max_tokens)
+    
+    def save_session(self, session, path):
+        """Write a session's KV cache and the entries it covers to path; returns the bytes written, 0 if empty."""
+        with session.lock:
+            if session.past_key_values is None:
+                return 0
+            snapshot = {
+                "model": self.model_name,
+                "load_mode": self.load_mode,
+                "header": session.header,
+                "header_length": session.header_length,
+                "offset": session.offset,
+                "entries": session.entries,
+                "entry_lengths": session.entry_lengths,
+                "input_ids": session.input_ids.cpu(),
+                "layers": [(k.cpu(), v.cpu()) for k, v in session.past_key_values.to_legacy_cache()],
+            }
+            # Written whole and swapped in, so a crash never leaves half a snapshot
+            torch.save(snapshot, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return os.path.getsize(path)
+    
+    def load_session(self, session, path):
+        """Restore a snapshot written by save_session, so its entries aren't prefilled again.
+        
+        Returns the number of tokens restored, or 0 if there is no snapshot or it was made with
+        another model or load mode. The next sync checks the entries against the history as usual.
+        """
+        if not os.path.exists(path):
+            return 0
+        snapshot = torch.load(path, map_location=self.device, weights_only=True)
+        if snapshot["model"] != self.model_name or snapshot["load_mode"] != self.load_mode:
+            return 0
+        with session.lock:
+            session.reset()
+            session.header = snapshot["header"]
+            session.header_length = snapshot["header_length"]
+            session.offset = snapshot["offset"]
+            session.entries = list(snapshot["entries"])
+            session.entry_lengths = list(snapshot["entry_lengths"])
+            session.input_ids = snapshot["input_ids"].to(self.device)
+            session.past_key_values = DynamicCache.from_legacy_cache(tuple(snapshot["layers"]))
+            return session.input_ids.shape[-1]
+    
+    def _prefill(self, input_ids, past_key_values):
+        with TRACER.span("prefill", tokens=input_ids.shape[-1], rows=input_ids.shape[0]), torch.no_grad():
+            return self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True).past_key_values
+    
+    def _sync_session(self, session, system_prompt, header, entries):
+        """Bring the session cache in line with the history, prefilling only entries it hasn't seen."""
+        header_text = f"<|im_start|>system\n{system_prompt}<|im_end|>\n<|im_start|>user\n{header}"
+        if session.header != header_text:
+            session.reset()
+        
+        # Find where the cached entries stop matching the history (e.g. after a reroll)
+        window = entries[session.offset:]
+        common = 0
+        while common < min(len(window), len(session.entries)) and window[common] == session.entries[common]:
+            common += 1
+        session._truncate(session.offset + common)
+        
+        # Tokenize each new entry on its own so cached boundaries stay stable across turns
+        new_entries = window[len(session.entries):]
+        new_ids = [self.tokenizer(entry + "\n\n", add_special_tokens=False).input_ids for entry in new_entries]
+        
+        # Rebase onto the tail of the history when the session outgrows its token budget
+        if session.committed_length() + sum(len(ids) for ids in new_ids) > session.max_tokens:
+            pending = session.entries + new_entries
+            pending_ids = [self.tokenizer(entry + "\n\n", add_special_tokens=False).input_ids for entry in session.entries] + new_ids
+            budget = session.max_tokens // 2
+            keep = len(pending)
+            used = 0
+            while keep > 0 and used + len(pending_ids[keep - 1]) <= budget:
+                keep -= 1
+                used += len(pending_ids[keep])
+            offset = session.offset + keep
+            session.reset()
+            session.offset = offset
+            new_entries = pending[keep:]
+            new_ids = pending_ids[keep:]
+        
+        session.last_prefill_tokens = 0
+        if session.past_key_values is None:
+            # Seed from the shared system prompt cache, then prefill the user header
+            system_block = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
+            prefix_ids, prefix_kv = self.get_prefix_cache(system_block)
+            header_ids = self.tokenizer(header_text[len(system_block):], return_tensors="pt", add_special_tokens=False).input_ids.to(self.device)
+            session.past_key_values = self._prefill(header_ids, copy.deepcopy(prefix_kv))
+            session.input_ids = torch.cat([prefix_ids, header_ids], dim=-1)
+            session.header = header_text
+            session.header_length = session.input_ids.shape[-1]
+            session.last_prefill_tokens += header_ids.shape[-1]
+        
+        if new_ids:
+            delta = torch.tensor([[token for ids in new_ids for token in ids]], device=self.device)
+            session.past_key_values = self._prefill(delta, session.past_key_values)
+            session.input_ids = torch.cat([session.input_ids, delta], dim=-1)
+            session.entries.extend(new_entries)
+            session.entry_lengths.extend(len(ids) for ids in new_ids)
+            session.last_prefill_tokens += delta.shape[-1]
+    
+    def generate_session_response(self, session, system_prompt, header, entries, instruction, temperature=0.9, max_new_tokens=1024, on_token=None, cancel_event=None, json_keys=None):
+        """Generate a reply to a prompt built from the history, reusing the session's KV cache."""
+        with session.lock:
+            return self._generate_session_response(
+                session, system_prompt, header, entries, instruction, temperature, max_new_tokens, on_token, cancel_event, json_keys
+            )
+    
+    def _generate_session_response(self, session, system_prompt, header, entries, instruction, temperature, max_new_tokens, on_token, cancel_event, json_keys):
+        self._sync_session(session, system_prompt, header, entries)
+        committed = session.committed_length()
+        
+        suffix_ids = self.tokenizer(
+            f"{instruction}<|im_end|>\n{self.generation_prompt()}", return_tensors="pt", add_special_tokens=False
+        ).input_ids.to(self.device)
+        input_ids = torch.cat([session.input_ids, suffix_ids], dim=-1)
+        
+        try:
+            outputs = self._run_generate(
+                on_token=on_token,
+                cancel_event=cancel_event,
+                json_keys=[json_keys] if json_keys else None,
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=session.past_key_values,
+                do_sample=True,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.eos_token_id
+            )
+        finally:
+            # Drop the instruction and generated tokens so the cache only holds the history
+            session.past_key_values.crop(committed)
+        
+        return self.decode_reply(outputs[0][input_ids.shape[-1]:])
+    
+    def generate_batch(self, messages_list, temperatures, max_new_tokens=1024, on_token=None, cancel_event=None, json_keys=None):
+        """Generate replies to several chats in one batched generate() call.
+        
+        Each row is sampled at its own temperature and on_token streams the first row. Decoding a
+        batch of two costs about the same per step as one sequence on CPU, so the rows overlap.
+        """
+        prompts = ["".join(self.format_messages(messages)) for messages in messages_list]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        row_temperatures = torch.tensor(temperatures, dtype=torch.float32, device=self.device)
+        
+        outputs = self._run_generate(
+            on_token=on_token,
+            cancel_event=cancel_event,
+            json_keys=json_keys,
+            input_ids=inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            do_sample=True,
+            temperature=1.0,
+            logits_processor=LogitsProcessorList([RowTemperatureLogitsWarper(row_temperatures)]),
+            max_new_tokens=max_new_tokens,
+            pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id
+        )
+        
+        new_tokens = outputs[:, inputs.input_ids.shape[-1]:]
+        return [self.decode_reply(row) for row in new_tokens]
+    
+    def generate_parallel_values(self, messages, keys, temperature=0.8, max_new_tokens=160, on_token=None, cancel_event=None):
+        """Generate one JSON string value per key as parallel rows of a single generate() call.
+        
+        The chat prompt is prefilled once and its cache repeated for every row. Each row's reply is
+        seeded with the opening of its own key ({"k": "), so every value is conditioned on its key
+        and the rows decode side by side instead of one after another. on_token streams row 0.
+        """
+        prefix, prompt = self.format_messages(messages)
+        prompt_ids = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids.to(self.device)
+        if prefix:
+            prefix_ids, prefix_kv = self.get_prefix_cache(prefix)
+            shared_ids = torch.cat([prefix_ids, prompt_ids], dim=-1)
+            shared_kv = self._prefill(prompt_ids, copy.deepcopy(prefix_kv))
+        else:
+            shared_ids = prompt_ids
+            shared_kv = self._prefill(prompt_ids, DynamicCache())
+        
+        openers = [f'{{\n  "{key}": "' for key in keys]
+        opener_ids = [self.tokenizer(text, add_special_tokens=False).input_ids for text in openers]
+        if len({len(ids) for ids in opener_ids}) != 1:
+            raise ValueError("Parallel generation needs keys whose openings tokenize to the same length")
+        shared_kv.batch_repeat_interleave(len(keys))
+        input_ids = torch.cat(
+            [shared_ids.repeat(len(keys), 1), torch.tensor(opener_ids, dtype=torch.long, device=self.device)], dim=-1
+        )
+        
+        outputs = self._run_generate(
+            on_token=on_token,
+            cancel_event=cancel_event,
+            stop_at_json=False,
+            json_keys=[[key] for key in keys],
+            json_start_texts=openers,
+            stopping_criteria=StoppingCriteriaList([
+                ClosingQuoteCriteria(self.get_token_strings(), input_ids.shape[-1], len(keys))
+            ]),
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=shared_kv,
+            do_sample=True,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id
+        )
+        
+        values = {}
+        for key, row in zip(keys, outputs[:, input_ids.shape[-1]:]):
+            raw = re.split(r'(?<!\\)"', self.tokenizer.decode(row, skip_special_tokens=True), maxsplit=1)[0]
+            try:
+                values[key] = json.loads(f'"{raw}"').strip()
+            except json.JSONDecodeError:
+                values[key] = raw.strip()
+        return values
+    
+    def generate_response(self, messages, temperature=0.8, max_new_tokens=1024, on_token=None, cancel_event=None, json_keys=None, kv_cache=None):
+        """Generate a response using the Qwen model based on a list of messages.
+        
+        If on_token is given, decoded text is passed to it as soon as each token is generated.
+        If json_keys is given, the reply is constrained to a flat JSON object with exactly those keys.
+        kv_cache overrides the model's KV cache mode for this call.
+        """
+        kv_cache = kv_cache or self.kv_cache
+        self.check_kv_cache(kv_cache)
+        with TRACER.span("tokenize") as span:
+            prefix, prompt = self.format_messages(messages)
+            
+            # Tokenize input, reusing the prefilled system prompt so only the suffix is computed
+            suffix_ids = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids.to(self.device)
+            span.set(tokens=suffix_ids.shape[-1])
+        generate_kwargs = self.kv_cache_kwargs(kv_cache)
+        if prefix and kv_cache == "dynamic":
+            prefix_ids, prefix_kv = self.get_prefix_cache(prefix)
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1)
+            # generate() extends the cache in place, so hand it a private copy
+            generate_kwargs["past_key_values"] = copy.deepcopy(prefix_kv)
+        elif prefix:
+            # Quantized and offloaded caches can't start from the prefilled DynamicCache, so the
+            # system block is only tokenized rather than looked up (and prefilled on a miss)
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1)
+        else:
+            prefix_ids = suffix_ids[:, :0]
+            input_ids = suffix_ids
+        
+        # Keep the system prompt and the user turn's header when sliding the window
+        header_ids = self.tokenizer("<|im_start|>user\n", add_special_tokens=False).input_ids
+        keep_start = prefix_ids.shape[-1] + (len(header_ids) if prompt.startswith("<|im_start|>user\n") else 0)
+        input_ids, max_new_tokens, dropped = self.fit_kv_ceiling(input_ids, keep_start, max_new_tokens, kv_cache)
+        
+        # Generate response
+        outputs = self._run_generate(
+            on_token=on_token,
+            cancel_event=cancel_event,
+            json_keys=[json_keys] if json_keys else None,
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            do_sample=True,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=self.tokenizer.eos_token_id,
+            **generate_kwargs
+        )
+        self.last_stats["kv_cache"] = kv_cache
+        self.last_stats["prompt_tokens_dropped"] = dropped
+        
+        # Decode only the newly generated tokens
+        return self.decode_reply(outputs[0][input_ids.shape[-1]:])
+
+class BatchRequest:
+    """One chat completion waiting for, or decoding in, a ContinuousBatcher."""
+    def __init__(self, messages, temperature, max_new_tokens, json_keys, cancel_event):
+        self.messages = messages
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.json_keys = json_keys
+        self.cancel_event = cancel_event
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.first_token = None
+        self.token_ids = []
+        self.last_token = None
+        self.grammar = None
+        self.state = None
+        self.json_stop = None
+
+class ContinuousBatcher:
+    """Decodes chat completions from many callers together on one shared QwenModel.
+    
+    Scheduling happens per decode step rather than per request: a new request is prefilled and
+    joins the running batch at the next step, and a finished one leaves it immediately, so short
+    replies are never held back by long ones and every step decodes as many rows as are waiting.
+    Rows of different lengths share one left-padded KV cache with an attention mask.
+    """
+    def __init__(self, model, max_batch=16):
+        self.model = model
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.rows = []
+        self.layers = None          # per-layer (key, value) tensors of shape (rows, heads, length, dim)
+        self.attention_mask = None  # (rows, length); zeros mark left padding
+        
+        config = model.model.generation_config
+        eos = config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos]) | {model.tokenizer.eos_token_id}
+        # The top-k / top-p filtering generate() applies from the same config, so batched replies are
+        # sampled from the same distribution as single ones
+        self.warpers = LogitsProcessorList()
+        if config.top_k:
+            self.warpers.append(TopKLogitsWarper(config.top_k))
+        if config.top_p is not None and config.top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(config.top_p))
+        
+        self.steps = 0
+        self.decoded_tokens = 0
+        self.busy_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def submit(self, messages, temperature=0.8, max_new_tokens=1024, json_keys=None, cancel_event=None):
+        """Queue a completion and return a concurrent.futures.Future of (text, stats)."""
+        request = BatchRequest(messages, temperature, max_new_tokens, json_keys, cancel_event)
+        self.pending.put(request)
+        return request.future
+    
+    def stats(self):
+        return {
+            "active_rows": len(self.rows),
+            "queued": self.pending.qsize(),
+            "steps": self.steps,
+            "decoded_tokens": self.decoded_tokens,
+            "mean_batch_size": self.decoded_tokens / self.steps if self.steps else 0.0,
+            "tokens_per_sec": self.decoded_tokens / self.busy_time if self.busy_time else 0.0,
+        }
+    
+    def _run(self):
+        while True:
+            if not self.rows:
+                self._admit(self.pending.get())
+            while len(self.rows) < self.max_batch:
+                try:
+                    request = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                self._admit(request)
+            if self.rows:
+                start = time.perf_counter()
+                try:
+                    self._step()
+                except Exception as e:
+                    # A failed step leaves the shared cache unusable, so every row in it fails;
+                    # rows that finished earlier in the step already have their result
+                    for request in self.rows:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    self.rows = []
+                    self.layers = None
+                    self.attention_mask = None
+                self.busy_time += time.perf_counter() - start
+    
+    def _admit(self, request):
+        """Prefill a request on its own, sample its first token, and add it to the batch."""
+        if not request.future.set_running_or_notify_cancel():
+            return
+        if request.cancel_event is not None and request.cancel_event.is_set():
+            request.future.set_exception(GenerationCancelled())
+            return
+        start = time.perf_counter()
+        try:
+            model = self.model
+            prefix, prompt = model.format_messages(request.messages)
+            prompt_ids = model.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids.to(model.device)
+            if prefix:
+                prefix_ids, prefix_kv = model.get_prefix_cache(prefix)
+                past_key_values = copy.deepcopy(prefix_kv)
+                length = prefix_ids.shape[-1] + prompt_ids.shape[-1]
+            else:
+                past_key_values = DynamicCache()
+                length = prompt_ids.shape[-1]
+            with torch.no_grad():
+                outputs = model.model(input_ids=prompt_ids, past_key_values=past_key_values, use_cache=True)
+            
+            if request.json_keys and model.constrain_json:
+                request.grammar = model.get_grammar(request.json_keys)
+                request.state = request.grammar.new_state()
+            request.json_stop = JsonObjectStoppingCriteria(model.tokenizer, 0, 1)
+            if not self._accept(request, self._sample(request, outputs.logits[0, -1])):
+                self._merge(list(outputs.past_key_values.to_legacy_cache()), length)
+                self.rows.append(request)
+        except Exception as e:
+            # _accept may have resolved it already, when the first token ended the reply
+            if not request.future.done():
+                request.future.set_exception(e)
+        self.busy_time += time.perf_counter() - start
+    
+    def _merge(self, layers, length):
+        """Concatenate a prefilled row onto the batch cache, left-padding whichever side is shorter."""
+        device = self.model.device
+        mask = torch.ones(1, length, dtype=torch.long, device=device)
+        if self.layers is None:
+            self.layers = layers
+            self.attention_mask = mask
+            return
+        
+        current = self.attention_mask.shape[-1]
+        if length < current:
+            layers = [(pad_left(k, current - length), pad_left(v, current - length)) for k, v in layers]
+            mask = torch.cat([torch.zeros(1, current - length, dtype=torch.long, device=device), mask], dim=-1)
+        elif length > current:
+            self.layers = [(pad_left(k, length - current), pad_left(v, length - current)) for k, v in self.layers]
+            padding = torch.zeros(len(self.rows), length - current, dtype=torch.long, device=device)
+            self.attention_mask = torch.cat([padding, self.attention_mask], dim=-1)
+        
+        self.layers = [
+            (torch.cat([k0, k1]), torch.cat([v0, v1])) for (k0, v0), (k1, v1) in zip(self.layers, layers)
+        ]
+        self.attention_mask = torch.cat([self.attention_mask, mask])
+    
+    def _step(self):
+        """Decode one token for every row in the batch and retire the rows that finished."""
+        device = self.model.device
+        input_ids = torch.tensor([[request.last_token] for request in self.rows], device=device)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, torch.ones(len(self.rows), 1, dtype=torch.long, device=device)], dim=-1
+        )
+        # Positions count only real tokens, so padded rows line up with how they were prefilled
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True) - 1
+        with torch.no_grad():
+            outputs = self.model.model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=DynamicCache.from_legacy_cache(tuple(self.layers)),
+                use_cache=True
+            )
+        self.layers = list(outputs.past_key_values.to_legacy_cache())
+        self.steps += 1
+        
+        keep = []
+        for row, request in enumerate(self.rows):
+            if request.cancel_event is not None and request.cancel_event.is_set():
+                request.future.set_exception(GenerationCancelled())
+            elif not self._accept(request, self._sample(request, outputs.logits[row, -1])):
+                keep.append(row)
+        if len(keep) == len(self.rows):
+            return
+        
+        self.rows = [self.rows[row] for row in keep]
+        if not self.rows:
+            self.layers = None
+            self.attention_mask = None
+            return
+        index = torch.tensor(keep, device=device)
+        self.attention_mask = self.attention_mask[index]
+        # Drop padding columns that only the retired rows needed
+        start = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, start:]
+        self.layers = [(k[index, :, start:], v[index, :, start:]) for k, v in self.layers]
+    
+    def _sample(self, request, logits):
+        scores = logits.float()
+        if request.grammar is not None:
+            mask = request.grammar.mask(request.state, scores.shape[-1], scores.device)
+            if mask is not None:
+                scores = scores.masked_fill(~mask, float("-inf"))
+        scores = self.warpers(None, (scores / max(request.temperature, 1e-5)).unsqueeze(0))[0]
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, 1))
+    
+    def _accept(self, request, token_id):
+        """Record a sampled token; resolve the request and return True once it is finished."""
+        self.decoded_tokens += 1
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+        request.token_ids.append(token_id)
+        request.last_token = token_id
+        token_strings = self.model.get_token_strings()
+        if request.grammar is not None:
+            request.grammar.advance(request.state, token_strings[token_id] if token_id < len(token_strings) else "")
+        request.json_stop._feed(0, token_id)
+        
+        if token_id not in self.eos_ids and not request.json_stop.done[0] and len(request.token_ids) < request.max_new_tokens:
+            return False
+        end = time.perf_counter()
+        new_tokens = len(request.token_ids)
+        request.future.set_result((self.model.decode_reply(request.token_ids), {
+            "ttft": request.first_token - request.submitted,
+            "tokens_per_sec": new_tokens / (end - request.first_token) if end > request.first_token else 0.0,
+            "new_tokens": new_tokens,
+            "total_time": end - request.submitted,
+            "stopped_at_json": request.json_stop.done[0],
+        }))
+        return True
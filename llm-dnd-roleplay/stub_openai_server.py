@@ -0,0 +1,172 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Canned replies, picked by what the prompt asks for
+OUTCOMES = {
+    "1": "You stumble and the noise alerts every guard in the hall.",
+    "2": "You make a little progress before something goes wrong.",
+    "3": "Nothing much happens, but you are not noticed either.",
+    "4": "You succeed, though it takes longer than you hoped.",
+    "5": "You succeed cleanly and find something useful along the way.",
+    "6": "A flawless attempt that will be told in taverns for years.",
+}
+SUGGESTIONS = {
+    "1": "Search the room for hidden doors",
+    "2": "Ask the innkeeper about the missing caravan",
+    "3": "Rest and tend to your wounds",
+}
+SUMMARY = "The party crossed the old keep, made an uneasy ally of the innkeeper and still seeks the missing caravan."
+
+class StubSettings:
+    """Fault injection knobs shared by every request handler."""
+    def __init__(self, latency=0.0, token_delay=0.0, failure_rate=0.0, hang_rate=0.0, seed=None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def roll(self):
+        with self.lock:
+            self.requests += 1
+            return self.random.random()
+
+def reply_for(messages):
+    """Return the JSON table, or for summary requests the prose, a real model would be asked for by these messages."""
+    system = next((m["content"] for m in messages if m["role"] == "system"), "")
+    user = messages[-1]["content"] if messages else ""
+    # The summary prompt casts the model as the adventure's chronicler and wants plain prose
+    if "chronicler" in system:
+        return SUMMARY
+    table = SUGGESTIONS if "suggest 3" in system else OUTCOMES
+
+    # Tier requests name the keys they want, e.g. 'Only return the outcomes for "2", "5"'
+    match = re.search(r"Only return the outcomes for (.+?), as a JSON object", user)
+    if match:
+        keys = re.findall(r'"([^"]+)"', match.group(1))
+        table = {key: table.get(key, f"Outcome {key}") for key in keys}
+    return json.dumps(table, indent=2)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so the client's connection pool is exercised
+    settings = StubSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        settings = self.settings
+        time.sleep(settings.latency)
+        roll = settings.roll()
+        if roll < settings.failure_rate:
+            with settings.lock:
+                settings.failures += 1
+            self.send_json(500, {"error": {"message": "Injected failure"}})
+            return
+        if roll < settings.failure_rate + settings.hang_rate:
+            # Never answer, so the client's timeout has to fire
+            time.sleep(3600)
+            return
+
+        text = reply_for(body.get("messages", []))
+        if body.get("stream"):
+            self.send_stream(text)
+        else:
+            self.send_json(200, {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(text.split()), "total_tokens": len(text.split())},
+            })
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        # One "token" per whitespace-separated piece, like LM Studio's one token per chunk
+        try:
+            for piece in re.findall(r"\S+\s*|\s+", text):
+                chunk = {
+                    "id": "stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": "stub",
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(self.settings.token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream, e.g. on cancel
+            pass
+
+def make_server(host="127.0.0.1", port=0, **settings):
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"settings": StubSettings(**settings)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_server(host="127.0.0.1", port=0, **settings):
+    """Start the stub in a daemon thread and return the server; its base URL is f"http://{host}:{server.server_port}/v1"."""
+    server = make_server(host, port, **settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI-compatible server with injected latency and failures")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests never answered")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = make_server(
+        args.host,
+        args.port,
+        latency=args.latency,
+        token_delay=args.token_delay,
+        failure_rate=args.failure_rate,
+        hang_rate=args.hang_rate,
+        seed=args.seed
+    )
+    print(f"Stub server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,43 +1,74 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
+import argparse
 import random
 import json
-from openai import OpenAI
-from pydantic import RootModel, ValidationError
-from typing import Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import ValidationError
 
-# Set up OpenAI client
-client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
-
-# Define the Pydantic model for validation
-class DnDResponseSchema(RootModel[Dict[str, str]]):
-    def validate_keys(self):
-        expected_keys = {str(i) for i in range(1, 7)}
-        actual_keys = set(self.root.keys())
-        if expected_keys != actual_keys:
-            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
-
-class SuggestionsSchema(RootModel[Dict[str, str]]):
-    def validate_keys(self):
-        expected_keys = {"1", "2", "3"}
-        actual_keys = set(self.root.keys())
-        if expected_keys != actual_keys:
-            raise ValueError(f"Expected keys {expected_keys}, got {actual_keys}")
+from dungeon_common import (
+    DEFAULT_RESPONSE_CACHE, OUTCOME_SYSTEM_PROMPT, SUMMARY_SYSTEM_PROMPT, CampaignLog, ContextWindow, DnDResponseSchema, GenerationCancelled, HistoryStore,
+    InferenceWorker, ResponseCache, SuggestionsSchema, TRACER, VectorMemory
+)
+from lmstudio_client import SUGGESTION_SYSTEM_PROMPT, AsyncLMStudioClient, estimate_tokens, find_completed_value, truncate_tokens
 
 class DnDGameInterface:
-    def __init__(self, root):
+    def __init__(self, root, max_rendered_entries=500, history_page_size=100, lazy_outcomes=False, context_tokens=1024, retrieval_k=4, response_cache=None, prefetch=True, campaign=None, history_ring=512, client=None):
         self.root = root
+        # Created here rather than on import, since the client starts its own event-loop thread
+        self.client = client if client is not None else AsyncLMStudioClient()
         self.root.title("D&D Game Interface")
         self.root.geometry("800x700")
         
-        self.game_history = []
+        # Only the newest history_ring entries are held in memory; older ones are read back from disk
+        self.game_history = HistoryStore(ring_size=history_ring)
         self.current_outcomes = {}
         self.current_roll = None
         self.last_action = ""
+        self.last_stats = {}
+        # Generate the rolled tier first and fill in the others in the background
+        self.lazy_outcomes = lazy_outcomes
+        self.outcomes_pending = False
+        self.pending_roll = None
+        # Replies memoized by action and scene; whether to reuse them is read from the checkbox each turn
+        self.response_cache = response_cache
+        self.reuse_cached = False
+        self.turn_started = None
+        # Outcome tables generated for the suggested actions while the player decides, by reply key
+        self.prefetch = prefetch
+        self.prefetched = {}
+        self.prefetch_started = False
+        self.prefetch_turns = 0
+        self.prefetch_hits = 0
+        # Follow-up requests for keys a reply left out, and the tokens they saved over a full retry
+        self.repair_stats = {"repairs": 0, "keys": 0, "tokens": 0, "tokens_saved": 0}
+        # Save file the history and current turn are appended to
+        self.campaign = campaign
+        # Prompts see a summary of older turns plus the newest entries that fit the token budget
+        self.context = ContextWindow(
+            estimate_tokens,
+            truncate_tokens,
+            max_tokens=context_tokens,
+            memory=VectorMemory() if retrieval_k else None,
+            retrieval_k=retrieval_k
+        )
+        
+        # Only a bounded window of the history lives in the text widget
+        self.max_rendered_entries = max_rendered_entries
+        self.history_page_size = history_page_size
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.worker = InferenceWorker(self.root)
+        # Lets the suggestions request run while the outcome table is still streaming
+        self.executor = ThreadPoolExecutor(max_workers=2)
         
         # Create frames
         self.create_widgets()
         self.layout_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        if self.campaign is not None:
+            self.restore_campaign(*self.campaign.load())
     
     def create_widgets(self):
         # Create main frames
@@ -46,7 +77,14 @@ class DnDGameInterface:
         self.suggestions_frame = tk.Frame(self.root)
         
         # Game history text area
-        self.context_label = tk.Label(self.history_frame, text="Game History:")
+        self.history_header = tk.Frame(self.history_frame)
+        self.context_label = tk.Label(self.history_header, text="Game History:")
+        self.show_earlier_button = tk.Button(
+            self.history_header,
+            text="Show earlier entries",
+            command=self.on_show_earlier_clicked,
+            state=tk.DISABLED
+        )
         self.context_box = scrolledtext.ScrolledText(
             self.history_frame,
             wrap=tk.WORD,
@@ -82,6 +120,33 @@ class DnDGameInterface:
             fg="white",
             width=10
         )
+        self.stream_var = tk.BooleanVar(value=True)
+        self.stream_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Stream tokens",
+            variable=self.stream_var
+        )
+        self.pipeline_var = tk.BooleanVar(value=False)
+        self.pipeline_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Overlap suggestions",
+            variable=self.pipeline_var
+        )
+        self.cache_var = tk.BooleanVar(value=self.response_cache is not None)
+        self.cache_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Reuse cached replies",
+            variable=self.cache_var,
+            state=tk.NORMAL if self.response_cache is not None else tk.DISABLED
+        )
+        self.trace_var = tk.BooleanVar(value=TRACER.enabled)
+        self.trace_checkbox = tk.Checkbutton(
+            self.button_frame,
+            text="Trace turns",
+            variable=self.trace_var,
+            command=self.on_trace_toggled
+        )
+        self.stats_label = tk.Label(self.button_frame, text="", fg="gray")
         
         # Suggestions
         self.suggestions_label = tk.Label(self.suggestions_frame, text="Suggested Actions:")
@@ -99,7 +164,9 @@ class DnDGameInterface:
     def layout_widgets(self):
         # Layout history frame
         self.history_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        self.context_label.pack(anchor="w")
+        self.history_header.pack(fill=tk.X)
+        self.context_label.pack(side=tk.LEFT)
+        self.show_earlier_button.pack(side=tk.RIGHT)
         self.context_box.pack(fill=tk.BOTH, expand=True)
         
         # Layout input frame
@@ -111,6 +178,11 @@ class DnDGameInterface:
         self.button_frame.pack(fill=tk.X, pady=5)
         self.send_button.pack(side=tk.LEFT, padx=5)
         self.reroll_button.pack(side=tk.LEFT, padx=5)
+        self.stream_checkbox.pack(side=tk.LEFT, padx=5)
+        self.pipeline_checkbox.pack(side=tk.LEFT, padx=5)
+        self.cache_checkbox.pack(side=tk.LEFT, padx=5)
+        self.trace_checkbox.pack(side=tk.LEFT, padx=5)
+        self.stats_label.pack(side=tk.RIGHT, padx=5)
         
         # Layout suggestions
         self.suggestions_frame.pack(fill=tk.BOTH, padx=10, pady=10)
@@ -118,18 +190,117 @@ class DnDGameInterface:
         for button in self.suggestion_buttons:
             button.pack(fill=tk.X, pady=2)
     
+    @TRACER.traced("update_context")
     def update_context(self, content, replace_last=False):
         if replace_last and self.game_history:
-            self.game_history.pop()
-        self.game_history.append(content)
-        
-        # Update the text widget
+            self.game_history.replace_last(content)
+            self.replace_last_rendered(content)
+        else:
+            self.game_history.append(content)
+            self.render_entry(content)
+    
+    def render_entry(self, content):
+        """Append one entry to the text widget, trimming the oldest past the scrollback limit."""
+        index = len(self.game_history) - 1
         self.context_box.config(state=tk.NORMAL)
-        self.context_box.delete(1.0, tk.END)
-        self.context_box.insert(tk.END, "\n\n".join(self.game_history))
+        if self.rendered_end > self.rendered_start:
+            self.context_box.insert(tk.END, "\n\n")
+        self.context_box.insert(tk.END, content, f"entry{index}")
+        self.rendered_end = index + 1
+        while self.rendered_end - self.rendered_start > self.max_rendered_entries:
+            self.drop_first_rendered()
         self.context_box.config(state=tk.DISABLED)
         self.context_box.see(tk.END)  # Scroll to the end
-        
+        self.update_show_earlier()
+    
+    def replace_last_rendered(self, content):
+        tag = f"entry{len(self.game_history) - 1}"
+        self.context_box.config(state=tk.NORMAL)
+        ranges = self.context_box.tag_ranges(tag)
+        if ranges:
+            start = ranges[0]
+            self.context_box.delete(ranges[0], ranges[-1])
+        else:
+            start = self.context_box.index("end-1c")
+        self.context_box.insert(start, content, tag)
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)  # Scroll to the end
+    
+    def drop_first_rendered(self):
+        next_ranges = self.context_box.tag_ranges(f"entry{self.rendered_start + 1}")
+        self.context_box.delete("1.0", next_ranges[0] if next_ranges else "end-1c")
+        self.context_box.tag_delete(f"entry{self.rendered_start}")
+        self.rendered_start += 1
+    
+    def on_show_earlier_clicked(self):
+        """Page older entries back into the text widget from the stored history."""
+        start = max(0, self.rendered_start - self.history_page_size)
+        self.context_box.config(state=tk.NORMAL)
+        for index in range(self.rendered_start - 1, start - 1, -1):
+            self.context_box.insert("1.0", "\n\n")
+            self.context_box.insert("1.0", self.game_history[index], f"entry{index}")
+        self.context_box.config(state=tk.DISABLED)
+        self.rendered_start = start
+        self.context_box.see("1.0")
+        self.update_show_earlier()
+    
+    def update_show_earlier(self):
+        self.show_earlier_button.config(state=tk.NORMAL if self.rendered_start > 0 else tk.DISABLED)
+    
+    def begin_stream(self):
+        """Open a provisional region at the end of the history that streamed tokens are written into."""
+        self.context_box.config(state=tk.NORMAL)
+        self.context_box.insert(tk.END, "\n\nDM is writing... ", "stream")
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)
+    
+    def append_stream(self, text):
+        self.context_box.config(state=tk.NORMAL)
+        self.context_box.insert(tk.END, text, "stream")
+        self.context_box.config(state=tk.DISABLED)
+        self.context_box.see(tk.END)
+    
+    def end_stream(self):
+        ranges = self.context_box.tag_ranges("stream")
+        if ranges:
+            self.context_box.config(state=tk.NORMAL)
+            self.context_box.delete(ranges[0], ranges[-1])
+            self.context_box.config(state=tk.DISABLED)
+    
+    def on_trace_toggled(self):
+        TRACER.enabled = self.trace_var.get()
+        if not TRACER.enabled:
+            TRACER.flush()
+    
+    def end_turn_trace(self):
+        # The turn span runs from the action being sent to the suggestions (or an error) arriving
+        if self.turn_started is not None and TRACER.enabled:
+            TRACER.record("turn", self.turn_started, time.perf_counter())
+            TRACER.flush()
+        self.turn_started = None
+    
+    def show_error(self, title, message):
+        # Dialogs must be opened from the Tk thread
+        self.worker.post(messagebox.showerror, title, message)
+    
+    def show_stats(self, stats):
+        if not stats:
+            return
+        if stats.get("cached"):
+            text = "Cached reply"
+        elif stats.get("prefetched"):
+            text = "Prefetched reply"
+        else:
+            text = f"TTFT {stats['ttft']:.2f}s | {stats['tokens_per_sec']:.1f} tok/s | {stats['new_tokens']} tokens"
+        if self.response_cache is not None:
+            cache = self.response_cache.stats()
+            text += f" | cache {cache['hit_rate']:.0%} hits, {cache['saved_seconds']:.1f}s saved"
+        if self.repair_stats["repairs"]:
+            text += f" | {self.repair_stats['repairs']} repairs, {self.repair_stats['tokens_saved']} tokens saved"
+        if self.prefetch_turns:
+            text += f" | prefetch {self.prefetch_hits}/{self.prefetch_turns} hits"
+        self.stats_label.config(text=text)
+    
     def update_suggestions(self, suggestions):
         for i, button in enumerate(self.suggestion_buttons):
             button.config(text=suggestions[str(i+1)])
@@ -137,168 +308,553 @@ class DnDGameInterface:
     def roll_die(self):
         return random.randint(1, 6)
     
-    def get_model_response(self, user_action):
-        system_prompt = """
-        You are a fantasy roleplaying assistant. Your task is to return 6 different interpretations or outcomes of a user's in-game action.
-        The replies will be from failure to success with the lowest being failure, and the highest success.
-        
-        Respond ONLY in JSON format, using the following schema:
-        {
-          "1": "An epic and funny failure.",
-          "2": "The request fails perhaps the opposite effect the user wanted.",
-          "3": "The action was not successful but the outcome is neutral",
-          "4": "A fair success",
-          "5": "An elegant success",
-          "6": "an amazing success"
-        }
+    def outcome_messages(self, user_action, context=""):
+        story = f"Story context: {context}\n\n" if context else ""
+        return [
+            {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"{story}My action: {user_action}"}
+        ]
+    
+    def outcome_context(self, user_action, history):
+        # Outcomes get half the budget: earlier events relevant to the action plus the latest turns
+        return self.context.build(history, query=user_action, max_tokens=self.context.max_tokens // 2)
+    
+    def create_completion(self, messages, temperature, on_token=None, cancel_event=None, max_tokens=None):
+        """Request a chat completion, optionally streaming text to on_token.
         
-        Here's an example for the action "I try to climb the tower":
-        {
-          "1": "You slip on the first foothold and fall flat on your back, knocking the wind out of yourself as nearby creatures snicker at your clumsiness.",
-          "2": "Your aggressive climbing causes several loose stones to break free. They crash down around you, alerting the tower guards to your presence.",
-          "3": "After several attempts, you realize the tower's surface is too smooth to climb without proper equipment. You're back where you started.",
-          "4": "With careful movements, you manage to scale about halfway up the tower, finding a small window ledge where you can rest and observe.",
-          "5": "Your nimble fingers find perfect handholds in the weathered stone, allowing you to scale the tower with remarkable speed and silence.",
-          "6": "Not only do you scale the tower effortlessly, but you discover a hidden entrance near the top that appears to have been unused for centuries."
-        }
+        Returns the response text and a dict with TTFT and tokens/sec for the call. When cancel_event
+        is given the response is always streamed so the connection can be closed as soon as it is set.
+        """
+        return self.client.complete(messages, temperature, on_token=on_token, cancel_event=cancel_event, max_tokens=max_tokens)
+
+    def reply_key(self, kind, history, **params):
+        # Replies are matched on the latest player action and the latest DM entry
+        action = next((entry[len("Player: "):] for entry in reversed(history) if entry.startswith("Player: ")), "")
+        scene = next((entry for entry in reversed(history) if entry.startswith("DM ")), "")
+        return ResponseCache.make_key(kind, action, scene, model=str(self.client.client.base_url), **params)
+    
+    def cached_reply(self, key):
+        """Return the stored reply text for key, or None if there is none or reuse is off."""
+        if self.response_cache is None or key is None or not self.reuse_cached:
+            return None
+        return self.response_cache.get(key)
+    
+    def store_reply(self, key, text, cost):
+        """Remember a reply that took cost seconds to generate."""
+        if self.response_cache is not None and key is not None:
+            self.response_cache.put(key, text, cost)
+    
+    @TRACER.traced("parse_json")
+    def parse_reply(self, response_text):
+        """Pull the JSON object out of a reply; anything unparseable comes back empty for repair_table to fill."""
+        # Check if the JSON is properly formatted (has matching braces)
+        if response_text.count('{') != response_text.count('}'):
+            # Try to fix it by adding missing closing brace
+            response_text = response_text + "}"
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx == -1 or end_idx <= start_idx:
+            return {}
+        try:
+            table = json.loads(response_text[start_idx:end_idx])
+        except json.JSONDecodeError:
+            return {}
+        return table if isinstance(table, dict) else {}
+    
+    def repair_table(self, table, schema, follow_up, temperature, full_tokens, cancel_event=None):
+        """Validate a parsed reply against schema and re-ask only for the keys that are missing or empty.
         
-        Each response should be a short narrative or description (1–3 sentences), styled as if spoken by a dungeon master. Keep it creative and immersive.
+        follow_up(keys) builds the messages for the targeted request. Returns the table and the keys
+        that still failed.
         """
+        table = {key: value.strip() for key, value in table.items() if key in schema.keys and isinstance(value, str) and value.strip()}
+        try:
+            schema(table).validate_keys()
+            return table, []
+        except ValueError:
+            missing = [key for key in schema.keys if key not in table]
         
+        response_text, stats = self.create_completion(follow_up(missing), temperature=temperature, cancel_event=cancel_event)
+        values = self.parse_reply(response_text)
+        table.update({key: values[key].strip() for key in missing if isinstance(values.get(key), str) and values[key].strip()})
+        # A full retry would have cost about as many tokens as the reply being repaired
+        self.repair_stats["repairs"] += 1
+        self.repair_stats["keys"] += len(missing)
+        self.repair_stats["tokens"] += stats["new_tokens"]
+        # A short, truncated reply can cost less than its repair; that saved nothing rather than a negative amount
+        self.repair_stats["tokens_saved"] += max(0, full_tokens - stats["new_tokens"])
+        return table, [key for key in schema.keys if key not in table]
+    
+    def fill_missing(self, table, missing, placeholder):
+        # Placeholders keep the turn playable when even the targeted retry came back incomplete
+        if missing:
+            self.show_error("JSON Error", f"The model left out {', '.join(missing)} even after a retry for just those keys")
+        return {**table, **{key: placeholder(key) for key in missing}}
+    
+    @TRACER.traced("get_model_response")
+    def get_model_response(self, user_action, on_token=None, cancel_event=None, context="", cache_key=None):
         try:
-            completion = client.chat.completions.create(
-                model="model-identifier",  # Replace with your actual model name
-                messages=[
-                    {"role": "system", "content": system_prompt.strip()},
-                    {"role": "user", "content": f"My action: {user_action}"}
-                ],
+            response_text = self.cached_reply(cache_key)
+            if response_text is not None:
+                self.last_stats = {"ttft": 0.0, "tokens_per_sec": 0.0, "new_tokens": 0, "cached": True}
+                if on_token is not None:
+                    on_token(response_text)
+                return self.parse_reply(response_text)
+            
+            start = time.perf_counter()
+            response_text, self.last_stats = self.create_completion(
+                self.outcome_messages(user_action, context),
                 temperature=0.8,
+                on_token=on_token,
+                cancel_event=cancel_event
             )
-            
-            response_text = completion.choices[0].message.content.strip()
-            
-            # Check if the JSON is properly formatted (has matching braces)
-            if response_text.count('{') != response_text.count('}'):
-                # Try to fix it by adding missing closing brace
-                response_text = response_text + "}"
-                
-            try:
-                return json.loads(response_text)
-            except json.JSONDecodeError as e:
-                messagebox.showerror("JSON Error", f"Failed to parse model response: {str(e)}\n\nRaw response: {response_text}")
-                # Return a fallback dictionary
-                return {str(i): f"Error parsing outcome {i}" for i in range(1, 7)}
+            outcomes, missing = self.repair_table(
+                self.parse_reply(response_text),
+                DnDResponseSchema,
+                lambda keys: self.tier_messages(user_action, keys, context),
+                0.8,
+                self.last_stats["new_tokens"],
+                cancel_event
+            )
+            # Only complete tables are worth replaying
+            if not missing:
+                self.store_reply(cache_key, json.dumps(outcomes), time.perf_counter() - start)
+            return self.fill_missing(outcomes, missing, lambda key: f"Error parsing outcome {key}")
+        except GenerationCancelled:
+            raise
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to get model response: {str(e)}")
+            self.show_error("Error", f"Failed to get model response: {str(e)}")
             return {str(i): f"Error getting outcome {i}" for i in range(1, 7)}
     
-    def get_suggestions(self, context):
-        system_prompt = """
-        You are a fantasy roleplaying assistant.
-Maintain the world's internal logic and consistency Based on the provided game context, suggest 3 different possible actions the player might want to take next.
-        
-        Respond ONLY in JSON format, using the following schema:
-        {
-          "1": "A possible action described in 5-10 words",
-          "2": "A possible action described in 5-10 words",
-          "3": "A possible action described in 5-10 words"
-        }
-        
-        Here's an example for a context where the player just entered a tavern:
-        {
-          "1": "Order a drink from the bartender",
-          "2": "Ask locals about recent rumors",
-          "3": "Look for suspicious characters"
-        }
-        
-        And another example for combat context:
-        {
-          "1": "Attack with your sword",
-          "2": "Take cover behind the boulder",
-          "3": "Try to negotiate with the enemy"
-        }
-        
-        Make the suggestions creative, varied, and appropriate to the current situation.
-        """
-        
+    def tier_messages(self, user_action, keys, context=""):
+        keys_text = ", ".join(f'"{key}"' for key in keys)
+        story = f"Story context: {context}\n\n" if context else ""
+        return [
+            {"role": "system", "content": OUTCOME_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"{story}My action: {user_action}\n\nOnly return the outcomes for {keys_text}, as a JSON object with just those keys."}
+        ]
+    
+    @TRACER.traced("get_outcome_tiers")
+    def get_outcome_tiers(self, user_action, keys, on_token=None, cancel_event=None, context=""):
+        """Generate only the given outcome tiers for an action."""
         try:
-            completion = client.chat.completions.create(
-                model="model-identifier",  # Replace with your actual model name
-                messages=[
-                    {"role": "system", "content": system_prompt.strip()},
-                    {"role": "user", "content": f"Game context: {context}\n\nSuggest three possible actions for the player:"}
-                ],
-                temperature=0.9,
+            response_text, self.last_stats = self.create_completion(
+                self.tier_messages(user_action, keys, context),
+                temperature=0.8,
+                on_token=on_token,
+                cancel_event=cancel_event
             )
+            start_idx = response_text.find('{')
+            end_idx = response_text.rfind('}') + 1
+            outcomes = json.loads(response_text[start_idx:end_idx]) if start_idx != -1 and end_idx > start_idx else {}
+            return {key: str(outcomes.get(key, f"Error parsing outcome {key}")) for key in keys}
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            self.show_error("Error", f"Failed to get model response: {str(e)}")
+            return {key: f"Error getting outcome {key}" for key in keys}
+    
+    def suggestion_messages(self, context, keys=None):
+        if keys is None:
+            ask = "Suggest three possible actions for the player:"
+        else:
+            keys_text = ", ".join(f'"{key}"' for key in keys)
+            ask = f"Only return the suggestions for {keys_text}, as a JSON object with just those keys."
+        return [
+            {"role": "system", "content": SUGGESTION_SYSTEM_PROMPT.strip()},
+            {"role": "user", "content": f"Game context: {context}\n\n{ask}"}
+        ]
+    
+    @TRACER.traced("get_suggestions")
+    def get_suggestions(self, context, cancel_event=None, cache_key=None):
+        try:
+            response_text = self.cached_reply(cache_key)
+            if response_text is not None:
+                return self.parse_reply(response_text)
             
-            response_text = completion.choices[0].message.content.strip()
-            
-            # Check if the JSON is properly formatted (has matching braces)
-            if response_text.count('{') != response_text.count('}'):
-                # Try to fix it by adding missing closing brace
-                response_text = response_text + "}"
-                
-            try:
-                return json.loads(response_text)
-            except json.JSONDecodeError as e:
-                messagebox.showerror("JSON Error", f"Failed to parse model response: {str(e)}\n\nRaw response: {response_text}")
-                # Return a fallback dictionary
-                return {str(i): f"Error parsing outcome {i}" for i in range(1, 7)}
+            start = time.perf_counter()
+            response_text, stats = self.create_completion(self.suggestion_messages(context), temperature=0.9, cancel_event=cancel_event)
+            suggestions, missing = self.repair_table(
+                self.parse_reply(response_text),
+                SuggestionsSchema,
+                lambda keys: self.suggestion_messages(context, keys),
+                0.9,
+                stats["new_tokens"],
+                cancel_event
+            )
+            if not missing:
+                self.store_reply(cache_key, json.dumps(suggestions), time.perf_counter() - start)
+            return self.fill_missing(suggestions, missing, lambda key: f"Suggested action {key}")
+        except GenerationCancelled:
+            raise
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to get suggestions: {str(e)}")
+            self.show_error("Error", f"Failed to get suggestions: {str(e)}")
             return {str(i): f"Suggested action {i}" for i in range(1, 4)}
     
     def on_send_clicked(self):
         user_action = self.user_input.get("1.0", tk.END).strip()
         if not user_action:
             return
-            
+        
+        # A new action supersedes whatever the model is still working on
+        self.worker.cancel_all()
+        self.end_stream()
+        
         self.last_action = user_action
+        TRACER.next_turn()
+        self.turn_started = time.perf_counter()
+        self.reuse_cached = self.cache_var.get()
+        self.current_outcomes = {}
+        self.outcomes_pending = False
+        self.pending_roll = None
         self.update_context(f"Player: {user_action}")
         
-        try:
-            # Show loading indicator in the UI
+        # Clear user input
+        self.user_input.delete("1.0", tk.END)
+        
+        prefetched = self.take_prefetched(self.game_history)
+        if prefetched is not None:
+            # The outcome table was generated while the player was choosing
+            outcomes, stats = prefetched
             self.root.config(cursor="watch")
-            self.root.update()
-            
-            # Get 6 possible outcomes from model
-            self.current_outcomes = self.get_model_response(user_action)
+            self.on_outcomes_ready((outcomes, dict(stats, prefetched=True)))
+            return
+        
+        # Show loading indicator in the UI while the worker runs
+        self.root.config(cursor="watch")
+        on_token = None
+        if self.stream_var.get():
+            self.begin_stream()
+            on_token = lambda text: self.worker.post(self.append_stream, text)
+        
+        if self.lazy_outcomes:
+            self.outcomes_pending = True
+            self.worker.submit(
+                self.lazy_turn_job,
+                user_action,
+                self.game_history.snapshot(),
+                on_token,
+                on_error=self.on_turn_error
+            )
+            return
+        
+        if self.pipeline_var.get():
+            # Suggestions start as soon as the rolled outcome has streamed in
+            self.worker.submit(
+                self.pipeline_job,
+                user_action,
+                self.game_history.snapshot(),
+                on_token,
+                on_done=self.on_suggestions_ready,
+                on_error=self.on_turn_error
+            )
+            return
+        
+        # Get 6 possible outcomes from model in the background
+        self.worker.submit(
+            self.outcomes_job,
+            user_action,
+            self.game_history.snapshot(),
+            on_token,
+            on_done=self.on_outcomes_ready,
+            on_error=self.on_turn_error
+        )
+    
+    def outcomes_job(self, cancel_event, user_action, history, on_token):
+        context = self.outcome_context(user_action, history)
+        cache_key = self.reply_key("outcomes", history, temperature=0.8)
+        outcomes = self.get_model_response(user_action, on_token=on_token, cancel_event=cancel_event, context=context, cache_key=cache_key)
+        return outcomes, dict(self.last_stats)
+    
+    def pipeline_job(self, cancel_event, user_action, history, on_token):
+        """Run a turn with the suggestions request overlapping the rest of the outcome table.
+        
+        The die is rolled up front, so once the rolled outcome's text has closed in the stream the
+        suggestions request is sent on a second connection while the other outcomes finish.
+        """
+        roll = self.roll_die()
+        streamed = []
+        pending = {}
+        
+        def start_suggestions(outcome):
+            latest = f"DM [Rolled {roll}]: {outcome}"
+            context = self.context.build(history + [latest], query=latest)
+            cache_key = self.reply_key("suggestions", history + [latest], temperature=0.9)
+            pending["suggestions"] = self.executor.submit(self.get_suggestions, context, cancel_event, cache_key)
+        
+        def on_outcome_token(text):
+            if on_token is not None:
+                on_token(text)
+            if "suggestions" in pending:
+                return
+            streamed.append(text)
+            outcome = find_completed_value("".join(streamed), str(roll))
+            if outcome is not None:
+                start_suggestions(outcome)
+        
+        outcomes = self.get_model_response(
+            user_action,
+            on_token=on_outcome_token,
+            cancel_event=cancel_event,
+            context=self.outcome_context(user_action, history),
+            cache_key=self.reply_key("outcomes", history, temperature=0.8)
+        )
+        self.worker.post(self.show_outcome, outcomes, dict(self.last_stats), roll)
+        if "suggestions" not in pending:
+            # The rolled outcome never closed in the stream, e.g. the JSON was malformed
+            start_suggestions(outcomes.get(str(roll), ""))
+        return pending["suggestions"].result()
+    
+    def lazy_turn_job(self, cancel_event, user_action, history, on_token):
+        """Roll first, generate and show only the rolled tier, then fill in the others for rerolls."""
+        roll = self.roll_die()
+        outcome_context = self.outcome_context(user_action, history)
+        # A full table stored by any earlier turn already has every tier
+        cache_key = self.reply_key("outcomes", history, temperature=0.8)
+        cached = self.cached_reply(cache_key)
+        start = time.perf_counter()
+        if cached is not None:
+            self.last_stats = {"ttft": 0.0, "tokens_per_sec": 0.0, "new_tokens": 0, "cached": True}
+            if on_token is not None:
+                on_token(cached)
+            rolled = json.loads(cached)
+        else:
+            rolled = self.get_outcome_tiers(user_action, [str(roll)], on_token=on_token, cancel_event=cancel_event, context=outcome_context)
+        self.worker.post(self.show_outcome, rolled, dict(self.last_stats), roll)
+        
+        fill = None
+        if cached is None:
+            # The remaining tiers are only needed for rerolls, so they overlap the suggestions request
+            remaining = [key for key in DnDResponseSchema.keys if key != str(roll)]
+            fill = self.executor.submit(self.get_outcome_tiers, user_action, remaining, None, cancel_event, outcome_context)
+        
+        latest = f"DM [Rolled {roll}]: {rolled[str(roll)]}"
+        context = self.context.build(history + [latest], query=latest)
+        suggestions_key = self.reply_key("suggestions", history + [latest], temperature=0.9)
+        self.worker.post(self.on_suggestions_ready, self.get_suggestions(context, cancel_event=cancel_event, cache_key=suggestions_key))
+        if fill is None:
+            self.worker.post(self.merge_outcomes, rolled)
+            return
+        table = {**rolled, **fill.result()}
+        if all(value not in (f"Error parsing outcome {key}", f"Error getting outcome {key}") for key, value in table.items()):
+            self.store_reply(cache_key, json.dumps(table), time.perf_counter() - start)
+        self.worker.post(self.merge_outcomes, table)
+    
+    def on_outcomes_ready(self, result):
+        outcomes, stats = result
+        if not self.show_outcome(outcomes, stats):
+            return
+        
+        # Get suggestions for next actions
+        full_context = self.context.build(self.game_history.snapshot(), query="\n".join(self.game_history[-2:]))
+        cache_key = self.reply_key("suggestions", self.game_history.snapshot(), temperature=0.9)
+        self.worker.submit(
+            lambda cancel_event: self.get_suggestions(full_context, cancel_event=cancel_event, cache_key=cache_key),
+            on_done=self.on_suggestions_ready,
+            on_error=self.on_turn_error
+        )
+    
+    def show_outcome(self, outcomes, stats, roll=None):
+        """Roll for the finished outcome table (unless already rolled) and add the result to the history."""
+        self.end_stream()
+        self.show_stats(stats)
+        try:
+            self.current_outcomes = outcomes
             
             # Roll die and get outcome
-            self.current_roll = self.roll_die()
+            self.current_roll = roll if roll is not None else self.roll_die()
             outcome = self.current_outcomes[str(self.current_roll)]
             
             # Update game context
             self.update_context(f"DM [Rolled {self.current_roll}]: {outcome}")
-            
-            # Clear user input
-            self.user_input.delete("1.0", tk.END)
-            
-            # Get suggestions for next actions
-            full_context = "\n\n".join(self.game_history)
-            suggestions = self.get_suggestions(full_context)
+        except Exception as e:
+            self.on_turn_error(e)
+            return False
+        return True
+    
+    def merge_outcomes(self, outcomes):
+        """Add background-filled tiers to the table and resolve a reroll that was waiting on them."""
+        self.current_outcomes.update(outcomes)
+        self.outcomes_pending = False
+        if self.pending_roll is not None:
+            outcome = self.current_outcomes.get(str(self.pending_roll), f"Error getting outcome {self.pending_roll}")
+            self.update_context(f"DM [Rolled {self.pending_roll}]: {outcome}", replace_last=True)
+            self.pending_roll = None
+        self.save_campaign()
+    
+    def on_suggestions_ready(self, suggestions):
+        try:
             self.update_suggestions(suggestions)
-            
         except Exception as e:
-            self.update_context(f"Error: {str(e)}")
-        finally:
-            # Reset cursor
-            self.root.config(cursor="")
+            self.on_turn_error(e)
+            return
+        if self.prefetch:
+            # Runs once the model is otherwise idle; the next action cancels it
+            self.prefetch_started = True
+            self.worker.submit_idle(self.prefetch_job, self.game_history.snapshot(), [suggestions[str(i)] for i in range(1, 4)])
+        # Reset cursor
+        self.root.config(cursor="")
+        self.end_turn_trace()
+        self.save_campaign()
+        # Compress older turns in the background while the player reads
+        self.executor.submit(self.update_summary, self.game_history.snapshot())
+    
+    @TRACER.traced("update_summary")
+    def update_summary(self, history):
+        """Fold older entries into the running summary once they outgrow the context budget."""
+        pending = self.context.pending_summary(history)
+        if pending is None:
+            return
+        previous, entries, end = pending
+        try:
+            summary, _ = self.create_completion(
+                self.context.summary_messages(previous, entries),
+                temperature=0.3,
+                max_tokens=self.context.summary_tokens
+            )
+        except Exception as e:
+            self.context.cancel_summary()
+            self.show_error("Error", f"Failed to summarize the story so far: {str(e)}")
+            return
+        self.context.apply_summary(summary, end)
+    
+    def prefetch_job(self, cancel_event, history, actions):
+        """Generate outcome tables for the suggested actions, one at a time, for a click to use instantly."""
+        for action in actions:
+            turn_history = history + [f"Player: {action}"]
+            context = self.outcome_context(action, turn_history)
+            try:
+                response_text, stats = self.create_completion(self.outcome_messages(action, context), temperature=0.8, cancel_event=cancel_event)
+                outcomes, missing = self.repair_table(
+                    self.parse_reply(response_text),
+                    DnDResponseSchema,
+                    lambda keys: self.tier_messages(action, keys, context),
+                    0.8,
+                    stats["new_tokens"],
+                    cancel_event
+                )
+                if missing:
+                    continue
+            except GenerationCancelled:
+                raise
+            except Exception:
+                # Speculative work: a table that failed is just not offered
+                continue
+            self.worker.post(self.store_prefetched, self.reply_key("outcomes", turn_history, temperature=0.8), outcomes, stats)
+    
+    def store_prefetched(self, key, outcomes, stats):
+        self.prefetched[key] = (outcomes, stats)
+    
+    def take_prefetched(self, history):
+        """Return the prefetched (outcomes, stats) for the action just added to history, dropping the others."""
+        prefetched = self.prefetched.get(self.reply_key("outcomes", history, temperature=0.8))
+        if self.prefetch_started:
+            self.prefetch_turns += 1
+            self.prefetch_hits += prefetched is not None
+        self.prefetched = {}
+        self.prefetch_started = False
+        return prefetched
+    
+    def on_turn_error(self, error):
+        self.end_stream()
+        self.update_context(f"Error: {str(error)}")
+        # Reset cursor
+        self.root.config(cursor="")
+        self.end_turn_trace()
+        self.save_campaign()
     
     def on_reroll_clicked(self):
         if not self.current_outcomes:
             return
             
-        # Roll again
+        # Roll again; a tier the table lacks is generated, so every other number can come up
         old_roll = self.current_roll
         self.current_roll = self.roll_die()
-        while self.current_roll == old_roll and len(self.current_outcomes) > 1:
+        while self.current_roll == old_roll:
             self.current_roll = self.roll_die()
+        
+        if str(self.current_roll) not in self.current_outcomes:
+            # Show it as soon as it lands: the background fill is already generating it, or (for a
+            # table saved before that fill finished) the missing tiers are generated now
+            self.pending_roll = self.current_roll
+            self.update_context(f"DM [Rolled {self.current_roll}]: ...", replace_last=True)
+            if not self.outcomes_pending:
+                self.request_missing_tiers()
+            self.save_campaign()
+            return
+        self.pending_roll = None
             
         outcome = self.current_outcomes[str(self.current_roll)]
         
         # Update game context (replace last entry)
         self.update_context(f"DM [Rolled {self.current_roll}]: {outcome}", replace_last=True)
+        self.save_campaign()
+    
+    def request_missing_tiers(self):
+        """Generate the outcome tiers missing from the current table and merge them in when they land."""
+        missing = [key for key in DnDResponseSchema.keys if key not in self.current_outcomes]
+        self.outcomes_pending = True
+        self.worker.submit(
+            self.tiers_job,
+            self.last_action,
+            # The history up to the player's action, without the DM entry rerolls replace
+            self.game_history.snapshot(len(self.game_history) - 1),
+            missing,
+            on_done=self.merge_outcomes,
+            on_error=self.on_turn_error
+        )
+    
+    def tiers_job(self, cancel_event, user_action, history, keys):
+        return self.get_outcome_tiers(user_action, keys, cancel_event=cancel_event, context=self.outcome_context(user_action, history))
+    
+    def campaign_meta(self):
+        summary, summarized = self.context.summary, self.context.summarized
+        return {
+            "outcomes": self.current_outcomes,
+            "roll": self.current_roll,
+            # A reroll still waiting on its tier; the table may lack tiers the background fill hadn't added yet
+            "pending_roll": self.pending_roll,
+            "action": self.last_action,
+            "suggestions": [button["text"] for button in self.suggestion_buttons],
+            "summary": summary,
+            "summarized": summarized,
+        }
+    
+    def restore_campaign(self, history, meta):
+        """Show a saved campaign's history and put its last turn back, so play continues where it stopped."""
+        # Only the newest entries are rendered, as if they had been played in this window
+        start = max(0, len(history) - self.max_rendered_entries)
+        self.game_history.extend(history[:start])
+        self.rendered_start = self.rendered_end = start
+        for entry in history[start:]:
+            self.game_history.append(entry)
+            self.render_entry(entry)
+        self.update_show_earlier()
+        self.current_outcomes = meta.get("outcomes") or {}
+        self.current_roll = meta.get("roll")
+        self.pending_roll = meta.get("pending_roll")
+        self.last_action = meta.get("action", "")
+        for button, text in zip(self.suggestion_buttons, meta.get("suggestions", [])):
+            button.config(text=text)
+        if meta.get("summarized"):
+            self.context.apply_summary(meta["summary"], meta["summarized"])
+        if self.pending_roll is not None:
+            # The save was made while a reroll waited on its tier
+            self.request_missing_tiers()
+    
+    def save_campaign(self):
+        if self.campaign is None:
+            return
+        try:
+            self.campaign.save(self.game_history, self.campaign_meta())
+        except OSError as e:
+            self.show_error("Save Error", f"Failed to save the campaign: {str(e)}")
+    
+    def on_close(self):
+        self.worker.cancel_all()
+        self.save_campaign()
+        TRACER.close()
+        self.root.destroy()
     
     def on_suggestion_clicked(self, suggestion_number):
         suggestion = self.suggestion_buttons[suggestion_number-1]["text"]
@@ -309,8 +865,44 @@ Maintain the world's internal logic and consistency Based on the provided game c
         self.user_input.see(tk.END)
 
 def main():
+    parser = argparse.ArgumentParser(description="AI dungeon backed by an LM Studio server")
+    parser.add_argument("--lazy-outcomes", action="store_true", help="show the rolled outcome first and fill in the rest in the background")
+    parser.add_argument("--base-url", default="http://localhost:1234/v1", help="OpenAI-compatible server to use")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--max-retries", type=int, default=3, help="retries for failed requests, with exponential backoff")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="maximum requests in flight")
+    parser.add_argument("--context-tokens", type=int, default=1024, help="token budget for the game context in prompts")
+    parser.add_argument("--retrieval-k", type=int, default=4, help="earlier entries recalled by relevance per prompt (0 to disable)")
+    parser.add_argument("--no-prefetch", action="store_true", help="don't generate outcomes for the suggested actions while idle")
+    parser.add_argument("--trace", action="store_true", help="record timing spans for each turn from the start (also a checkbox)")
+    parser.add_argument("--trace-file", default="dungeon_trace.jsonl", help="JSONL file the spans are appended to")
+    parser.add_argument("--metrics-file", default="dungeon_metrics.prom", help="Prometheus textfile with per-stage totals")
+    parser.add_argument("--response-cache", metavar="PATH", default=DEFAULT_RESPONSE_CACHE, help="SQLite file for memoized replies")
+    parser.add_argument("--no-response-cache", action="store_true", help="never store or reuse replies")
+    parser.add_argument("--campaign", metavar="PATH", help="save file to resume the campaign from and autosave it to")
+    parser.add_argument("--history-ring", type=int, default=512, help="newest history entries kept in memory; older ones are memory-mapped from disk")
+    args = parser.parse_args()
+    TRACER.trace_path = args.trace_file
+    TRACER.metrics_path = args.metrics_file
+    TRACER.enabled = args.trace
+    
     root = tk.Tk()
-    app = DnDGameInterface(root)
+    app = DnDGameInterface(
+        root,
+        client=AsyncLMStudioClient(
+            base_url=args.base_url,
+            timeout=args.timeout,
+            max_retries=args.max_retries,
+            max_concurrency=args.max_concurrency
+        ),
+        lazy_outcomes=args.lazy_outcomes,
+        context_tokens=args.context_tokens,
+        retrieval_k=args.retrieval_k,
+        response_cache=None if args.no_response_cache else ResponseCache(args.response_cache),
+        prefetch=not args.no_prefetch,
+        campaign=CampaignLog(args.campaign) if args.campaign else None,
+        history_ring=args.history_ring
+    )
     root.mainloop()
 
 if __name__ == "__main__":